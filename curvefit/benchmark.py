@@ -0,0 +1,199 @@
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+from timeit import default_timer
+
+import numpy as np
+import xlwt
+from django.conf import settings
+
+from curvefit.functions import CurveFit, read_table
+from curvefit.model_functions import (BUILTIN_MODELS, compile_model,
+                                      model_aliases, model_cache)
+from curvefit.plotting import render_png
+
+SIZES = [10 ** p for p in range(2, 8)]
+FORMATS = ['.txt', '.csv', '.xls']
+
+# Largest data set written to .xls, which holds at most 65536 rows.
+XLS_MAX_ROWS = 65535
+
+# Fits start from the true parameters scaled by this factor, and the data
+# gets normal noise of this fraction of its range.
+START_FACTOR = 1.1
+NOISE = 0.01
+
+# Stages slower than the baseline by more than the tolerance, and by more
+# than the noise floor in seconds, count as regressions.
+TOLERANCE = 0.25
+NOISE_FLOOR = 0.001
+
+# True parameters and x values of the synthetic data for each built-in
+# model, as functions of the number of points.
+DATASETS = {
+    'boltzmann': ([0.2, 3.0, 12.0, 2.5], lambda n: np.linspace(0, 25, n)),
+    'expdecay': ([0.5, 4.0, 0.3], lambda n: np.linspace(0, 20, n)),
+    'gaussian': ([0.1, 2.0, 7.0, 1.5], lambda n: np.linspace(0, 15, n)),
+    'hill': ([2.5, 40.0, 1.3], lambda n: np.logspace(-1, 3, n)),
+    'ic50': ([0.9, 25.0, 1.8], lambda n: np.logspace(-1, 3, n)),
+    'mm': ([12.0, 8.0], lambda n: np.linspace(0.1, 60, n)),
+    'modsin': ([2.0, 0.5, 3.0], lambda n: np.linspace(0, 12, n)),
+}
+
+
+def dataset(name, n, seed=0):
+    """
+    Return reproducible noisy x and y values of n points for the built-in
+    model called name, and its true parameters.
+    """
+    param, xs = DATASETS[name]
+    x = xs(n)
+    y = BUILTIN_MODELS[name].eqn(x, param)
+    noise = np.random.RandomState(seed).normal(0, 1, n)
+    y = y + NOISE * (y.max() - y.min()) * noise
+    return x, y, np.array(param, dtype=float)
+
+def best_time(func, repeat):
+    """
+    Return the shortest of repeat timed calls of func and its last result.
+    """
+    best = None
+    for i in range(repeat):
+        start = default_timer()
+        value = func()
+        elapsed = default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, value
+
+def write_data(path, x, y):
+    """
+    Write x and y as two columns to path, in the format its extension
+    names.
+    """
+    if path.endswith('.xls'):
+        wbk = xlwt.Workbook()
+        sheet = wbk.add_sheet('sheet 1')
+        for i in xrange(len(x)):
+            sheet.write(i, 0, x[i])
+            sheet.write(i, 1, y[i])
+        wbk.save(path)
+    else:
+        np.savetxt(path, np.column_stack([x, y]),
+                   delimiter=',' if path.endswith('.csv') else ' ')
+
+def time_compile(name, repeat):
+    """
+    Time compiling the sympy form of a built-in model from scratch.
+    """
+    builtin = BUILTIN_MODELS[name]
+    def build():
+        model_cache.clear()
+        model_aliases.clear()
+        return compile_model(builtin.expression, builtin.nvars)
+    return best_time(build, repeat)[0]
+
+def time_parse(extn, x, y, repeat, directory):
+    path = os.path.join(directory, 'data' + extn)
+    write_data(path, x, y)
+    try:
+        return best_time(lambda: read_table(path, extn), repeat)[0]
+    finally:
+        os.remove(path)
+
+def time_fit(name, x, y, param, repeat):
+    """
+    Time a Levenberg-Marquardt fit of a built-in model. Returns the time
+    and the number of iterations.
+    """
+    builtin = BUILTIN_MODELS[name]
+    def fit():
+        f = CurveFit(None, builtin.expression, param * START_FACTOR,
+                     builtin=name)
+        f.x, f.y = x, y
+        return f.fit()[0]
+    return best_time(fit, repeat)
+
+def time_render(name, x, y, param, repeat):
+    builtin = BUILTIN_MODELS[name]
+    curve = lambda xs: builtin.eqn(xs, param)
+    return best_time(lambda: render_png(x, y, curve), repeat)[0]
+
+def run(sizes=SIZES, models=None, formats=FORMATS, repeat=3, log=None):
+    """
+    Benchmark compiling each built-in model in models (all of them by
+    default), parsing each file format and fitting and rendering each
+    model at each size. Every stage is timed repeat times and the best time
+    kept. Progress is passed to log, if given. Returns a dictionary of the
+    timings in seconds, keyed 'stage:model:size' or 'parse:format:size',
+    the iteration counts of the fits and a description of the platform.
+    """
+    models = models or list(BUILTIN_MODELS)
+    results = {
+        'meta': {
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'compile_tier': getattr(settings, 'CURVEFIT_COMPILE_TIER',
+                                    'numpy'),
+            'chunk_size': getattr(settings, 'CURVEFIT_CHUNK_SIZE', None),
+            'repeat': repeat,
+        },
+        'timings': {},
+        'iterations': {},
+    }
+    timings = results['timings']
+    def record(key, seconds):
+        timings[key] = seconds
+        if log is not None:
+            log("%-28s %10.4f s" % (key, seconds))
+    for name in models:
+        record('compile:%s' % name, time_compile(name, repeat))
+    directory = tempfile.mkdtemp()
+    try:
+        for n in sizes:
+            x, y, param = dataset(models[0], n)
+            for extn in formats:
+                if extn != '.xls' or n <= XLS_MAX_ROWS:
+                    record('parse:%s:%d' % (extn, n),
+                           time_parse(extn, x, y, repeat, directory))
+            for name in models:
+                x, y, param = dataset(name, n)
+                seconds, k = time_fit(name, x, y, param, repeat)
+                record('fit:%s:%d' % (name, n), seconds)
+                results['iterations']['fit:%s:%d' % (name, n)] = k
+                record('render:%s:%d' % (name, n),
+                       time_render(name, x, y, param, repeat))
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+def compare(results, baseline, tolerance=TOLERANCE, floor=NOISE_FLOOR):
+    """
+    Return (key, baseline seconds, seconds) for every stage timed in both
+    results and baseline that has become slower by more than tolerance, as
+    a fraction, and by more than floor seconds, slowest first.
+    """
+    regressions = []
+    old = baseline.get('timings', {})
+    for key, seconds in results['timings'].items():
+        if key not in old:
+            continue
+        base = old[key]
+        if seconds > base * (1 + tolerance) and seconds - base > floor:
+            regressions.append((key, base, seconds))
+    regressions.sort(key=lambda r: r[2] / r[1] if r[1] else np.inf,
+                     reverse=True)
+    return regressions
+
+def save(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
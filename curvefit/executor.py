@@ -0,0 +1,172 @@
+import atexit
+import multiprocessing
+import threading
+import zlib
+
+from django.conf import settings
+
+from curvefit.functions import fit_data
+from curvefit.metrics import timed
+from curvefit.model_functions import get_model, model_cache, normalize_model
+
+_executor = None
+
+
+def warm_worker():
+    """
+    Import the numeric and plotting libraries and exercise sympy once, so
+    the first fit a worker runs does not pay for it.
+    """
+    import numpy
+    import sympy
+    from curvefit.plotting import get_template
+    get_template()
+    get_model('var0 * exp(-var1 * x)', 2)
+
+def run_fit(kwargs):
+    """
+    Compile the model and run fit_data. Errors are returned in 'msg'
+    rather than raised, since they have to cross a process boundary. The
+    compile time is added to the timings, and whether the model was already
+    compiled is returned as 'model_cached'.
+    """
+    timings = {}
+    misses = model_cache.misses
+    try:
+        with timed(timings, 'compile'):
+            get_model(kwargs['model'], len(kwargs['var']),
+                      kwargs.get('builtin'))
+    except Exception:
+        return {'msg': "There was an error in the model equation."}
+    try:
+        result = fit_data(**kwargs)
+    except Exception as e:
+        return {'msg': "The fit failed: %s" % e}
+    result['timings'].update(timings)
+    result['model_cached'] = model_cache.misses == misses
+    return result
+
+def fit_summary(model, result):
+    """
+    Return the parts of a successful fit result of model that are sent as
+    JSON and kept on queued jobs, including the plot if one was asked for.
+    """
+    summary = {
+        'model': model,
+        'k': result['k'],
+        'iteration_cap': result.get('iteration_cap', False),
+        'nfev': result['nfev'],
+        'njev': result['njev'],
+        'time': result['time'],
+        'guess': result['guess'],
+        'var': result['var'],
+        'loss_scale': result.get('loss_scale'),
+        'stderr': result.get('stderr'),
+        'covariance': result.get('covariance'),
+        'r2': result.get('r2'),
+        'chi2_red': result.get('chi2_red'),
+        'dof': result.get('dof'),
+        'solutions': result.get('solutions', []),
+    }
+    for name in ('plot', 'plotdata'):
+        if result.get(name) is not None:
+            summary[name] = result[name]
+    return summary
+
+
+class FitExecutor(object):
+    """
+    A group of single-process worker pools. Fits are routed on their model
+    so that the same model always lands on the same worker, whose compiled
+    model cache then already holds it.
+    """
+    def __init__(self, workers):
+        self.pools = [multiprocessing.Pool(1, initializer=warm_worker)
+                      for i in range(workers)]
+        self.lock = threading.Lock()
+
+    def route(self, model):
+        key = normalize_model(model)
+        return self.pools[(zlib.crc32(key) & 0xffffffff) % len(self.pools)]
+
+    def submit(self, kwargs, callback=None):
+        pool = self.route(kwargs['model'])
+        return pool.apply_async(run_fit, (kwargs,), callback=callback)
+
+    def run(self, kwargs, timeout=None):
+        pool = self.route(kwargs['model'])
+        return self.wait(pool, pool.apply_async(run_fit, (kwargs,)), timeout)
+
+    def wait(self, pool, result, timeout=None):
+        """
+        Return the result of a fit submitted to pool. If it times out, the
+        worker is still busy with it and every later fit routed there would
+        queue behind it, so the pool is replaced. Fits submitted to a pool
+        that has since been replaced fail at once unless already finished.
+        """
+        if pool not in self.pools:
+            timeout = 0
+        try:
+            return result.get(timeout)
+        except multiprocessing.TimeoutError:
+            self.restart(pool)
+            raise
+
+    def restart(self, pool):
+        """
+        Terminate pool and put a fresh one in its place.
+        """
+        with self.lock:
+            if pool in self.pools:
+                self.pools[self.pools.index(pool)] = multiprocessing.Pool(
+                    1, initializer=warm_worker)
+                pool.terminate()
+
+    def shutdown(self):
+        for pool in self.pools:
+            pool.terminate()
+
+
+def get_executor():
+    """
+    Return this process's FitExecutor, or None if fits should run in the
+    web process.
+    """
+    global _executor
+    if _executor is None and settings.CURVEFIT_WORKERS:
+        _executor = FitExecutor(settings.CURVEFIT_WORKERS)
+        atexit.register(_executor.shutdown)
+    return _executor
+
+def execute(kwargs):
+    """
+    Run a fit on the executor if there is one, otherwise right here.
+    """
+    executor = get_executor()
+    if executor is None:
+        return run_fit(kwargs)
+    try:
+        return executor.run(kwargs, settings.CURVEFIT_FIT_TIMEOUT)
+    except multiprocessing.TimeoutError:
+        return {'msg': "The fit took too long and was abandoned."}
+
+def execute_many(kwargs_list):
+    """
+    Run several fits, all at once on the executor if there is one, so they
+    spread over its workers, otherwise one after another right here.
+    """
+    executor = get_executor()
+    if executor is None:
+        return [run_fit(kwargs) for kwargs in kwargs_list]
+    pools = [executor.route(kwargs['model']) for kwargs in kwargs_list]
+    pending = [pool.apply_async(run_fit, (kwargs,))
+               for pool, kwargs in zip(pools, kwargs_list)]
+    results = []
+    for pool, p in zip(pools, pending):
+        try:
+            results.append(executor.wait(pool, p,
+                                         settings.CURVEFIT_FIT_TIMEOUT))
+        except multiprocessing.TimeoutError:
+            results.append({'msg': "The fit took too long and was "
+                                   "abandoned."})
+    return results
@@ -1,16 +1,24 @@
 from django import forms
 
+from curvefit.model_functions import BUILTIN_MODELS
+from curvefit.solvers import LOSS_LABELS, SOLVERS
+
+
+def parse_numbers(value):
+    """
+    Parse a list of numbers separated by commas or spaces.
+    """
+    value = value.strip()
+    if not value:
+        return []
+    try:
+        return [float(v) for v in value.replace(',', ' ').split()]
+    except ValueError:
+        raise forms.ValidationError("Enter a list of numbers.")
+
 class CurvefitForm(forms.Form):
-    MODEL_CHOICES = (
-        ('', '--------'),
-        ('boltzmann', 'Boltzmann sigmoid'),
-        ('expdecay', 'Exponential Decay'),
-        ('gaussian', 'Gaussian function'),
-        ('hill', 'Hill plot'),
-        ('ic50', 'Dose Response (ic50)'),
-        ('mm', 'Michaelis-Menten'),
-        ('modsin', 'Modified sine wave'),
-    )
+    MODEL_CHOICES = (('', '--------'),) + tuple(
+        (m.name, m.label) for m in BUILTIN_MODELS.values())
     model = forms.CharField(max_length=500, help_text="*",
                             widget=forms.TextInput(attrs={'size': 80}))
     builtin_models = forms.ChoiceField(choices=MODEL_CHOICES, required=False,
@@ -28,11 +36,83 @@ class CurvefitForm(forms.Form):
     m4 = forms.FloatField(label=u"var3", help_text="*",
                         initial=1.0,
                         widget=forms.TextInput(attrs={'size': 10}))
+    more_vars = forms.CharField(label=u"var4, var5, ...", required=False,
+                        help_text="Initial guesses for any further "
+                                  "parameters, separated by commas",
+                        widget=forms.TextInput(attrs={'size': 50}))
+    auto_guess = forms.BooleanField(label="Estimate Initial Guess?",
+                                    required=False,
+                                    help_text="Start from parameters "
+                                              "estimated from the data if "
+                                              "they fit better")
+    multistart = forms.BooleanField(label="Search for the Global Best Fit?",
+                                    required=False,
+                                    help_text="Fit from many starting points "
+                                              "and list the other solutions "
+                                              "found")
+    solver = forms.ChoiceField(choices=[(s.name, s.label)
+                                        for s in SOLVERS.values()],
+                               required=False, initial='lm')
+    loss = forms.ChoiceField(choices=LOSS_LABELS, required=False,
+                             initial='linear',
+                             help_text="Robust losses limit the pull of "
+                                       "outliers")
+    loss_scale = forms.FloatField(label=u"Loss scale", required=False,
+                        help_text="Residual beyond which a robust loss "
+                                  "stops growing quadratically, estimated "
+                                  "from the data if not given",
+                        widget=forms.TextInput(attrs={'size': 10}))
+    lower_bounds = forms.CharField(label=u"Lower bounds", required=False,
+                        help_text="Optional lower bound for each "
+                                  "parameter, separated by commas",
+                        widget=forms.TextInput(attrs={'size': 50}))
+    upper_bounds = forms.CharField(label=u"Upper bounds", required=False,
+                        help_text="Optional upper bound for each "
+                                  "parameter, separated by commas",
+                        widget=forms.TextInput(attrs={'size': 50}))
     x_label = forms.CharField(max_length=100, required=False,
                         widget=forms.TextInput(attrs={'size': 50}))
     y_label = forms.CharField(max_length=100, required=False,
                         widget=forms.TextInput(attrs={'size': 50}))
     logscale = forms.BooleanField(label="Plot in Log Scale?",
                                   required=False)
+    vector_plot = forms.BooleanField(label="Draw Plot in Browser?",
+                                     required=False)
     infile = forms.FileField(label="File", 
-                        help_text="* .xls, .txt, and .csv files supported.")
+                        help_text="* .xls, .xlsx, .txt, .csv, .npy, .npz "
+                                  "and .parquet files supported.")
+    x_column = forms.CharField(label=u"x column", required=False,
+                        help_text="Number or heading of the column holding "
+                                  "the x values, if not the first",
+                        widget=forms.TextInput(attrs={'size': 20}))
+    y_column = forms.CharField(label=u"y column", required=False,
+                        help_text="Number or heading of the column holding "
+                                  "the y values, if not the second",
+                        widget=forms.TextInput(attrs={'size': 20}))
+    sigma_column = forms.CharField(label=u"Sigma column", required=False,
+                        help_text="Number or heading of the column holding "
+                                  "the standard deviation of each y value, "
+                                  "to weight the fit by",
+                        widget=forms.TextInput(attrs={'size': 20}))
+
+    def clean_model(self):
+        try:
+            return str(self.cleaned_data['model'])
+        except UnicodeEncodeError:
+            raise forms.ValidationError(
+                "There was an error in the model equation.")
+
+    def clean_more_vars(self):
+        return parse_numbers(self.cleaned_data['more_vars'])
+
+    def clean_lower_bounds(self):
+        return parse_numbers(self.cleaned_data['lower_bounds'])
+
+    def clean_upper_bounds(self):
+        return parse_numbers(self.cleaned_data['upper_bounds'])
+
+    def clean_loss_scale(self):
+        scale = self.cleaned_data['loss_scale']
+        if scale is not None and not 0 < scale < float('inf'):
+            raise forms.ValidationError("The loss scale must be positive.")
+        return scale
@@ -1,163 +1,862 @@
+import itertools
 import os
-import random
+import time
+import warnings
+from io import BytesIO
 import numpy as np
 import xlrd
 
-import matplotlib.pyplot as plt
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+from django.core.files import File
 
-from settings import MEDIA_ROOT
 from model_functions import * 
+from guess import (GRID_SIZE, estimates, grid, guess_parameters, scatter,
+                   sum_of_squares, thin)
+from plotting import data_uri, plot_data, render_png
+from plotstore import save_plot
+from solvers import (CHUNK_SIZE, GTOL, LOSSES, MAX_ITER, XTOL,
+                     LevenbergMarquardt, get_solver)
+from uncertainty import band, covariance, finite, r_squared
+from metrics import logger, timed
+
+
+# Formats read straight into arrays, memory-mapped where possible, rather
+# than parsed line by line.
+BINARY_EXTENSIONS = ('.npy', '.npz', '.parquet')
 
+# Multi-start fits run a short Levenberg-Marquardt from the MULTISTART_KEEP
+# best of the starting points, for at most MULTISTART_ITER iterations, and
+# report up to RUNNERS_UP other solutions besides the best.
+MULTISTART_KEEP = 16
+MULTISTART_ITER = 50
+RUNNERS_UP = 5
+
+# Most times the loss scale of a robust fit is re-estimated from its own
+# residuals.
+ROBUST_ROUNDS = 5
 
 # I have numpy 2.0.0 on my machines. Comment this out if using earlier numpy
 np.seterr(all='ignore')
 
 class CurveFit:
-    def __init__(self, filepath, model, var, logscale=False):
+    def __init__(self, filepath, model, var, logscale=False, builtin=None):
         self.filepath = filepath
         self.msg = ''
         self.logscale = logscale
         self.param = var
         self.var = var
         self.nvar = len(var)
-        self.model = get_symbolic_function(model, self.nvar)
+        self.compiled = get_model(model, self.nvar, builtin)
         self.x = []
         self.y = []
-        self.m = []
-        self.d = []
-        self.eqn = eq(self.model, self.nvar)
-        self.funcarray = dvardx(self.model, self.nvar)
+        self.eqn = self.compiled.eqn
+        self.kernel = self.compiled.kernel
+        self.chunk_size = CHUNK_SIZE
+        self.fc = None
+        self.jtc = None
+        self.rc = None
+        self.at = None
+        self.sigma = None
+        self.inv_sigma = None
+        self.jtj = None
+        self.cov = None
+        self.wssr = None
+        self.chi2 = None
+        self.loss = 'linear'
+        self.loss_scale = None
+        self.rho = None
+        self.nfev = 0
+        self.njev = 0
+        self.time = 0.0
+        self.capped = False
+
+    @property
+    def model(self):
+        return self.compiled.symfunc
         
-    def file_handler(self, extn):
+    def file_handler(self, extn, infile=None, weighted=False):
         """
         Read data from file. Use xlrd to handle .xls files. Return x and y 
-        values and a message.
-        """
-        xdata, ydata = [], []
-        if extn == '.xls':
-            wb = xlrd.open_workbook(self.filepath)
-            sh = wb.sheet_by_index(0)
-            x_raw = sh.col_values(0)
-            y_raw = sh.col_values(1)
-            for i in range(min(len(x_raw), len(y_raw))):
-                if type(x_raw[i]) == float and type(y_raw[i]) == float:
-                    xdata.append(x_raw[i])
-                    ydata.append(y_raw[i])
+        values and a message. If infile is given the data is read straight
+        from that uploaded file instead of from filepath. With weighted the
+        third column holds the standard deviation of each y value.
+        """
+        ncols = 3 if weighted else 2
+        if infile is None:
+            data, self.msg = read_table(self.filepath, extn, ncols)
+            os.remove(self.filepath)
         else:
-            x_raw, y_raw = [], []
-            with open(self.filepath, "rU") as f:
-                for line in f:
-                    if extn == '.txt':
-                        row = line.split()
-                    elif extn == '.csv':
-                        row = line.strip().split(',')
-                    try:
-                        x_raw.append(row[0])
-                        y_raw.append(row[1])
-                    except IndexError:
-                        self.msg = "Cannot read data from input file."
-                        os.remove(self.filepath)
-                        return
-            for i in range(len(x_raw)):
-                try:
-                    x, y = float(x_raw[i]), float(y_raw[i])
-                    xdata.append(x)
-                    ydata.append(y)
-                except ValueError:
-                    continue
-        self.x = np.array(xdata) 
-        self.y = np.array(ydata)
-        os.remove(self.filepath)
-        if not xdata or not ydata:
+            data, self.msg = read_table(infile, extn, ncols)
+        if self.msg:
+            return
+        self.x = data[:, 0]
+        self.y = data[:, 1]
+        if weighted:
+            self.sigma = data[:, 2]
+            self.msg = check_sigma(self.sigma)
+        if not len(data):
             self.msg = "Cannot read data. Empty input."
 
-    def equation(self):
-        self.m = self.eqn(self.x, *self.var)
+    def chunks(self):
+        """
+        Yield views of x, y and the inverse sigmas (or None) and of the
+        residual, transposed Jacobian and scratch buffers for each run of
+        at most chunk_size points, so that memory use does not grow with
+        the number of points.
+        """
+        n = len(self.x)
+        size = max(1, min(n, self.chunk_size))
+        if self.fc is None or len(self.fc) != size:
+            self.fc = np.empty(size)
+            self.rc = np.empty(size)
+            self.jtc = self.compiled.jacobian_buffer(size)
+            self.at = None
+        if self.sigma is not None and self.inv_sigma is None:
+            self.inv_sigma = 1.0 / np.asarray(self.sigma, dtype=float)
+        inv_sigma = self.inv_sigma if self.sigma is not None else None
+        for start in xrange(0, n, size):
+            m = min(size, n - start)
+            s = inv_sigma[start:start + m] if inv_sigma is not None else None
+            yield (self.x[start:start + m], self.y[start:start + m], s,
+                   self.fc[:m], self.jtc[:, :m], self.rc[:m])
 
-    def derivatives(self):
-        self.d = [df(self.x, *self.var) for df in self.funcarray]
-    
-    def get_f(self):
-        self.equation()
-        return self.y - self.m
-        
-    def get_jac(self):
-        args = []
-        self.derivatives()
-        for i in self.d:
-            if isinstance(i, int):
-                i = self.x**0.0
-            args.append(i)
-        jt = np.array(args)
-        return -1 * jt.T
+    def weights(self, f, s):
+        """
+        Return the weight of each residual in f, with inverse sigmas s, in
+        the iteratively reweighted least squares step for the loss, or None
+        if every weight is one.
+        """
+        if s is None and self.rho is None:
+            return None
+        w = s * s if s is not None else np.ones(len(f))
+        if self.rho is not None:
+            e = f * s if s is not None else f
+            w *= self.rho((e / self.loss_scale) ** 2)[1]
+        return w
+
+    def cost(self, f, s):
+        """
+        Return the contribution of the residuals f, with inverse sigmas s,
+        to the objective: the weighted sum of squares, or with a robust loss
+        loss_scale ** 2 times the sum of the loss.
+        """
+        e = f * s if s is not None else f
+        if self.rho is None:
+            return np.dot(e, e)
+        z = (e / self.loss_scale) ** 2
+        return self.loss_scale ** 2 * self.rho(z)[0].sum()
+
+    def normal_equations(self, var, a, g):
+        """
+        Fill a with J^T W J and g with J^T W f at var and return the
+        objective, accumulating them chunk by chunk. W holds the weights,
+        recomputed from the residuals at var on every call, so that with a
+        robust loss each solver step is an iteratively reweighted least
+        squares step. J^T W J, f^T W f and the sum of squared residuals
+        divided by sigma are kept for statistics, so that those at the
+        final parameters need no further evaluations.
+        """
+        self.nfev += 1
+        self.njev += 1
+        a.fill(0.0)
+        g.fill(0.0)
+        F = 0.0
+        wssr = 0.0
+        chi2 = 0.0
+        for i, (x, y, s, f, jt, r) in enumerate(self.chunks()):
+            self.kernel(x, y, f, jt, var)
+            w = self.weights(f, s)
+            if w is None:
+                wjt, wf = jt, f
+            else:
+                wjt, wf = jt * w, np.multiply(f, w, r)
+            if i == 0:
+                np.dot(wjt, jt.T, out=a)
+                np.dot(jt, wf, out=g)
+            else:
+                a += np.dot(wjt, jt.T)
+                g += np.dot(jt, wf)
+            cost = self.cost(f, s)
+            F += cost
+            wssr += np.dot(f, wf)
+            if self.rho is None:
+                chi2 += cost
+            else:
+                e = f * s if s is not None else f
+                chi2 += np.dot(e, e)
+        self.jtj = a.copy()
+        self.wssr = wssr
+        self.chi2 = chi2
+        # With a single chunk the buffers still hold f and J at var.
+        self.at = var.copy() if len(self.x) <= len(self.fc) else None
+        return F
+
+    def sum_of_squares(self, var):
+        """
+        Return the objective at var: the residual sum of squares, weighted
+        and passed through the loss if there are any.
+        """
+        self.nfev += 1
+        F = 0.0
+        for x, y, s, f, jt, r in self.chunks():
+            self.compiled.residual(x, y, r, var)
+            F += self.cost(r, s)
+        return F
+
+    def curvature(self, var, velocity, step):
+        """
+        Return J^T W r_vv at var, where r_vv is the second directional
+        derivative of the residual along velocity, estimated by a finite
+        difference with the given step.
+        """
+        trial = var + step * velocity
+        cached = self.at is not None and np.array_equal(self.at, var)
+        self.nfev += 1
+        if not cached:
+            self.nfev += 1
+            self.njev += 1
+        out = np.zeros(len(var))
+        for x, y, s, f, jt, r in self.chunks():
+            if not cached:
+                self.kernel(x, y, f, jt, var)
+            w = self.weights(f, s)
+            self.compiled.residual(x, y, r, trial)
+            r -= f
+            r /= step
+            r -= np.dot(velocity, jt)
+            r *= 2.0 / step
+            if w is not None:
+                r *= w
+            out += np.dot(jt, r)
+        return out
+
+    def residual_scale(self):
+        """
+        Return a robust estimate of the standard deviation of the weighted
+        residuals at the current parameters, from their median absolute
+        value.
+        """
+        e = self.y - self.eqn(self.x, self.var)
+        y = self.y
+        if self.sigma is not None:
+            e = e / self.sigma
+            y = y / self.sigma
+        # Exact data would give no scale at all.
+        floor = np.sqrt(np.finfo(float).eps) * (np.abs(y).max() or 1.0)
+        return max(1.4826 * np.median(np.abs(e)), floor)
+
+    def fit(self, solver=None):
+        """
+        Fit the model with solver, Levenberg-Marquardt by default, counting
+        residual and Jacobian evaluations and timing the fit. With a robust
+        loss and no loss_scale, a plain least squares fit is made first and
+        loss_scale estimated from its residuals, then from those of each
+        robust fit in turn until it stops shrinking.
+        """
+        if solver is None:
+            solver = LevenbergMarquardt()
+        self.nfev = self.njev = 0
+        self.at = None
+        self.inv_sigma = None
+        self.rho = LOSSES[self.loss]
+        start = time.time()
+        k0 = 0
+        var = np.array(self.var, dtype=float)
+        rounds = 0
+        if self.rho is not None and self.loss_scale is None:
+            self.rho = None
+            k0, self.var = solver.solve(self, var)
+            self.loss_scale = self.residual_scale()
+            self.rho = LOSSES[self.loss]
+            rounds = ROBUST_ROUNDS
+            var = self.var.copy()
+        k, self.var = solver.solve(self, var)
+        while rounds:
+            rounds -= 1
+            scale = self.residual_scale()
+            if scale > 0.5 * self.loss_scale:
+                break
+            self.loss_scale = scale
+            self.at = None
+            k0 += k
+            k, self.var = solver.solve(self, self.var.copy())
+        self.time = time.time() - start
+        self.capped = k >= solver.max_iter
+        return (k0 + k, self.var)
+
+    def levenberg_marquardt(self):
+        return self.fit(LevenbergMarquardt())
         
+    def curve(self, x):
+        return self.eqn(x, self.var)
+
+    def statistics(self):
+        """
+        Return the covariance matrix and standard errors of the parameters,
+        R squared, the reduced chi squared and the degrees of freedom of the
+        fit, all from the J^T W J and residuals the solver left at the final
+        parameters, so without evaluating the model again.
+        """
+        dof = len(self.x) - len(self.var)
+        self.cov = covariance(self.jtj, self.wssr, dof)
+        weights = None
+        if self.sigma is not None:
+            weights = 1.0 / np.asarray(self.sigma, dtype=float) ** 2
+        return {
+            'covariance': finite(self.cov),
+            'stderr': finite(np.sqrt(np.diag(self.cov))),
+            'r2': finite(r_squared(self.y, self.chi2, weights)),
+            'chi2_red': finite(self.chi2 / dof if dof > 0 else np.inf),
+            'dof': dof,
+        }
+
+    def curve_band(self, x):
+        """
+        Return the half width of the confidence band of the fitted curve at
+        x, or None if the parameters have no finite covariance.
+        """
+        if self.cov is None or not np.isfinite(self.cov).all():
+            return None
+        n = len(x)
+        f = np.empty(n)
+        jt = self.compiled.jacobian_buffer(n)
+        self.kernel(x, np.zeros(n), f, jt, self.var)
+        return band(jt, self.cov, len(self.x) - len(self.var))
+
+    def plot(self, xlab, ylab):
+        """
+        Plot results to the plot store and return the plot's path relative
+        to MEDIA_ROOT.
+        """
+        return save_plot(self.render_png(xlab, ylab))
+
+    def render_png(self, xlab, ylab):
+        """
+        Plot results and return the PNG image without saving it.
+        """
+        return render_png(self.x, self.y, self.curve, self.logscale,
+                          xlab, ylab, band=self.curve_band)
+
+    def plot_data(self):
+        """
+        Return the data and fitted curve for plotting in the browser.
+        """
+        return plot_data(self.x, self.y, self.curve, self.logscale,
+                         band=self.curve_band)
+
+
+class BatchCurveFit:
+    """
+    Fit one model to many curves sharing the same x values at once. The
+    Levenberg-Marquardt iterations for all curves are carried out together
+    on stacked (K, n, N) Jacobians, each curve with its own damping.
+    """
+    def __init__(self, filepath, model, var, logscale=False, builtin=None):
+        self.filepath = filepath
+        self.msg = ''
+        self.logscale = logscale
+        self.guess = np.asarray(var, dtype=float)
+        self.nvar = self.guess.shape[-1]
+        self.compiled = get_model(model, self.nvar, builtin)
+        self.x = []
+        self.y = []
+        self.var = None
+        self.max_iter = MAX_ITER
+
+    def file_handler(self, extn, infile=None):
+        """
+        Read x values from the first column and one curve from each of the
+        remaining columns.
+        """
+        if infile is None:
+            data, self.msg = read_table(self.filepath, extn, ncols=None)
+            os.remove(self.filepath)
+        else:
+            data, self.msg = read_table(infile, extn, ncols=None)
+        if self.msg:
+            return
+        self.x = data[:, 0]
+        self.y = data[:, 1:].T
+        if not len(data):
+            self.msg = "Cannot read data. Empty input."
+
+    def columns(self, var):
+        """
+        Lay out (K, N) parameters as N columns of shape (K, 1), so that
+        evaluating a model gives one row per curve.
+        """
+        return var.T[:, :, None]
+
+    def get_f(self, var, idx):
+        return self.y[idx] - self.compiled.eqn(self.x, self.columns(var))
+
+    def evaluate(self, var, idx):
+        """
+        Return the residuals (m, n) and Jacobians (m, n, N) of the curves
+        selected by idx at parameters var (m, N).
+        """
+        m, n = len(idx), len(self.x)
+        f = np.empty((m, n))
+        jt = self.compiled.jacobian_buffer(m, n)
+        self.compiled.kernel(self.x, self.y[idx], f, jt, self.columns(var))
+        return f, jt.transpose(1, 2, 0)
+
     def levenberg_marquardt(self):
-        N = len(self.var)
-        k = 0
-        v = 2
-        J = self.get_jac()
-        f = self.get_f()
-        a = np.dot(J.T, J)
-        g = np.dot(J.T, f)
-        mu = 1.0e-3 * max(np.diag(a))
-        while np.linalg.norm(g, np.inf) >= 1.0e-15 and k < 200:
-            k += 1
-            muI = mu * np.eye(N)
-            h = np.linalg.solve((a + muI), -g)
-            self.param = [i for i in self.var]
-            self.var += h
-            if np.linalg.norm(self.var - self.param) <= 1.0e-20:
-                return (k, self.var)
-            f_new = self.get_f()
-            dF1 = np.dot(f.T, f)
-            dF2 = np.dot(f_new.T, f_new)
-            
-            dF = 0.5 * (dF1 - dF2)
-            dL = 0.5 * np.dot(h.T, ((mu * h) - g))
-            d = dF/dL
-            if d > 0:
-                J = self.get_jac()
-                f = f_new
-                a = np.dot(J.T, J)
-                g = np.dot(J.T, f)
-                mu *= max(1.0/3.0, (1 - (2 * d - 1) ** 3))
-                v = 2
-            else:
-                self.var = self.param[:]
-                mu *= v
-                v *= 2
+        """
+        Fit every curve. Returns the number of iterations each curve took
+        and the fitted parameters as a (K, N) array.
+        """
+        K, N = len(self.y), self.nvar
+        self.var = np.empty((K, N))
+        self.var[:] = self.guess
+        k = np.zeros(K, dtype=int)
+        v = np.empty(K)
+        v.fill(2.0)
+        allidx = np.arange(K)
+        f, J = self.evaluate(self.var, allidx)
+        a = np.einsum('kni,knj->kij', J, J)
+        g = np.einsum('kni,kn->ki', J, f)
+        mu = 1.0e-3 * np.diagonal(a, axis1=1, axis2=2).max(axis=1)
+        eye = np.eye(N)
+        active = np.abs(g).max(axis=1) >= GTOL
+        while active.any():
+            idx = np.flatnonzero(active & (k < self.max_iter))
+            if not len(idx):
+                break
+            k[idx] += 1
+            A = a[idx] + mu[idx, None, None] * eye
+            h = self.solve(A, -g[idx])
+            solved = ~np.isnan(h).any(axis=1)
+            active[idx[~solved]] = False
+            idx, h = idx[solved], h[solved]
+            trial = self.var[idx] + h
+            h = trial - self.var[idx]
+            small = np.sqrt((h * h).sum(axis=1)) <= XTOL
+            self.var[idx[small]] = trial[small]
+            active[idx[small]] = False
+            idx, h, trial = idx[~small], h[~small], trial[~small]
+            if not len(idx):
+                continue
+            f_new = self.get_f(trial, idx)
+            dF = 0.5 * ((f[idx] ** 2).sum(axis=1) - (f_new ** 2).sum(axis=1))
+            dL = 0.5 * (h * (mu[idx, None] * h - g[idx])).sum(axis=1)
+            d = dF / dL
+            ok = d > 0
+            acc, rej = idx[ok], idx[~ok]
+            if len(acc):
+                self.var[acc] = trial[ok]
+                f[acc], J[acc] = self.evaluate(self.var[acc], acc)
+                a[acc] = np.einsum('kni,knj->kij', J[acc], J[acc])
+                g[acc] = np.einsum('kni,kn->ki', J[acc], f[acc])
+                mu[acc] *= np.maximum(1.0 / 3.0, 1 - (2 * d[ok] - 1) ** 3)
+                v[acc] = 2
+                active[acc] = np.abs(g[acc]).max(axis=1) >= GTOL
+            mu[rej] *= v[rej]
+            v[rej] *= 2
         return (k, self.var)
-        
-    def plot(self, plotname, xlab, ylab):
-        """
-        Plot results and save to MEDIA_ROOT.
-        """
-        plt.clf()
-        # swap input data with data for a smooth curve
-        xdata = [i for i in self.x]
-        self.x = np.arange(min(xdata), max(xdata), 
-                           (max(xdata) - min(xdata))/10000)
-        self.equation()
-        plt.plot(self.x, self.m, 'k', xdata, self.y, 'o', lw=2, ms=12, 
-                 mec='k', mew=1, mfc='None')
-        plt.xticks(size = 18)
-        plt.yticks(size = 18)
-        if self.logscale:
-            plt.xscale('log')
-        plt.ylim((min(self.y) - max(self.y) * 0.2), 
-                 (max(self.y) + max(self.y) * 0.2))
-        plt.xlabel(xlab, fontsize=24)
-        plt.ylabel(ylab, fontsize=24)
-        plt.subplots_adjust(bottom=0.15)
-        plotfile = os.path.join(MEDIA_ROOT, plotname)
-        plt.savefig(plotfile, dpi=80)
-        self.x = xdata
-
-
-def random_key():
-    v = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
-    key = []
-    for i in range(20):
-        key.append(random.choice(v))
-    return "".join(key)
 
+    def solve(self, A, b):
+        """
+        Solve the stacked systems A h = b. Curves whose system is singular
+        get a step of nan.
+        """
+        try:
+            return np.linalg.solve(A, b[:, :, None])[:, :, 0]
+        except np.linalg.LinAlgError:
+            h = np.empty(b.shape)
+            for i in range(len(b)):
+                try:
+                    h[i] = np.linalg.solve(A[i], b[i])
+                except np.linalg.LinAlgError:
+                    h[i] = np.nan
+            return h
+
+
+def multi_start(model, var, x, y, builtin=None, starts=GRID_SIZE,
+                keep=MULTISTART_KEEP, max_iter=MULTISTART_ITER):
+    """
+    Look for the global best fit. The given guess, the data-driven
+    estimates, a coarse grid around var and points scattered around it,
+    starts in all, are scored in one batched evaluation, and a short
+    Levenberg-Marquardt is run on the keep best of them together. Returns
+    the distinct solutions found as a list of (parameters, sum of squares)
+    pairs, best first.
+    """
+    var = np.asarray(var, dtype=float)
+    fit = BatchCurveFit(None, model, var, builtin=builtin)
+    xs, ys = thin(x, y)
+    candidates = np.vstack([var[None, :], estimates(fit.compiled, xs, ys),
+                            grid(var, starts // 2),
+                            scatter(var, starts - starts // 2)])
+    sse = sum_of_squares(fit.compiled, xs, ys, candidates)
+    order = np.argsort(sse, kind='mergesort')[:keep]
+    fit.guess = candidates[order[np.isfinite(sse[order])]]
+    if not len(fit.guess):
+        return []
+    fit.x = x
+    fit.y = np.broadcast_to(y, (len(fit.guess), len(x)))
+    fit.max_iter = max_iter
+    params = fit.levenberg_marquardt()[1]
+    f = fit.get_f(params, np.arange(len(params)))
+    sse = (f * f).sum(axis=1)
+    solutions = []
+    for i in np.argsort(sse, kind='mergesort'):
+        if not np.isfinite(sse[i]):
+            break
+        if not any(np.allclose(params[i], p, rtol=1.0e-4)
+                   for p, _ in solutions):
+            solutions.append((params[i], float(sse[i])))
+    return solutions
+
+def fit_data(model, var, x, y, logscale=False, builtin=None, store_plot=False,
+             xlabel='', ylabel='', inline_plot=False, vector_plot=False,
+             solver=None, solver_options=None, auto_guess=False,
+             multistart=False, sigma=None, loss='linear', loss_scale=None):
+    """
+    Fit model to already parsed data and optionally plot the result, either
+    with store_plot to the plot store (see plotstore.save_plot), returning
+    its path as 'plotfile', or with inline_plot to a data URI returned as
+    'plotdata'. With vector_plot the points for drawing the plot in the
+    browser are returned as 'plot' instead. The fit is made by the named
+    solver (see solvers.SOLVERS), configured with solver_options. With
+    auto_guess the fit starts from the best of var and the points tried by
+    guess.guess_parameters. With multistart it starts from the best
+    solution found by multi_start, and the other solutions are returned as
+    'solutions'. Residuals are divided by sigma, the standard deviation of
+    each y value, if given, and passed through the named loss (see
+    solvers.LOSSES) with scale loss_scale, estimated from a least squares
+    fit if not given. The covariance matrix and standard errors of the
+    parameters, R squared and the reduced chi squared come from the final
+    J^T W J (see CurveFit.statistics), and plots show the 95% confidence
+    band. Returns the number of iterations, evaluations and
+    Jacobian evaluations, the fit time, the starting point and the fitted
+    parameters in a dictionary, together with the time spent in each stage
+    as 'timings' and whether the solver stopped at its iteration cap.
+    """
+    timings = {}
+    fit = CurveFit(None, model, np.array(var, dtype=float), logscale, builtin)
+    fit.x = np.asarray(x, dtype=float)
+    fit.y = np.asarray(y, dtype=float)
+    if sigma is not None:
+        fit.sigma = np.asarray(sigma, dtype=float)
+    fit.loss = loss or 'linear'
+    fit.loss_scale = loss_scale
+    solutions = []
+    with timed(timings, 'guess'):
+        if multistart:
+            solutions = multi_start(model, fit.var, fit.x, fit.y, builtin)
+            if solutions:
+                fit.var = solutions[0][0].copy()
+        elif auto_guess:
+            fit.var = guess_parameters(fit.compiled, fit.var, fit.x, fit.y)
+    guess = [float(v) for v in fit.var]
+    solver = get_solver(solver, **(solver_options or {}))
+    k, var = fit.fit(solver)
+    timings['fit'] = fit.time
+    if fit.capped:
+        logger.warning("Fit of %s to %d points stopped at the iteration cap "
+                       "of %d without converging.", model, len(fit.x),
+                       solver.max_iter)
+    result = {
+        'k': k,
+        'var': [float(v) for v in var],
+        'loss_scale': fit.loss_scale,
+        'nfev': fit.nfev,
+        'njev': fit.njev,
+        'time': fit.time,
+        'guess': guess,
+        'plotfile': None,
+        'iteration_cap': fit.capped,
+        'timings': timings,
+    }
+    result.update(fit.statistics())
+    if multistart:
+        result['solutions'] = [
+            {'var': [float(v) for v in p], 'sse': sse}
+            for p, sse in solutions[1:RUNNERS_UP + 1]
+            if not np.allclose(p, var, rtol=1.0e-4)]
+    with timed(timings, 'plot'):
+        if vector_plot:
+            result['plot'] = fit.plot_data()
+        elif inline_plot:
+            result['plotdata'] = data_uri(fit.render_png(xlabel, ylabel))
+        elif store_plot:
+            result['plotfile'] = fit.plot(xlabel, ylabel)
+    return result
+
+def load_data(infile, extn, columns=None):
+    """
+    Read x and y values from a data file, from the columns given in columns
+    if any (see read_table). A third column in columns holds the standard
+    deviation of each y value. Returns x, y, the standard deviations or
+    None and a message.
+    """
+    data, msg = read_table(infile, extn, columns=columns)
+    if not msg and not len(data):
+        msg = "Cannot read data. Empty input."
+    sigma = None
+    if columns and len(columns) > 2 and data.shape[1] > 2:
+        sigma = data[:, 2]
+        msg = msg or check_sigma(sigma)
+    return data[:, 0], data[:, 1], sigma, msg
+
+def check_sigma(sigma):
+    """
+    Return a message if any of the standard deviations sigma is not
+    positive.
+    """
+    if not (sigma > 0).all():
+        return "The standard deviations must all be positive."
+    return ''
+
+def iter_lines(infile):
+    """
+    Yield the lines of a file one chunk at a time, so that the whole file is
+    never held in memory as a single string.
+    """
+    tail = ''
+    for chunk in infile.chunks():
+        lines = (tail + chunk).splitlines(True)
+        tail = lines.pop() if lines else ''
+        for line in lines:
+            yield line
+    if tail:
+        yield tail
+
+def read_table(infile, extn, ncols=2, columns=None):
+    """
+    Read rows of numbers from a data file, either a path or an uploaded
+    file, without writing anything to disk. Use xlrd to handle .xls files
+    and openpyxl, if installed, for .xlsx files. NumPy .npy and .npz files
+    and, with pyarrow installed, Parquet files are loaded as whole columns.
+    Rows holding anything other than numbers are skipped. The first ncols
+    columns are read, or every column if ncols is None, unless columns
+    lists the columns to read, each by number counting from 1 or by its
+    heading in the first row. Returns an (nrows, ncols) array and a
+    message.
+    """
+    if isinstance(infile, basestring) and extn not in BINARY_EXTENSIONS:
+        mode = "rb" if extn in ('.xls', '.xlsx') else "rU"
+        with open(infile, mode) as f:
+            return read_table(File(f), extn, ncols, columns)
+    if extn == '.xls':
+        return read_xls(infile, ncols, columns)
+    if extn == '.xlsx':
+        return read_xlsx(infile, ncols, columns)
+    if extn in ('.npy', '.npz'):
+        return read_numpy(infile, extn, ncols, columns)
+    if extn == '.parquet':
+        return read_parquet(infile, ncols, columns)
+    return read_text(infile, extn, ncols, columns)
+
+def column_indices(header, columns):
+    """
+    Return the indices of columns, given by number or by heading in
+    header. Returns None and a message if one of them cannot be found.
+    """
+    names = [unicode(h).strip().strip('"\'') if h is not None else u''
+             for h in header]
+    indices = []
+    for column in columns:
+        column = unicode(column).strip()
+        if column.isdigit() and int(column) > 0:
+            indices.append(int(column) - 1)
+        elif column in names:
+            indices.append(names.index(column))
+        else:
+            return None, "There is no column %s in the input file." % column
+    return indices, ''
+
+def read_xls(infile, ncols, columns):
+    wb = xlrd.open_workbook(file_contents="".join(infile.chunks()),
+                            on_demand=True)
+    sh = wb.sheet_by_index(0)
+    if columns:
+        header = sh.row_values(0) if sh.nrows else []
+        idx, msg = column_indices(header, columns)
+        if msg:
+            return np.empty((0, 2)), msg
+    else:
+        idx = range(sh.ncols if ncols is None else ncols)
+    if len(idx) < 2 or sh.ncols <= max(idx):
+        return np.empty((0, 2)), "Cannot read data from input file."
+    numeric = np.ones(sh.nrows, dtype=bool)
+    for i in idx:
+        numeric &= np.array(sh.col_types(i)) == xlrd.XL_CELL_NUMBER
+    data = np.array([sh.col_values(i) for i in idx],
+                    dtype=object).T[numeric]
+    return data.astype(float).reshape(-1, len(idx)), ''
+
+def read_xlsx(infile, ncols, columns):
+    """
+    Stream the rows of the first sheet of an .xlsx file into a float array,
+    reading only as far across as the last column wanted. Other sheets are
+    never parsed.
+    """
+    if openpyxl is None:
+        return np.empty((0, 2)), "Reading .xlsx files needs openpyxl."
+    f = getattr(infile, 'file', None)
+    if f is None:
+        f = BytesIO("".join(infile.chunks()))
+    f.seek(0)
+    try:
+        wb = openpyxl.load_workbook(f, read_only=True, data_only=True)
+    except Exception:
+        return np.empty((0, 2)), "Cannot read data from input file."
+    try:
+        ws = wb.worksheets[0]
+        if columns or ncols is None:
+            header = next(ws.iter_rows(max_row=1, values_only=True), ())
+        if columns:
+            idx, msg = column_indices(header, columns)
+            if msg:
+                return np.empty((0, 2)), msg
+        else:
+            idx = range(len(header) if ncols is None else ncols)
+        if len(idx) < 2:
+            return np.empty((0, 2)), "Cannot read data from input file."
+        data = np.empty((max(ws.max_row or 0, 1024), len(idx)))
+        n = 0
+        for row in ws.iter_rows(max_col=max(idx) + 1, values_only=True):
+            if len(row) <= max(idx):
+                continue
+            values = [row[i] for i in idx]
+            if not all(isinstance(v, (int, long, float)) and
+                       not isinstance(v, bool) for v in values):
+                continue
+            if n == len(data):
+                data = np.concatenate([data, np.empty_like(data)])
+            data[n] = values
+            n += 1
+    finally:
+        wb.close()
+    return data[:n], ''
+
+def binary_source(infile):
+    """
+    Return the path of infile if it is on disk, so that it can be
+    memory-mapped, or else its contents as a file object.
+    """
+    if isinstance(infile, basestring):
+        return infile
+    if hasattr(infile, 'temporary_file_path'):
+        return infile.temporary_file_path()
+    return BytesIO("".join(infile.chunks()))
+
+def gather(names, column, ncols, columns):
+    """
+    Copy the wanted columns of a table into a float array, where names are
+    the column headings and column(i) returns the i-th column. Rows with a
+    missing or non-finite value are dropped.
+    """
+    if columns:
+        idx, msg = column_indices(names, columns)
+        if msg:
+            return np.empty((0, 2)), msg
+    else:
+        idx = range(len(names) if ncols is None else ncols)
+    if len(idx) < 2 or max(idx) >= len(names):
+        return np.empty((0, 2)), "Cannot read data from input file."
+    first = column(idx[0])
+    data = np.empty((len(first), len(idx)))
+    data[:, 0] = first
+    for j, i in enumerate(idx[1:], 1):
+        data[:, j] = column(i)
+    return data[np.isfinite(data).all(axis=1)], ''
+
+def array_columns(arr):
+    """
+    Return the column names of an array and a function returning its
+    columns: the fields of a structured array, or the columns of a plain
+    one, which have no names.
+    """
+    if arr.dtype.names:
+        names = list(arr.dtype.names)
+        return names, lambda i: arr[names[i]]
+    arr = arr.reshape(len(arr), -1)
+    return [''] * arr.shape[1], lambda i: arr[:, i]
+
+def read_numpy(infile, extn, ncols, columns):
+    """
+    Read columns from a .npy file, memory-mapped when it is on disk, or
+    from a .npz file, whose arrays are the columns unless it holds just
+    one two-dimensional array.
+    """
+    source = binary_source(infile)
+    mmap = 'r' if extn == '.npy' and isinstance(source, basestring) else None
+    try:
+        loaded = np.load(source, mmap_mode=mmap, allow_pickle=False)
+    except (IOError, ValueError):
+        return np.empty((0, 2)), "Cannot read data from input file."
+    try:
+        if extn == '.npz' and len(loaded.files) != 1:
+            names = loaded.files
+            column = lambda i: loaded[names[i]]
+        else:
+            arr = loaded[loaded.files[0]] if extn == '.npz' else loaded
+            names, column = array_columns(arr)
+        return gather(names, column, ncols, columns)
+    except (IOError, ValueError, TypeError, IndexError, AttributeError):
+        return np.empty((0, 2)), "Cannot read data from input file."
+    finally:
+        if extn == '.npz' and hasattr(loaded, 'close'):
+            loaded.close()
+
+def arrow_column(chunked):
+    """
+    Convert a pyarrow column to a float array, with nulls as nan.
+    """
+    data = np.empty(len(chunked))
+    start = 0
+    for chunk in chunked.chunks:
+        data[start:start + len(chunk)] = chunk.to_numpy(zero_copy_only=False)
+        start += len(chunk)
+    return data
+
+def read_parquet(infile, ncols, columns):
+    """
+    Read only the wanted columns of a Parquet file.
+    """
+    if pq is None:
+        return np.empty((0, 2)), "Reading .parquet files needs pyarrow."
+    source = binary_source(infile)
+    try:
+        pf = pq.ParquetFile(source,
+                            memory_map=isinstance(source, basestring))
+        names = pf.schema.names
+        column = lambda i: arrow_column(pf.read(columns=[names[i]]).column(0))
+        return gather(names, column, ncols, columns)
+    except Exception:
+        return np.empty((0, 2)), "Cannot read data from input file."
+
+def read_text(infile, extn, ncols, columns):
+    delimiter = ',' if extn == '.csv' else None
+    lines = iter_lines(infile)
+    first = next(lines, '')
+    lines = itertools.chain([first], lines)
+    if columns:
+        idx, msg = column_indices(first.split(delimiter), columns)
+        if msg:
+            return np.empty((0, 2)), msg
+    else:
+        idx = range(len(first.split(delimiter)) if ncols is None else ncols)
+    if len(idx) < 2:
+        return np.empty((0, 2)), "Cannot read data from input file."
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        try:
+            data = np.genfromtxt(lines, delimiter=delimiter,
+                                 usecols=idx, dtype=float)
+        except (ValueError, IndexError):
+            return np.empty((0, 2)), "Cannot read data from input file."
+    data = data.reshape(-1, len(idx))
+    return data[~np.isnan(data).any(axis=1)], ''
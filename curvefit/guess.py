@@ -0,0 +1,205 @@
+import numpy as np
+
+from curvefit.model_functions import BuiltinModel
+
+# Number of points the data is thinned to, and the number of grid points
+# tried for models without a heuristic.
+GUESS_POINTS = 1000
+GRID_SIZE = 512
+
+# Multiples of each parameter's magnitude making up the coarse grid.
+GRID_STEPS = np.array([-10.0, -1.0, -0.1, 0.0, 0.1, 1.0, 10.0])
+
+
+def thin(x, y, npoints=GUESS_POINTS):
+    """
+    Return the finite points of x and y sorted on x, keeping at most
+    npoints of them, evenly spread.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    keep = np.isfinite(x) & np.isfinite(y)
+    x, y = x[keep], y[keep]
+    if len(x) > npoints:
+        idx = np.linspace(0, len(x) - 1, npoints).astype(int)
+        x, y = x[idx], y[idx]
+    order = np.argsort(x, kind='mergesort')
+    return x[order], y[order]
+
+def ends(y, fraction=0.1):
+    """
+    Return the mean of y over the first and the last tenth of the points.
+    """
+    m = max(1, int(len(y) * fraction))
+    return y[:m].mean(), y[-m:].mean()
+
+def crossing(x, y, level):
+    """
+    Return the x at which y first crosses level, interpolating linearly
+    between the points either side, or None if it never does.
+    """
+    d = y - level
+    idx = np.flatnonzero(np.sign(d[:-1]) != np.sign(d[1:]))
+    if not len(idx):
+        return None
+    i = idx[0]
+    if d[i] == d[i + 1]:
+        return x[i]
+    return x[i] + (x[i + 1] - x[i]) * d[i] / (d[i] - d[i + 1])
+
+def sigmoid_width(x, y, bottom, top):
+    """
+    Return the x at the midpoint between bottom and top and the x distance
+    between the quarter and three quarter points, or None for either if y
+    never reaches them.
+    """
+    mid = crossing(x, y, bottom + 0.5 * (top - bottom))
+    low = crossing(x, y, bottom + 0.25 * (top - bottom))
+    high = crossing(x, y, bottom + 0.75 * (top - bottom))
+    if low is None or high is None:
+        return mid, None
+    return mid, high - low
+
+def boltzmann_guess(x, y):
+    bottom, top = ends(y)
+    mid, width = sigmoid_width(x, y, bottom, top)
+    if mid is None:
+        mid = x.mean()
+    if not width:
+        width = (x[-1] - x[0]) / 10.0
+    # Between the quarter points of a Boltzmann sigmoid x moves 2 ln 3 var3.
+    return [bottom, top, mid, width / (2 * np.log(3))]
+
+def expdecay_guess(x, y):
+    first, last = ends(y)
+    start = y[0] - last
+    at = crossing(x, y - last, start / np.e)
+    rate = 1.0 / (at - x[0]) if at is not None and at > x[0] else 1.0
+    return [last, start * np.exp(rate * x[0]), rate]
+
+def gaussian_guess(x, y):
+    base = np.median(y)
+    peak = np.argmax(np.abs(y - base))
+    height = y[peak] - base
+    above = np.flatnonzero(np.abs(y - base) >= 0.5 * abs(height))
+    fwhm = x[above[-1]] - x[above[0]]
+    if not fwhm:
+        fwhm = (x[-1] - x[0]) / 10.0
+    # The full width at half maximum is 2 sqrt(ln 2) var3.
+    return [base, height, x[peak], fwhm / (2 * np.sqrt(np.log(2)))]
+
+def hill_guess(x, y):
+    top = ends(y)[1]
+    positive = x > 0
+    x, y = x[positive], y[positive]
+    mid = crossing(x, y, 0.5 * top)
+    low = crossing(x, y, 0.25 * top)
+    high = crossing(x, y, 0.75 * top)
+    if mid is None:
+        mid = np.exp(np.log(x).mean())
+    slope = 1.0
+    if low and high and low != high:
+        # y / var0 goes from a quarter to three quarters while x grows by
+        # a factor of 9 ** (1 / var2).
+        slope = np.log(9) / np.log(high / low)
+    return [top, mid, slope]
+
+def ic50_guess(x, y):
+    return hill_guess(x, 1 - y)
+
+def mm_guess(x, y):
+    vmax = ends(y)[1]
+    km = crossing(x, y, 0.5 * vmax)
+    if km is None:
+        km = x.mean()
+    return [vmax, km]
+
+def modsin_guess(x, y):
+    amplitude = np.abs(y).max()
+    xs = np.linspace(x[0], x[-1], len(x))
+    spectrum = np.abs(np.fft.rfft(np.interp(xs, x, y)))
+    freq = np.fft.rfftfreq(len(xs), xs[1] - xs[0])
+    k = np.argmax(spectrum[1:]) + 1 if len(spectrum) > 1 else 0
+    halfperiod = 0.5 / freq[k] if k and freq[k] else (x[-1] - x[0])
+    # Try a range of phases; the best is chosen with the other candidates.
+    return [[amplitude, phase, halfperiod]
+            for phase in np.linspace(0, 2 * halfperiod, 8, endpoint=False)]
+
+HEURISTICS = {
+    'boltzmann': boltzmann_guess,
+    'expdecay': expdecay_guess,
+    'gaussian': gaussian_guess,
+    'hill': hill_guess,
+    'ic50': ic50_guess,
+    'mm': mm_guess,
+    'modsin': modsin_guess,
+}
+
+
+def grid(var, size=GRID_SIZE, seed=0):
+    """
+    Return a coarse grid of starting points around var, spanning several
+    orders of magnitude and both signs for each parameter. If the full
+    grid has more than size points, size of them are drawn at random.
+    """
+    var = np.asarray(var, dtype=float)
+    N = len(var)
+    scale = np.where(var == 0, 1.0, np.abs(var))
+    values = scale[:, None] * GRID_STEPS
+    n = len(GRID_STEPS)
+    if n ** N <= size:
+        idx = np.indices((n,) * N).reshape(N, -1).T
+    else:
+        idx = np.random.RandomState(seed).randint(0, n, (size, N))
+    return values[np.arange(N), idx]
+
+def scatter(var, size=GRID_SIZE, seed=0):
+    """
+    Return size starting points drawn at random between zero and twice
+    var, or between -1 and 1 for parameters guessed as zero.
+    """
+    var = np.asarray(var, dtype=float)
+    u = np.random.RandomState(seed).uniform(0.0, 2.0, (size, len(var)))
+    return np.where(var == 0, u - 1.0, u * var)
+
+def sum_of_squares(compiled, x, y, candidates):
+    """
+    Return the sum of squared residuals of every row of candidates in one
+    batched evaluation. Candidates giving non-finite residuals get inf.
+    """
+    K = len(candidates)
+    model = compiled.eqn(x, candidates.T[:, :, None])
+    f = np.broadcast_to(y - model, (K, len(x)))
+    sse = (f * f).sum(axis=1)
+    sse[~np.isfinite(sse)] = np.inf
+    return sse
+
+def estimates(compiled, x, y):
+    """
+    Return the data-driven starting points for a built-in model as rows of
+    an array, which is empty for models without a heuristic. x and y must
+    be sorted on x, as thin returns them.
+    """
+    heuristic = None
+    if isinstance(compiled, BuiltinModel):
+        heuristic = HEURISTICS.get(compiled.name)
+    if heuristic is None:
+        return np.empty((0, compiled.nvars))
+    return np.array(heuristic(x, y), dtype=float).reshape(-1, compiled.nvars)
+
+def guess_parameters(compiled, var, x, y):
+    """
+    Return the best starting point for fitting compiled to x and y among
+    the given guess var and either the data-driven estimates for a
+    built-in model or a coarse grid around var for any other model.
+    """
+    var = np.asarray(var, dtype=float)
+    x, y = thin(x, y)
+    if len(x) < 2:
+        return var
+    extra = estimates(compiled, x, y)
+    if not len(extra):
+        extra = grid(var)
+    candidates = np.vstack([var[None, :], extra])
+    sse = sum_of_squares(compiled, x, y, candidates)
+    return candidates[np.argmin(sse)]
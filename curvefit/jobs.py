@@ -0,0 +1,77 @@
+import datetime
+import json
+from functools import partial
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+
+from curvefit.executor import fit_summary, get_executor
+from curvefit.metrics import logger, metrics
+from curvefit.models import FitJob
+from curvefit.resultcache import result_key, store
+
+
+def finish_job(job_id, key, result, close=False):
+    """
+    Record the result of a queued fit on its job and in the result cache.
+    With an executor this runs in the pool's result handler thread, which
+    an exception would stop, leaving every later job pending, so errors are
+    logged rather than raised.
+    """
+    try:
+        metrics.record_fit(result)
+        job = FitJob.objects.get(pk=job_id)
+        if 'msg' in result:
+            job.status = 'failed'
+            job.msg = result['msg'][:255]
+        else:
+            job.status = 'done'
+            job.iterations = result['k']
+            job.params = json.dumps(result['var'])
+            job.plotfile = result['plotfile'] or ''
+            summary = fit_summary(job.model, result)
+            if 'plot' in summary:
+                job.plot = json.dumps(summary.pop('plot'))
+            summary.pop('plotdata', None)
+            job.result = json.dumps(summary)
+        job.finished = datetime.datetime.now()
+        job.save()
+        store(key, result)
+    except Exception:
+        logger.exception("Recording the result of fit job %d failed.",
+                         job_id)
+    finally:
+        if close:
+            connection.close()
+
+def expire_job(job):
+    """
+    Mark job as failed if it has been pending for longer than
+    CURVEFIT_FIT_TIMEOUT seconds, since its result is not going to come.
+    """
+    timeout = settings.CURVEFIT_FIT_TIMEOUT
+    if job.status != 'pending' or timeout is None:
+        return job
+    now = datetime.datetime.now()
+    if now - job.created > datetime.timedelta(seconds=timeout):
+        job.status = 'failed'
+        job.msg = "The fit took too long and was abandoned."
+        job.finished = now
+        job.save()
+    return job
+
+def submit_job(kwargs, filename):
+    """
+    Queue the fit described by kwargs (see fit_data) and return its FitJob
+    straight away. Queued fits need worker processes to run them.
+    """
+    executor = get_executor()
+    if executor is None:
+        raise ImproperlyConfigured("CURVEFIT_ASYNC needs CURVEFIT_WORKERS, "
+                                   "or fits would run inside the request.")
+    job = FitJob.objects.create(model=kwargs['model'], filename=filename)
+    key = result_key(kwargs)
+    executor.submit(kwargs, callback=partial(finish_job, job.pk, key,
+                                             close=True))
+    return job
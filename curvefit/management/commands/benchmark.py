@@ -0,0 +1,54 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from curvefit import benchmark
+
+
+def parse_list(value, convert=str):
+    return [convert(v) for v in value.split(',') if v.strip()]
+
+
+class Command(BaseCommand):
+    help = ("Time model compilation, parsing, fitting and rendering on "
+            "synthetic data for the built-in models, and compare the "
+            "timings with a baseline.")
+    option_list = BaseCommand.option_list + (
+        make_option('--sizes', default=','.join(map(str, benchmark.SIZES)),
+                    help="Comma separated numbers of points."),
+        make_option('--models', default='',
+                    help="Comma separated built-in models, all by default."),
+        make_option('--formats', default=','.join(benchmark.FORMATS),
+                    help="Comma separated file formats to parse."),
+        make_option('--repeat', type='int', default=3,
+                    help="Times each stage is run; the best is kept."),
+        make_option('--output', default=None,
+                    help="Write the results to this JSON file."),
+        make_option('--baseline', default=None,
+                    help="Compare the results with this JSON file."),
+        make_option('--tolerance', type='float',
+                    default=benchmark.TOLERANCE,
+                    help="Slowdown, as a fraction, counted as a "
+                         "regression."),
+    )
+
+    def handle(self, *args, **options):
+        models = parse_list(options['models'])
+        for name in models:
+            if name not in benchmark.DATASETS:
+                raise CommandError("Unknown model %r." % name)
+        log = lambda line: self.stdout.write(line + "\n")
+        results = benchmark.run(parse_list(options['sizes'], int), models,
+                                parse_list(options['formats']),
+                                options['repeat'], log)
+        if options['output']:
+            benchmark.save(results, options['output'])
+        if options['baseline']:
+            regressions = benchmark.compare(results,
+                                            benchmark.load(options['baseline']),
+                                            options['tolerance'])
+            for key, old, new in regressions:
+                log("%-28s %10.4f s -> %.4f s" % (key, old, new))
+            if regressions:
+                raise CommandError("%d stages are slower than the baseline."
+                                   % len(regressions))
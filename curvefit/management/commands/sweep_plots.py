@@ -0,0 +1,21 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from curvefit import plotstore
+
+
+class Command(BaseCommand):
+    help = ("Remove plots unused for longer than the time to live, then the "
+            "least recently used until the rest fit the disk budget.")
+    option_list = BaseCommand.option_list + (
+        make_option('--budget', type='int', default=plotstore.PLOT_BUDGET,
+                    help="Bytes the plots may take up."),
+        make_option('--ttl', type='int', default=plotstore.PLOT_TTL,
+                    help="Seconds a plot is kept after it was last used."),
+    )
+
+    def handle(self, *args, **options):
+        removed, freed = plotstore.sweep(options['budget'], options['ttl'])
+        self.stdout.write("Removed %d plots, freeing %d bytes.\n" %
+                          (removed, freed))
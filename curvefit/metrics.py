@@ -0,0 +1,114 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+logger = logging.getLogger('curvefit')
+
+# Stages of handling a fit, in the order they happen.
+STAGES = ('parse', 'compile', 'guess', 'fit', 'plot', 'total')
+
+COUNTERS = OrderedDict([
+    ('requests', "Fit requests handled."),
+    ('fits', "Fits run, not counting results served from the cache."),
+    ('failed_fits', "Fits that failed."),
+    ('iterations', "Solver iterations."),
+    ('function_evaluations', "Residual evaluations."),
+    ('jacobian_evaluations', "Jacobian evaluations."),
+    ('iteration_cap', "Fits stopped by the iteration cap."),
+    ('model_cache_hits', "Fits whose compiled model was already in memory."),
+    ('model_cache_misses', "Fits whose model had to be compiled."),
+    ('result_cache_hits', "Fits answered from the result cache."),
+    ('result_cache_misses', "Fits not found in the result cache."),
+    ('bytes_parsed', "Bytes of uploaded data read."),
+    ('plots_evicted', "Plots removed from the plot store by sweeps."),
+])
+
+
+@contextmanager
+def timed(timings, stage):
+    """
+    Add the time spent in the body of the with statement to
+    timings[stage].
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + time.time() - start
+
+def server_timing(timings):
+    """
+    Format stage timings in seconds as a Server-Timing header value.
+    """
+    return ", ".join("%s;dur=%.1f" % (stage, 1000 * timings[stage])
+                     for stage in STAGES if stage in timings)
+
+
+class Metrics(object):
+    """
+    Thread-safe counters and per-stage time totals for the fits handled by
+    this process, rendered in the Prometheus text exposition format. Fits
+    run in worker processes report back through their results, so they
+    are counted by the web process that asked for them.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = dict((name, 0) for name in COUNTERS)
+            self.stage_count = {}
+            self.stage_sum = {}
+
+    def inc(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def observe(self, timings):
+        with self._lock:
+            for stage, seconds in timings.items():
+                self.stage_count[stage] = self.stage_count.get(stage, 0) + 1
+                self.stage_sum[stage] = (self.stage_sum.get(stage, 0.0) +
+                                         seconds)
+
+    def record_fit(self, result):
+        """
+        Count a fit from its result (see fit_data and run_fit).
+        """
+        if 'msg' in result:
+            self.inc('failed_fits')
+            return
+        self.inc('fits')
+        self.inc('iterations', result.get('k') or 0)
+        self.inc('function_evaluations', result.get('nfev') or 0)
+        self.inc('jacobian_evaluations', result.get('njev') or 0)
+        if result.get('iteration_cap'):
+            self.inc('iteration_cap')
+        if 'model_cached' in result:
+            self.inc('model_cache_hits' if result['model_cached']
+                     else 'model_cache_misses')
+        self.observe(result.get('timings', {}))
+
+    def render(self):
+        with self._lock:
+            lines = []
+            for name, help in COUNTERS.items():
+                metric = "curvefit_%s_total" % name
+                lines.append("# HELP %s %s" % (metric, help))
+                lines.append("# TYPE %s counter" % metric)
+                lines.append("%s %d" % (metric, self.counters[name]))
+            lines.append("# HELP curvefit_stage_seconds Time spent in each "
+                         "stage of handling a fit.")
+            lines.append("# TYPE curvefit_stage_seconds summary")
+            for stage in sorted(self.stage_sum):
+                lines.append('curvefit_stage_seconds_sum{stage="%s"} %r' %
+                             (stage, self.stage_sum[stage]))
+                lines.append('curvefit_stage_seconds_count{stage="%s"} %d' %
+                             (stage, self.stage_count[stage]))
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
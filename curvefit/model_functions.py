@@ -1,59 +1,295 @@
 import re
+import threading
+from collections import OrderedDict
+
 import numpy as np
 import sympy as s
+from django.conf import settings
+from sympy.printing.pycode import NumPyPrinter
+
+from curvefit.native import COMPILE_TIER, NativeKernel, c_source, load_library
+
+# Largest number of parameters a model may have.
+MAX_NVARS = 16
+
+def var_indices(function):
+    return set(int(i) for i in re.findall('var([0-9]+)', function))
 
 def find_nvars(function):
-    return len(set(re.findall('var[0-9]+', function))) 
+    """
+    Return the number of parameters of function, one more than the highest
+    numbered, so that a gap never leaves a parameter undefined.
+    """
+    indices = var_indices(function)
+    return max(indices) + 1 if indices else 0
+
+def check_vars(function):
+    """
+    Return a message if the parameters of function are not numbered from
+    var0 without gaps.
+    """
+    missing = sorted(set(range(find_nvars(function))) -
+                     var_indices(function))
+    if missing:
+        return ("The parameters must be numbered var0, var1, ... without "
+                "gaps, but var%d is missing." % missing[0])
+    return ''
+
+def model_symbols(nvars):
+    """
+    Return the symbol x and a tuple of the symbols var0 ... var<nvars - 1>.
+    """
+    symbols = s.symbols("x,var:%d" % nvars)
+    return symbols[0], tuple(symbols[1:])
 
 def get_symbolic_function(function, nvars):
-    if nvars == 2:
-        x, var0, var1 = s.symbols("x,var:2")
-    elif nvars == 3:
-        x, var0, var1, var2 = s.symbols("x,var:3")
-    elif nvars == 4:
-        x, var0, var1, var2, var3 = s.symbols("x,var:4")
-    else:
-        return "Sorry, only four independent variables are supported at the moment"
-    return s.sympify(function)
-    
+    if nvars < 1 or nvars > MAX_NVARS:
+        return "Sorry, at most %d independent variables are supported" % (
+            MAX_NVARS)
+    x, params = model_symbols(nvars)
+    names = dict((str(sym), sym) for sym in (x,) + params)
+    symfunc = s.sympify(function, locals=names)
+    # Any other name would end up as a local of the generated kernels.
+    unknown = symfunc.free_symbols - set((x,) + params)
+    if unknown:
+        raise ValueError("Unknown names in the model: %s" %
+                         ", ".join(sorted(str(sym) for sym in unknown)))
+    return symfunc
+
 def eq(symfunc, nvars):
-    if nvars == 2:
-        x, var0, var1 = s.symbols("x,var:2")
-        return s.lambdify((x, var0, var1), symfunc, "numpy")
-    elif nvars == 3:
-        x, var0, var1, var2 = s.symbols("x,var:3")
-        return s.lambdify((x, var0, var1, var2), symfunc, "numpy")
-    elif nvars == 4:
-        x, var0, var1, var2, var3 = s.symbols("x,var:4")
-        return s.lambdify((x, var0, var1, var2, var3), symfunc, "numpy")
-    else:
-        return "Error"
+    """
+    Lambdify symfunc as f(x, var), with var a vector of the parameters.
+    """
+    x, params = model_symbols(nvars)
+    return s.lambdify((x, params), symfunc, "numpy")
 
 def dvardx(symfunc, nvars):
-    if nvars == 2:
-        x, var0, var1 = s.symbols("x,var:2")
-        dv0 = s.diff(symfunc, var0)
-        dv1 = s.diff(symfunc, var1)
-        return [s.lambdify((x, var0, var1), 
-                           func, "numpy") for func in [dv0, dv1]]
-    elif nvars == 3:
-        x, var0, var1, var2 = s.symbols("x,var:3")
-        dv0 = s.diff(symfunc, var0)
-        dv1 = s.diff(symfunc, var1)
-        dv2 = s.diff(symfunc, var2)
-        return [s.lambdify((x, var0, var1, var2), 
-                           func, "numpy") for func in [dv0, dv1, dv2]]
-    elif nvars == 4:
-        x, var0, var1, var2, var3 = s.symbols("x,var:4")
-        dv0 = s.diff(symfunc, var0)
-        dv1 = s.diff(symfunc, var1)
-        dv2 = s.diff(symfunc, var2)
-        dv3 = s.diff(symfunc, var3)
-        return [s.lambdify((x, var0, var1, var2, var3), 
-                           func, "numpy") for func in [dv0, dv1, dv2, dv3]]
-    else:
-        return "Error"
+    """
+    Lambdify the partial derivative of symfunc with respect to each
+    parameter as df(x, var).
+    """
+    x, params = model_symbols(nvars)
+    return [s.lambdify((x, params), s.diff(symfunc, var), "numpy")
+            for var in params]
+
+def kernel_expressions(symfunc, nvars):
+    """
+    Return x, the parameters, the common subexpressions of symfunc and its
+    partial derivatives, those expressions in terms of the common
+    subexpressions, and the derivatives of the residual that are constant,
+    by parameter index.
+    """
+    x, params = model_symbols(nvars)
+    exprs = [symfunc] + [s.diff(symfunc, var) for var in params]
+    replacements, reduced = s.cse(exprs, symbols=s.numbered_symbols("cse"))
+    constants = dict((i, -float(expr)) for i, expr in enumerate(reduced[1:])
+                     if expr.is_number)
+    return x, params, replacements, reduced, constants
+
+def fused_kernel(symfunc, nvars):
+    """
+    Generate a single numpy function that evaluates the residual and the
+    Jacobian of symfunc in one pass, sharing common subexpressions between
+    the model and all of its partial derivatives.
+
+    The kernel is called as kernel(x, y, f, jt, var) and fills f with
+    y - model and row i of jt with the derivative of the residual with
+    respect to var[i]. Rows whose derivative is a constant are left alone
+    and listed in the kernel's constant_columns, to be filled once by the
+    caller. Returns None if the model uses a function that cannot be
+    printed as numpy code.
+    """
+    x, params, replacements, reduced, constants = kernel_expressions(symfunc,
+                                                                     nvars)
+    printer = NumPyPrinter()
+    lines = ["def kernel(x, y, f, jt, var):"]
+    for i, var in enumerate(params):
+        lines.append("    %s = var[%d]" % (var, i))
+    for sym, expr in replacements:
+        lines.append("    %s = %s" % (sym, printer.doprint(expr)))
+    lines.append("    f[:] = y - (%s)" % printer.doprint(reduced[0]))
+    for i, expr in enumerate(reduced[1:]):
+        if i not in constants:
+            lines.append("    jt[%d] = -(%s)" % (i, printer.doprint(expr)))
+    lines.append("    return f, jt")
+    source = "\n".join(lines)
+    if "Not supported" in source:
+        return None
+    namespace = {'numpy': np}
+    exec(source, namespace)
+    kernel = namespace['kernel']
+    kernel.constant_columns = constants
+    return kernel
+
+def native_kernel(symfunc, nvars, kernel, residual, cache_dir=None):
+    """
+    Return a NativeKernel running symfunc as C loops, built by the local C
+    compiler and cached on disk under a hash of the expression, so that
+    other processes and later runs load the library without compiling it
+    or generating its source again. kernel and residual are the numpy
+    versions, used for calls the C code cannot take. Returns None if the
+    model cannot be compiled.
+    """
+    def generate():
+        x, params, replacements, reduced, constants = kernel_expressions(
+            symfunc, nvars)
+        return (c_source(symfunc, x, params, replacements, reduced),
+                constants)
+    loaded = load_library((s.srepr(symfunc), nvars), generate, cache_dir)
+    if loaded is None:
+        return None
+    lib, constants = loaded
+    return NativeKernel(lib, constants, kernel, residual)
+
+def unfused_kernel(eqn, funcarray):
+    """
+    Wrap separately lambdified model and derivatives in the fused kernel
+    calling convention.
+    """
+    def kernel(x, y, f, jt, var):
+        f[:] = y - eqn(x, var)
+        for i, df in enumerate(funcarray):
+            jt[i] = -df(x, var)
+        return f, jt
+    return kernel
+
+
+class LRUCache(object):
+    """
+    A small thread-safe mapping that evicts the least recently used entry
+    once maxsize is reached, counting hits, misses and evictions.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+        }
+
+
+class Model(object):
+    """
+    Base for fittable models. Jacobian rows listed in constant_columns are
+    never written by the kernel, so buffers must come from jacobian_buffer.
+    """
+    constant_columns = {}
 
+    def jacobian_buffer(self, *shape):
+        """
+        Return an uninitialised (nvars,) + shape buffer for the transposed
+        Jacobian with the constant rows already filled in.
+        """
+        jt = np.empty((self.nvars,) + shape)
+        for i, value in self.constant_columns.items():
+            jt[i] = value
+        return jt
+
+    def residual(self, x, y, f, var):
+        """
+        Fill f with y minus the model at x and return it.
+        """
+        return np.subtract(y, self.eqn(x, var), f)
+
+
+class CompiledModel(Model):
+    """
+    The sympy expression for a model together with the numpy callables
+    needed to fit it: the model itself, one partial derivative for each
+    parameter and a fused kernel returning the residual and Jacobian. With
+    the 'c' compile tier the kernel and residual are C loops instead,
+    whenever the model can be compiled.
+    """
+    def __init__(self, symfunc, nvars, tier=None):
+        self.symfunc = symfunc
+        self.nvars = nvars
+        self.eqn = eq(symfunc, nvars)
+        self.funcarray = dvardx(symfunc, nvars)
+        self.kernel = fused_kernel(symfunc, nvars)
+        if self.kernel is None:
+            self.kernel = unfused_kernel(self.eqn, self.funcarray)
+        self.constant_columns = getattr(self.kernel, 'constant_columns', {})
+        self.native = None
+        if (tier or COMPILE_TIER) == 'c':
+            self.native = native_kernel(symfunc, nvars, self.kernel,
+                                        super(CompiledModel, self).residual)
+        if self.native is not None:
+            self.kernel = self.native.kernel
+            self.residual = self.native.residual
+            self.constant_columns = self.native.constant_columns
+
+
+MODEL_CACHE_SIZE = getattr(settings, 'CURVEFIT_MODEL_CACHE_SIZE', 128)
+
+# Compiled models keyed on (srepr of the sympified model, nvars), and the
+# raw model text keyed on the canonical key so repeat requests skip sympify.
+model_cache = LRUCache(MODEL_CACHE_SIZE)
+model_aliases = LRUCache(MODEL_CACHE_SIZE * 4)
+
+
+def normalize_model(function):
+    return "".join(function.split()).replace("^", "**")
+
+def compile_model(function, nvars):
+    """
+    Return the CompiledModel for function, sympifying and lambdifying it
+    only if no equivalent model has been compiled by this process before.
+    """
+    if nvars < 1 or nvars > MAX_NVARS:
+        raise ValueError("Unsupported number of parameters: %d" % nvars)
+    alias = (normalize_model(function), nvars)
+    key = model_aliases.get(alias)
+    if key is not None:
+        compiled = model_cache.get(key)
+        if compiled is not None:
+            return compiled
+    symfunc = get_symbolic_function(function, nvars)
+    if key is None:
+        # Only look the model up once, so each call counts one hit or miss.
+        key = (s.srepr(symfunc), nvars)
+        model_aliases.put(alias, key)
+        compiled = model_cache.get(key)
+        if compiled is not None:
+            return compiled
+    compiled = CompiledModel(symfunc, nvars)
+    model_cache.put(key, compiled)
+    return compiled
 
 
 # Equations for the models
@@ -80,22 +316,25 @@ def modsin_eq(x, var0, var1, var2):
 
 # Equations for the partial derivatives of the models
 def boltzmann_pd(x, var0, var1, var2, var3):
-    d1 = 1 - (1 / (1 + np.exp((var2 - x) / var3)))
-    d2 = 1 / (1 + np.exp((var2 - x) / var3))
-    d3 = (((var0 - var1) * np.exp((var2 + x) / var3)) 
-            / (var3 * (np.exp(var2/var3) + np.exp(x / var3)) ** 2))
-    d4 = (((var1 - var0) * (var2 - x) * np.exp((var2 - x) / var3)) / 
-            (var3 ** 2 * (np.exp((var2 - x) / var3) + 1) ** 2))
+    # Written with both logistic functions, p and q = 1 - p, so that no
+    # term overflows to inf / inf far out on either side of the midpoint.
+    z = (var2 - x) / var3
+    p = 1 / (1 + np.exp(z))
+    q = 1 / (1 + np.exp(-z))
+    d1 = q
+    d2 = p
+    d3 = -(var1 - var0) * p * q / var3
+    d4 = (var1 - var0) * z * p * q / var3
     return [d1, d2, d3, d4]
 
 def expdecay_pd(x, var0, var1, var2):
-    d1 = x ** 0.0
+    d1 = 1.0
     d2 = np.exp(-var2 * x)
     d3 = -x * var1 * np.exp(-var2 * x)
     return [d1, d2, d3]
 
 def gaussian_pd(x, var0, var1, var2, var3):
-    d1 = x ** 0.0
+    d1 = 1.0
     d2 = np.exp(-(x - var2) ** 2 / var3 ** 2)
     d3 = 2 * ((x - var2) / (var3 ** 2)) * var1 * np.exp(
         -(x - var2) ** 2 / var3 ** 2)
@@ -131,3 +370,128 @@ def modsin_pd(x, var0, var1, var2):
           (x - var1) / var2)) / var2**2)
     return [d1, d2, d3]
 
+
+class BuiltinModel(Model):
+    """
+    A built-in model, fitted with its hand-written numpy equation and
+    partial derivatives so that sympy is never involved. Derivatives that
+    are constant are returned as scalars and given, negated as Jacobian
+    rows, in constant_columns.
+    """
+    def __init__(self, name, label, expression, nvars, eqn, pd,
+                 constant_columns=None):
+        self.name = name
+        self.label = label
+        self.expression = expression
+        self.nvars = nvars
+        self.equation = eqn
+        self.partials = pd
+        self.constant_columns = constant_columns or {}
+        self.funcarray = [self._derivative(i) for i in range(nvars)]
+        self._symfunc = None
+
+    @property
+    def symfunc(self):
+        if self._symfunc is None:
+            self._symfunc = get_symbolic_function(self.expression, self.nvars)
+        return self._symfunc
+
+    def _derivative(self, i):
+        return lambda x, var: self.pd(x, var)[i]
+
+    def eqn(self, x, var):
+        return self.equation(x, *var)
+
+    def pd(self, x, var):
+        return self.partials(x, *var)
+
+    def kernel(self, x, y, f, jt, var):
+        f[:] = y - self.equation(x, *var)
+        for i, d in enumerate(self.partials(x, *var)):
+            if i not in self.constant_columns:
+                jt[i] = -d
+        return f, jt
+
+    def matches(self, function):
+        return normalize_model(function) == normalize_model(self.expression)
+
+
+BUILTIN_MODELS = OrderedDict((m.name, m) for m in [
+    BuiltinModel('boltzmann', 'Boltzmann sigmoid',
+                 'var0 + ((var1 - var0)/(1 + exp((var2 - x)/var3)))',
+                 4, boltzmann_eq, boltzmann_pd),
+    BuiltinModel('expdecay', 'Exponential Decay',
+                 'var0 + var1 * exp(-var2 * x)',
+                 3, expdecay_eq, expdecay_pd, {0: -1.0}),
+    BuiltinModel('gaussian', 'Gaussian function',
+                 'var0 + var1 * exp(-(x - var2)^2 / var3^2)',
+                 4, gaussian_eq, gaussian_pd, {0: -1.0}),
+    BuiltinModel('hill', 'Hill plot',
+                 'var0 / (1 + (var1 / x)^var2)',
+                 3, hill_eq, hill_pd),
+    BuiltinModel('ic50', 'Dose Response (ic50)',
+                 '1 - (var0 / (1 + (var1 / x)^var2))',
+                 3, ic50_eq, ic50_pd),
+    BuiltinModel('mm', 'Michaelis-Menten',
+                 '(var0 * x) / (var1 + x)',
+                 2, mm_eq, mm_pd),
+    BuiltinModel('modsin', 'Modified sine wave',
+                 'var0 * sin(pi * (x - var1) / var2)',
+                 3, modsin_eq, modsin_pd),
+])
+
+def find_builtin(function, name=None):
+    """
+    Return the built-in model whose expression is function, or None. If
+    name is given only that built-in model is considered.
+    """
+    if name:
+        candidates = [BUILTIN_MODELS[name]] if name in BUILTIN_MODELS else []
+    else:
+        candidates = BUILTIN_MODELS.values()
+    for builtin in candidates:
+        if builtin.matches(function):
+            return builtin
+    return None
+
+def get_model(function, nvars, name=None):
+    """
+    Return the hand-written kernels for a built-in model, or the compiled
+    sympy model for anything else.
+    """
+    builtin = find_builtin(function, name)
+    if builtin is not None and builtin.nvars == nvars:
+        return builtin
+    return compile_model(function, nvars)
+
+def model_key(function, nvars, name=None):
+    """
+    Return a string identifying the model function as written, ignoring
+    spaces and the spelling of powers. Nothing is parsed, so this is cheap
+    enough for the web process; only the workers run sympy.
+    """
+    builtin = find_builtin(function, name)
+    if builtin is not None and builtin.nvars == nvars:
+        return "builtin:%s" % builtin.name
+    return "%s:%d" % (normalize_model(function), nvars)
+
+def check_builtin(builtin, x, var, rtol=1e-6, atol=1e-9):
+    """
+    Compare a built-in model's hand-written equation and derivatives with
+    those sympy derives from its expression. Returns True if they agree
+    wherever sympy's are finite, and the hand-written derivatives are finite
+    wherever the model is.
+    """
+    compiled = compile_model(builtin.expression, builtin.nvars)
+    y = builtin.eqn(x, var)
+    if not np.allclose(y, compiled.eqn(x, var), rtol=rtol, atol=atol):
+        return False
+    for d, df in zip(builtin.pd(x, var), compiled.funcarray):
+        d = d * x ** 0.0
+        expected = df(x, var) * x ** 0.0
+        if not np.isfinite(d[np.isfinite(y)]).all():
+            return False
+        ok = np.isfinite(expected)
+        if not np.allclose(d[ok], expected[ok], rtol=rtol, atol=atol):
+            return False
+    return True
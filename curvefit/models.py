@@ -1,3 +1,58 @@
+import json
+
 from django.db import models
 
-# Create your models here.
+
+class FitJob(models.Model):
+    """
+    A fit submitted to the job queue, and its results once it has run.
+    """
+    STATUS_CHOICES = (
+        ('pending', 'Pending'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    )
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES,
+                              default='pending')
+    model = models.CharField(max_length=500)
+    filename = models.CharField(max_length=255)
+    iterations = models.IntegerField(null=True, blank=True)
+    params = models.TextField(blank=True)
+    plotfile = models.CharField(max_length=100, blank=True)
+    plot = models.TextField(blank=True)
+    result = models.TextField(blank=True)
+    msg = models.CharField(max_length=255, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    def __unicode__(self):
+        return u"%s (%s)" % (self.model, self.status)
+
+    def get_params(self):
+        if not self.params:
+            return []
+        return json.loads(self.params)
+
+    def get_result(self):
+        """
+        Return the results of the fit as from fit_summary, with its plot.
+        """
+        result = json.loads(self.result) if self.result else {}
+        result.update({
+            'k': self.iterations,
+            'var': self.get_params(),
+            'plotfile': self.plotfile,
+            'plot': json.loads(self.plot) if self.plot else None,
+        })
+        return result
+
+    def as_dict(self):
+        data = self.get_result()
+        data.update({
+            'id': self.pk,
+            'status': self.status,
+            'model': self.model,
+            'filename': self.filename,
+            'msg': self.msg,
+        })
+        return data
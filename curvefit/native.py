@@ -0,0 +1,248 @@
+import ctypes
+import hashlib
+import json
+import os
+import stat
+import subprocess
+import tempfile
+import threading
+
+import numpy as np
+import sympy as s
+from django.conf import settings
+from sympy.printing.ccode import C99CodePrinter
+
+from curvefit.metrics import logger
+
+# 'c' compiles each model to a C loop kernel with the local compiler, or
+# 'numpy' keeps the generated numpy kernels.
+COMPILE_TIER = getattr(settings, 'CURVEFIT_COMPILE_TIER', 'numpy')
+# Libraries are only loaded from a directory private to this user, since
+# loading one runs its code.
+KERNEL_CACHE_DIR = (getattr(settings, 'CURVEFIT_KERNEL_CACHE_DIR', None) or
+                    os.path.join(tempfile.gettempdir(),
+                                 'curvefit-kernels-%d' % os.getuid()))
+CC = os.environ.get('CC', 'cc')
+CFLAGS = ['-O3', '-shared', '-fPIC']
+
+# Bump whenever the generated code changes, so stale libraries are not
+# picked up from the cache.
+VERSION = 1
+
+HEADER = """#include <math.h>
+#ifndef M_PI
+#define M_PI 3.14159265358979323846
+#endif
+#ifndef M_E
+#define M_E 2.71828182845904523536
+#endif
+"""
+
+_libraries = {}
+_lock = threading.Lock()
+
+
+def loop_body(printer, x, replacements, assignments):
+    """
+    Return the C statements before and inside the loop over the points:
+    common subexpressions not depending on x are worked out once, before
+    the loop, and assignments are (target, expression) pairs.
+    """
+    before, inside = [], []
+    varying = set([x])
+    for sym, expr in replacements:
+        line = "const double %s = %s;" % (sym, printer.doprint(expr))
+        if expr.free_symbols & varying:
+            varying.add(sym)
+            inside.append(line)
+        else:
+            before.append(line)
+    for target, expr in assignments:
+        inside.append("%s = %s;" % (target, printer.doprint(expr)))
+    return before, inside
+
+def c_function(name, args, params, before, inside):
+    lines = ["void %s(%s)" % (name, args), "{"]
+    lines += ["    const double %s = var[%d];" % (p, i)
+              for i, p in enumerate(params)]
+    lines += ["    " + line for line in before]
+    lines += ["    long k;", "    for (k = 0; k < n; k++) {",
+              "        const double x = xs[k * sx];"]
+    lines += ["        " + line for line in inside]
+    lines += ["    }", "}", ""]
+    return "\n".join(lines)
+
+def c_source(symfunc, x, params, replacements, reduced):
+    """
+    Return C source for kernel(), which fills the residual and the rows of
+    the transposed Jacobian whose derivative is not constant, and
+    residual(), which fills the residual alone, each in a single loop over
+    the points. Every array is passed with its stride in elements.
+    """
+    printer = C99CodePrinter()
+    assignments = [("f[k * sf]", s.Symbol("y") - reduced[0])]
+    for i, expr in enumerate(reduced[1:]):
+        if not expr.is_number:
+            assignments.append(("jt[%d * sj + k * sk]" % i, -expr))
+    before, inside = loop_body(printer, x, replacements, assignments)
+    kernel = c_function(
+        "kernel", "long n, const double *xs, long sx, const double *ys, "
+        "long sy, double *f, long sf, double *jt, long sj, long sk, "
+        "const double *var", params, before,
+        ["const double y = ys[k * sy];"] + inside)
+    model_replacements, model = s.cse([symfunc],
+                                      symbols=s.numbered_symbols("cse"))
+    before, inside = loop_body(printer, x, model_replacements,
+                               [("f[k * sf]", s.Symbol("y") - model[0])])
+    residual = c_function(
+        "residual", "long n, const double *xs, long sx, const double *ys, "
+        "long sy, double *f, long sf, const double *var", params, before,
+        ["const double y = ys[k * sy];"] + inside)
+    return HEADER + "\n" + kernel + "\n" + residual
+
+def cache_key(key):
+    """
+    Return the name of the cached library for a model identified by key,
+    which also covers the code generator and compiler.
+    """
+    h = hashlib.sha1(repr((key, VERSION, CC, CFLAGS)).encode('utf-8'))
+    return "kernel_" + h.hexdigest()
+
+def build(source, path):
+    """
+    Compile source to the shared library path. The library is built under
+    a temporary name and renamed into place, so other processes sharing
+    the cache never load a partly written file.
+    """
+    directory = os.path.dirname(path)
+    fd, src = tempfile.mkstemp(suffix='.c', dir=directory)
+    out = src[:-2] + '.so'
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(source)
+        proc = subprocess.Popen([CC] + CFLAGS + ['-o', out, src, '-lm'],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        proc.communicate()
+        if proc.returncode != 0:
+            return False
+        os.rename(out, path)
+        return True
+    finally:
+        for name in (src, out):
+            if os.path.exists(name):
+                os.remove(name)
+
+def trusted(path):
+    """
+    Return True if path is owned by this user, is not a symbolic link, and
+    cannot be written by anyone else, so another local user cannot have
+    planted or replaced it.
+    """
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return (st.st_uid == os.getuid() and not stat.S_ISLNK(st.st_mode) and
+            not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH))
+
+def load_library(key, generate, cache_dir=None):
+    """
+    Return the ctypes library and constant Jacobian rows for the model
+    identified by key, from the on-disk cache if a library for it has been
+    built before by any process, or else compiled from the (source,
+    constants) pair generate() returns. Returns None if there is no
+    compiler, the model cannot be written in C, or the cache directory or
+    library is not trusted.
+    """
+    cache_dir = cache_dir or KERNEL_CACHE_DIR
+    name = os.path.join(cache_dir, cache_key(key))
+    path = name + '.so'
+    with _lock:
+        if path in _libraries:
+            return _libraries[path]
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir, 0700)
+            except OSError:
+                if not os.path.isdir(cache_dir):
+                    return None
+        if not trusted(cache_dir):
+            logger.warning("Not loading compiled models from %s, which "
+                           "other users can write to.", cache_dir)
+            return None
+        if not os.path.exists(path):
+            source, constants = generate()
+            if "Not supported" in source:
+                return None
+            try:
+                fd, tmp = tempfile.mkstemp(suffix='.json', dir=cache_dir)
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(constants, f)
+                os.rename(tmp, name + '.json')
+                if not build(source, path):
+                    return None
+            except OSError:
+                return None
+        if not (trusted(path) and trusted(name + '.json')):
+            logger.warning("Not loading %s, which other users can write "
+                           "to.", path)
+            return None
+        with open(name + '.json') as f:
+            constants = dict((int(i), v) for i, v in json.load(f).items())
+        lib = ctypes.CDLL(path)
+        lib.kernel.restype = None
+        lib.kernel.argtypes = ([ctypes.c_long] + [ctypes.c_void_p,
+                               ctypes.c_long] * 4 +
+                               [ctypes.c_long, ctypes.c_void_p])
+        lib.residual.restype = None
+        lib.residual.argtypes = ([ctypes.c_long] + [ctypes.c_void_p,
+                                 ctypes.c_long] * 3 + [ctypes.c_void_p])
+        _libraries[path] = (lib, constants)
+        return _libraries[path]
+
+def strided(*arrays):
+    """
+    Return True if every array is a one-dimensional float64 array that the
+    C kernels can read through its stride.
+    """
+    for a in arrays:
+        if (not isinstance(a, np.ndarray) or a.ndim != 1 or
+                a.dtype != np.float64 or a.strides[0] % 8):
+            return False
+    return True
+
+
+class NativeKernel(object):
+    """
+    The C kernel and residual of a model, called like the numpy kernels.
+    Anything but plain vectors, such as the stacked parameters of a batch
+    fit, is passed on to the numpy versions.
+    """
+    def __init__(self, lib, constant_columns, kernel, residual):
+        self.lib = lib
+        self.constant_columns = constant_columns
+        self.numpy_kernel = kernel
+        self.numpy_residual = residual
+
+    def kernel(self, x, y, f, jt, var):
+        if not (strided(x, y, f) and jt.ndim == 2 and
+                jt.dtype == np.float64 and not jt.strides[0] % 8 and
+                not jt.strides[1] % 8 and np.ndim(var) == 1):
+            return self.numpy_kernel(x, y, f, jt, var)
+        var = np.ascontiguousarray(var, dtype=float)
+        self.lib.kernel(len(x), x.ctypes.data, x.strides[0] // 8,
+                        y.ctypes.data, y.strides[0] // 8,
+                        f.ctypes.data, f.strides[0] // 8,
+                        jt.ctypes.data, jt.strides[0] // 8,
+                        jt.strides[1] // 8, var.ctypes.data)
+        return f, jt
+
+    def residual(self, x, y, f, var):
+        if not (strided(x, y, f) and np.ndim(var) == 1):
+            return self.numpy_residual(x, y, f, var)
+        var = np.ascontiguousarray(var, dtype=float)
+        self.lib.residual(len(x), x.ctypes.data, x.strides[0] // 8,
+                          y.ctypes.data, y.strides[0] // 8,
+                          f.ctypes.data, f.strides[0] // 8, var.ctypes.data)
+        return f
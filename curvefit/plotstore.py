@@ -0,0 +1,163 @@
+import errno
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+
+from curvefit.metrics import logger, metrics
+
+# Plots are stored under this directory of MEDIA_ROOT, in subdirectories
+# named after the first two hex digits of their hash.
+PLOT_DIR = getattr(settings, 'CURVEFIT_PLOT_DIR', 'plots')
+
+# A sweep removes plots not used for PLOT_TTL seconds, then the least
+# recently used until the rest fit in PLOT_BUDGET bytes. None is no limit.
+PLOT_BUDGET = getattr(settings, 'CURVEFIT_PLOT_BUDGET', None)
+PLOT_TTL = getattr(settings, 'CURVEFIT_PLOT_TTL', None)
+
+# Seconds between sweeps by the background thread, or 0 for none.
+SWEEP_INTERVAL = getattr(settings, 'CURVEFIT_PLOT_SWEEP_INTERVAL', 0)
+
+# Plots saved straight into MEDIA_ROOT by earlier versions are named
+# plot_<key>.png, and are swept like the others.
+LEGACY_PREFIX = 'plot_'
+
+# Temporary files younger than this many seconds may still be being
+# written, so sweeps leave them alone.
+TEMP_AGE = 3600
+
+_sweeper = None
+_lock = threading.Lock()
+
+
+def plot_path(plotfile):
+    return os.path.join(settings.MEDIA_ROOT, plotfile)
+
+def plot_name(png):
+    """
+    Return the path, relative to MEDIA_ROOT, under which the PNG image png
+    is stored.
+    """
+    digest = hashlib.sha1(png).hexdigest()
+    return '/'.join([PLOT_DIR, digest[:2], digest + '.png'])
+
+def touch(path):
+    """
+    Mark the plot at path as just used. Returns False if it is not there.
+    """
+    try:
+        os.utime(path, None)
+        return True
+    except OSError:
+        return False
+
+def save_plot(png):
+    """
+    Store the PNG image png and return its path relative to MEDIA_ROOT.
+    Plots are named after a hash of their contents, so identical plots are
+    only stored once; saving one again marks it as just used. New plots are
+    written under a temporary name and renamed into place, so a partly
+    written plot is never served.
+    """
+    plotfile = plot_name(png)
+    path = plot_path(plotfile)
+    if touch(path):
+        return plotfile
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+    fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(png)
+        os.chmod(tmp, 0644)
+        os.rename(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return plotfile
+
+def stored_plots(root, now):
+    """
+    Return (last used, size, path) for every plot stored under root, and
+    every plot left in root itself by earlier versions, least recently used
+    first.
+    """
+    paths = []
+    for directory, dirs, files in os.walk(os.path.join(root, PLOT_DIR)):
+        paths.extend(os.path.join(directory, name) for name in files)
+    paths.extend(os.path.join(root, name) for name in os.listdir(root)
+                 if name.startswith(LEGACY_PREFIX) and name.endswith('.png'))
+    plots = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        if path.endswith('.tmp') and now - st.st_mtime < TEMP_AGE:
+            continue
+        plots.append((st.st_mtime, st.st_size, path))
+    plots.sort()
+    return plots
+
+def sweep(budget=PLOT_BUDGET, ttl=PLOT_TTL, now=None):
+    """
+    Remove plots not used for ttl seconds, then the least recently used
+    ones until the rest take up at most budget bytes. Either limit may be
+    None. Returns the number of plots removed and the bytes freed.
+    """
+    now = time.time() if now is None else now
+    plots = stored_plots(settings.MEDIA_ROOT, now)
+    total = sum(size for used, size, path in plots)
+    removed = freed = gone = 0
+    for used, size, path in plots:
+        expired = ttl is not None and now - used > ttl
+        over = budget is not None and total - freed - gone > budget
+        if not (expired or over):
+            break
+        try:
+            os.remove(path)
+        except OSError as e:
+            # A plot already removed by another sweep no longer counts
+            # against the budget.
+            if e.errno == errno.ENOENT:
+                gone += size
+            continue
+        removed += 1
+        freed += size
+    metrics.inc('plots_evicted', removed)
+    return removed, freed
+
+def sweep_forever(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            removed, freed = sweep()
+        except Exception:
+            logger.exception("Sweeping the plot store failed.")
+            continue
+        if removed:
+            logger.info("Removed %d plots (%d bytes) from the plot store.",
+                        removed, freed)
+
+def start_sweeper():
+    """
+    Start this process's background sweeper, if CURVEFIT_PLOT_SWEEP_INTERVAL
+    asks for one and it is not already running. This is called from the
+    URLconf, so only the web process sweeps, not the fit workers.
+    """
+    global _sweeper
+    with _lock:
+        if _sweeper is None and SWEEP_INTERVAL:
+            _sweeper = threading.Thread(target=sweep_forever,
+                                        args=(SWEEP_INTERVAL,),
+                                        name='curvefit-plot-sweeper')
+            _sweeper.daemon = True
+            _sweeper.start()
@@ -0,0 +1,104 @@
+import base64
+import threading
+from io import BytesIO
+
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+DPI = 80
+# Width in pixels of plots drawn in the browser, and the most data points
+# sent to the browser.
+CANVAS_WIDTH = 640
+MAX_POINTS = 2000
+# Curve samples per horizontal pixel of the plot area.
+SAMPLES_PER_PIXEL = 2
+
+_local = threading.local()
+
+
+def get_template():
+    """
+    Return this thread's figure, canvas and axes. They are created once per
+    thread and reused for every plot, so no figure state is shared between
+    threads and no pyplot state is involved at all.
+    """
+    template = getattr(_local, 'template', None)
+    if template is None:
+        fig = Figure()
+        canvas = FigureCanvasAgg(fig)
+        ax = fig.add_subplot(111)
+        fig.subplots_adjust(bottom=0.15)
+        template = _local.template = (fig, canvas, ax)
+    return template
+
+def curve_samples(fig, ax, dpi=DPI):
+    """
+    Number of points needed for a smooth curve across the axes at dpi.
+    """
+    width = fig.get_figwidth() * dpi * ax.get_position().width
+    return int(width * SAMPLES_PER_PIXEL)
+
+def curve_x(x, n, logscale=False):
+    """
+    n points spanning the x data, evenly spaced on the plot's x axis.
+    """
+    xmin, xmax = np.min(x), np.max(x)
+    if logscale and xmin > 0:
+        return np.logspace(np.log10(xmin), np.log10(xmax), n)
+    return np.linspace(xmin, xmax, n)
+
+def render_png(x, y, eqn, logscale=False, xlab='', ylab='', dpi=DPI,
+               band=None):
+    """
+    Plot the data and the fitted curve eqn(x) and return the PNG bytes. If
+    band(x) gives the half width of a confidence band it is shaded in.
+    """
+    fig, canvas, ax = get_template()
+    ax.cla()
+    xs = curve_x(x, curve_samples(fig, ax, dpi), logscale)
+    ys = np.empty_like(xs)
+    ys[:] = eqn(xs)
+    hw = band(xs) if band is not None else None
+    if hw is not None:
+        ax.fill_between(xs, ys - hw, ys + hw, color='0.85', lw=0)
+    ax.plot(xs, ys, 'k', x, y, 'o', lw=2, ms=12, mec='k', mew=1, mfc='None')
+    ax.tick_params(labelsize=18)
+    if logscale:
+        ax.set_xscale('log')
+    ax.set_ylim((min(y) - max(y) * 0.2), (max(y) + max(y) * 0.2))
+    ax.set_xlabel(xlab, fontsize=24)
+    ax.set_ylabel(ylab, fontsize=24)
+    buf = BytesIO()
+    canvas.print_png(buf, dpi=dpi)
+    return buf.getvalue()
+
+def plot_data(x, y, eqn, logscale=False, width=CANVAS_WIDTH,
+              max_points=MAX_POINTS, band=None):
+    """
+    Return the data points, thinned to at most max_points, and the fitted
+    curve sampled for a plot width pixels wide, as lists for JSON. If
+    band(x) gives the half width of a confidence band it is returned at the
+    curve points as 'band'.
+    """
+    x, y = np.asarray(x), np.asarray(y)
+    if len(x) > max_points:
+        keep = np.linspace(0, len(x) - 1, max_points).astype(int)
+        x, y = x[keep], y[keep]
+    xs = curve_x(x, width * SAMPLES_PER_PIXEL, logscale)
+    ys = np.empty_like(xs)
+    ys[:] = eqn(xs)
+    data = {
+        'x': x.tolist(),
+        'y': y.tolist(),
+        'curve_x': xs.tolist(),
+        'curve_y': ys.tolist(),
+        'logscale': bool(logscale),
+    }
+    hw = band(xs) if band is not None else None
+    if hw is not None:
+        data['band'] = hw.tolist()
+    return data
+
+def data_uri(png):
+    return "data:image/png;base64," + base64.b64encode(png)
@@ -0,0 +1,110 @@
+import hashlib
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import get_cache
+
+from curvefit.executor import execute, execute_many
+from curvefit.metrics import metrics
+from curvefit.model_functions import model_key
+from curvefit.plotstore import plot_path, save_plot
+
+_cache = None
+
+
+def get_result_cache():
+    global _cache
+    if _cache is None and settings.CURVEFIT_RESULT_CACHE:
+        _cache = get_cache(settings.CURVEFIT_RESULT_CACHE)
+    return _cache
+
+def result_key(kwargs):
+    """
+    Hash everything that determines the outcome of a fit: the data and its
+    standard deviations, the model, the initial guess and whether it is to
+    be improved on or searched around, the solver and its options, the loss
+    and the plot options.
+    """
+    model = model_key(kwargs['model'], len(kwargs['var']),
+                      kwargs.get('builtin'))
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(kwargs['x'], dtype=float).tostring())
+    h.update(np.ascontiguousarray(kwargs['y'], dtype=float).tostring())
+    h.update(np.array(kwargs['var'], dtype=float).tostring())
+    if kwargs.get('sigma') is not None:
+        h.update(np.ascontiguousarray(kwargs['sigma'],
+                                      dtype=float).tostring())
+    h.update(repr((model,
+                   bool(kwargs.get('logscale')),
+                   kwargs.get('xlabel', ''),
+                   kwargs.get('ylabel', ''),
+                   bool(kwargs.get('inline_plot')),
+                   bool(kwargs.get('vector_plot')),
+                   bool(kwargs.get('store_plot')),
+                   kwargs.get('solver') or 'lm',
+                   sorted((kwargs.get('solver_options') or {}).items()),
+                   bool(kwargs.get('auto_guess')),
+                   bool(kwargs.get('multistart')),
+                   kwargs.get('loss') or 'linear',
+                   kwargs.get('loss_scale')
+                   )).encode('utf-8'))
+    return "curvefit:" + h.hexdigest()
+
+def lookup(kwargs):
+    """
+    Return the cached result for kwargs and its key. The cached plot is
+    saved to the plot store again, which marks it as used, or puts it back
+    if it has been swept away.
+    """
+    cache = get_result_cache()
+    key = result_key(kwargs) if cache is not None else None
+    if key is None:
+        return None, None
+    result = cache.get(key)
+    if result is None:
+        metrics.inc('result_cache_misses')
+        return None, key
+    metrics.inc('result_cache_hits')
+    result = dict(result)
+    png = result.pop('png', None)
+    if png is not None:
+        result['plotfile'] = save_plot(png)
+    return result, key
+
+def store(key, result):
+    cache = get_result_cache()
+    if key is None or cache is None or 'msg' in result:
+        return
+    entry = dict(result)
+    if result.get('plotfile'):
+        with open(plot_path(result['plotfile']), "rb") as f:
+            entry['png'] = f.read()
+    cache.set(key, entry)
+
+def cached_execute(kwargs):
+    """
+    Run a fit through execute(), unless an identical fit has been run
+    recently, in which case its stored result is returned.
+    """
+    result, key = lookup(kwargs)
+    if result is not None:
+        return result
+    result = execute(kwargs)
+    metrics.record_fit(result)
+    store(key, result)
+    return result
+
+def cached_execute_many(kwargs_list):
+    """
+    Like cached_execute for several fits. Those not in the cache are run
+    together through execute_many().
+    """
+    found = [lookup(kwargs) for kwargs in kwargs_list]
+    todo = [i for i, (result, key) in enumerate(found) if result is None]
+    results = execute_many([kwargs_list[i] for i in todo])
+    for i, result in zip(todo, results):
+        key = found[i][1]
+        metrics.record_fit(result)
+        store(key, result)
+        found[i] = (result, key)
+    return [result for result, key in found]
@@ -0,0 +1,360 @@
+from collections import OrderedDict
+
+import numpy as np
+from django.conf import settings
+
+MAX_ITER = getattr(settings, 'CURVEFIT_MAX_ITER', 200)
+GTOL = getattr(settings, 'CURVEFIT_GTOL', 1.0e-15)
+XTOL = getattr(settings, 'CURVEFIT_XTOL', 1.0e-20)
+CHUNK_SIZE = getattr(settings, 'CURVEFIT_CHUNK_SIZE', 65536)
+
+
+class Solver(object):
+    """
+    Base for the least squares solvers. A solver minimises the objective of
+    a CurveFit through its normal_equations(var, a, g), which fills in
+    J^T W J and J^T W f, and sum_of_squares(var), so it never sees the
+    residual, Jacobian or weights themselves. Parameters are kept between
+    lower and upper.
+
+    A parameter at a bound that the gradient pushes further out is held
+    there: steps are taken in the subspace of the other, free, parameters,
+    and iteration stops once the largest free gradient component falls
+    below gtol, a step changes the parameters by less than xtol or
+    max_iter iterations have been made.
+    """
+    name = None
+    label = None
+
+    def __init__(self, max_iter=None, gtol=None, xtol=None, lower=None,
+                 upper=None):
+        self.max_iter = MAX_ITER if max_iter is None else max_iter
+        self.gtol = GTOL if gtol is None else gtol
+        self.xtol = XTOL if xtol is None else xtol
+        self.lower = lower
+        self.upper = upper
+
+    def bounds(self, N):
+        """
+        Return the lower and upper bounds as arrays of length N, padding
+        missing entries with -inf and inf.
+        """
+        lower = np.empty(N)
+        lower.fill(-np.inf)
+        upper = np.empty(N)
+        upper.fill(np.inf)
+        if self.lower is not None:
+            lower[:len(self.lower)] = self.lower[:N]
+        if self.upper is not None:
+            upper[:len(self.upper)] = self.upper[:N]
+        return lower, upper
+
+    def project(self, var, lower, upper):
+        """
+        Clip var into the bounds in place.
+        """
+        np.clip(var, lower, upper, var)
+
+    def free(self, var, g, lower, upper):
+        """
+        Return a mask of the parameters not held at a bound, where the
+        descent direction -g would take them out of the bounds.
+        """
+        return ~(((var <= lower) & (g > 0)) | ((var >= upper) & (g < 0)))
+
+    def converged(self, g, free):
+        """
+        Return True once every free component of the gradient g is below
+        gtol. A gradient that is not finite also stops the iteration.
+        """
+        return not (np.abs(g[free]) >= self.gtol).any()
+
+    def free_solve(self, A, b, free, out):
+        """
+        Solve A out = b for the free parameters, leaving out zero for the
+        others, and return out.
+        """
+        if free.all():
+            out[:] = np.linalg.solve(A, b)
+        else:
+            idx = np.flatnonzero(free)
+            out.fill(0)
+            out[idx] = np.linalg.solve(A[np.ix_(idx, idx)], b[idx])
+        return out
+
+    def solve(self, fit, var):
+        """
+        Minimise from the initial guess var. Returns the number of
+        iterations and the fitted parameters.
+        """
+        raise NotImplementedError
+
+
+class LevenbergMarquardt(Solver):
+    """
+    Levenberg-Marquardt with Nielsen's damping update. All work arrays are
+    allocated once up front and the damped normal equations are rebuilt in
+    place on every iteration. Steps are taken in the free parameters, and
+    clipped if they leave the bounds.
+    """
+    name = 'lm'
+    label = 'Levenberg-Marquardt'
+
+    def solve(self, fit, var):
+        N = len(var)
+        k = 0
+        v = 2
+        lower, upper = self.bounds(N)
+        self.project(var, lower, upper)
+        trial = np.empty(N)
+        a = np.empty((N, N))
+        A = np.empty((N, N))
+        g = np.empty(N)
+        h = np.empty(N)
+        diag = A.reshape(-1)[::N + 1]
+        F = fit.normal_equations(var, a, g)
+        free = self.free(var, g, lower, upper)
+        mu = 1.0e-3 * max(np.diag(a))
+        while not self.converged(g, free) and k < self.max_iter:
+            k += 1
+            np.copyto(A, a)
+            diag += mu
+            self.free_solve(A, g, free, h)
+            np.subtract(var, h, trial)
+            self.project(trial, lower, upper)
+            np.subtract(trial, var, h)
+            if np.linalg.norm(h) <= self.xtol:
+                var = trial
+                break
+            F_new = fit.sum_of_squares(trial)
+            dF = 0.5 * (F - F_new)
+            dL = 0.5 * (mu * np.dot(h, h) - np.dot(h, g))
+            d = dF/dL
+            if d > 0:
+                var, trial = trial, var
+                F = fit.normal_equations(var, a, g)
+                free = self.free(var, g, lower, upper)
+                mu *= max(1.0/3.0, (1 - (2 * d - 1) ** 3))
+                v = 2
+            else:
+                mu *= v
+                v *= 2
+        return (k, var)
+
+
+class GeodesicLevenbergMarquardt(Solver):
+    """
+    Levenberg-Marquardt with geodesic acceleration (Transtrum and Sethna).
+    Each step adds a second order correction, found from the directional
+    second derivative of the residual along the Levenberg-Marquardt step,
+    which lets the iteration follow curved valleys such as those of
+    sigmoidal models in far fewer steps. The correction is dropped when it
+    is larger than alpha times the step.
+    """
+    name = 'geodesic'
+    label = 'Levenberg-Marquardt with geodesic acceleration'
+
+    def __init__(self, alpha=0.75, fd_step=0.1, **kwargs):
+        super(GeodesicLevenbergMarquardt, self).__init__(**kwargs)
+        self.alpha = alpha
+        self.fd_step = fd_step
+
+    def solve(self, fit, var):
+        N = len(var)
+        k = 0
+        v = 2
+        lower, upper = self.bounds(N)
+        self.project(var, lower, upper)
+        trial = np.empty(N)
+        a = np.empty((N, N))
+        A = np.empty((N, N))
+        g = np.empty(N)
+        h = np.empty(N)
+        diag = A.reshape(-1)[::N + 1]
+        velocity = np.empty(N)
+        accel = np.empty(N)
+        F = fit.normal_equations(var, a, g)
+        free = self.free(var, g, lower, upper)
+        mu = 1.0e-3 * max(np.diag(a))
+        while not self.converged(g, free) and k < self.max_iter:
+            k += 1
+            np.copyto(A, a)
+            diag += mu
+            velocity = -self.free_solve(A, g, free, velocity)
+            accel = -self.free_solve(A, fit.curvature(var, velocity,
+                                                      self.fd_step),
+                                     free, accel)
+            if (np.linalg.norm(accel) <=
+                    self.alpha * np.linalg.norm(velocity)):
+                velocity += 0.5 * accel
+            np.add(var, velocity, trial)
+            self.project(trial, lower, upper)
+            np.subtract(trial, var, h)
+            if np.linalg.norm(h) <= self.xtol:
+                var = trial
+                break
+            F_new = fit.sum_of_squares(trial)
+            dF = 0.5 * (F - F_new)
+            dL = 0.5 * (mu * np.dot(h, h) - np.dot(h, g))
+            d = dF/dL
+            if dF > 0 and d > 0:
+                var, trial = trial, var
+                F = fit.normal_equations(var, a, g)
+                free = self.free(var, g, lower, upper)
+                mu *= max(1.0/3.0, (1 - (2 * min(d, 1.0) - 1) ** 3))
+                v = 2
+            else:
+                mu *= v
+                v *= 2
+        return (k, var)
+
+
+class Dogleg(Solver):
+    """
+    Powell's dogleg trust region method. Each step combines the steepest
+    descent and Gauss-Newton steps inside a trust region whose radius
+    grows or shrinks with how well the linear model predicted the
+    decrease. The region is measured in parameters scaled by the column
+    norms of the Jacobian, as in MINPACK. Steps are taken in the free
+    parameters, and clipped if they cross a bound, so that a parameter
+    whose optimum lies beyond its bound lands on it and is then held.
+    """
+    name = 'dogleg'
+    label = 'Dogleg trust region'
+
+    def __init__(self, radius=None, factor=100.0, **kwargs):
+        super(Dogleg, self).__init__(**kwargs)
+        self.radius = radius
+        self.factor = factor
+
+    def step(self, a, g, radius):
+        """
+        Return the dogleg step for the normal matrix a, gradient g and
+        trust region radius.
+        """
+        try:
+            hgn = -np.linalg.solve(a, g)
+        except np.linalg.LinAlgError:
+            hgn = -np.linalg.lstsq(a, g, rcond=-1)[0]
+        if np.linalg.norm(hgn) <= radius:
+            return hgn
+        gg = np.dot(g, g)
+        alpha = gg / np.dot(g, np.dot(a, g))
+        if alpha * np.sqrt(gg) >= radius:
+            return -(radius / np.sqrt(gg)) * g
+        hsd = -alpha * g
+        d = hgn - hsd
+        c = np.dot(hsd, d)
+        dd = np.dot(d, d)
+        r = radius ** 2 - np.dot(hsd, hsd)
+        beta = (-c + np.sqrt(c * c + dd * r)) / dd
+        return hsd + beta * d
+
+    def solve(self, fit, var):
+        N = len(var)
+        k = 0
+        eps = np.finfo(float).eps
+        lower, upper = self.bounds(N)
+        self.project(var, lower, upper)
+        trial = np.empty(N)
+        a = np.empty((N, N))
+        g = np.empty(N)
+        h = np.empty(N)
+        F = fit.normal_equations(var, a, g)
+        scale = np.sqrt(np.diag(a))
+        scale[scale == 0] = 1.0
+        radius = self.radius
+        if radius is None:
+            radius = self.factor * np.linalg.norm(scale * var) or self.factor
+        free = self.free(var, g, lower, upper)
+        while not self.converged(g, free) and k < self.max_iter:
+            k += 1
+            idx = np.flatnonzero(free)
+            hs = np.zeros(N)
+            hs[idx] = self.step((a / np.outer(scale, scale))[np.ix_(idx, idx)],
+                                (g / scale)[idx], radius)
+            np.add(var, hs / scale, trial)
+            self.project(trial, lower, upper)
+            np.subtract(trial, var, h)
+            if np.linalg.norm(h) <= self.xtol:
+                var = trial
+                break
+            dL = -(np.dot(g, h) + 0.5 * np.dot(h, np.dot(a, h)))
+            if 0 <= dL <= eps * F:
+                break
+            F_new = fit.sum_of_squares(trial)
+            dF = 0.5 * (F - F_new)
+            rho = dF / dL if dL > 0 else -1.0
+            if rho > 0:
+                var, trial = trial, var
+                F = fit.normal_equations(var, a, g)
+                free = self.free(var, g, lower, upper)
+                np.maximum(scale, np.sqrt(np.diag(a)), scale)
+            if rho > 0.75:
+                radius = max(radius, 3 * np.linalg.norm(scale * h))
+            elif rho < 0.25:
+                radius /= 2
+                if radius <= eps * np.linalg.norm(scale * var):
+                    break
+        return (k, var)
+
+
+def huber(z):
+    """
+    Return the Huber loss and its derivative at z, the squared scaled
+    residuals: quadratic up to one, linear beyond.
+    """
+    big = z > 1
+    root = np.sqrt(z[big])
+    rho = z.copy()
+    rho[big] = 2 * root - 1
+    drho = np.ones_like(z)
+    drho[big] = 1 / root
+    return rho, drho
+
+def soft_l1(z):
+    """
+    Return the soft L1 loss, a smooth Huber, and its derivative at z.
+    """
+    root = np.sqrt(1 + z)
+    return 2 * (root - 1), 1 / root
+
+def cauchy(z):
+    """
+    Return the Cauchy loss and its derivative at z.
+    """
+    return np.log1p(z), 1 / (1 + z)
+
+# Losses applied to the squared residuals, scaled by the loss scale, with
+# labels. Linear is ordinary least squares.
+LOSSES = OrderedDict([
+    ('linear', None),
+    ('huber', huber),
+    ('soft_l1', soft_l1),
+    ('cauchy', cauchy),
+])
+LOSS_LABELS = [
+    ('linear', 'Least squares'),
+    ('huber', 'Huber'),
+    ('soft_l1', 'Soft L1'),
+    ('cauchy', 'Cauchy'),
+]
+
+
+SOLVERS = OrderedDict((s.name, s) for s in [
+    LevenbergMarquardt,
+    Dogleg,
+    GeodesicLevenbergMarquardt,
+])
+
+
+def get_solver(name=None, **options):
+    """
+    Return an instance of the solver called name, Levenberg-Marquardt by
+    default, configured with options.
+    """
+    if not name:
+        name = LevenbergMarquardt.name
+    if name not in SOLVERS:
+        raise ValueError("Unknown solver %r." % name)
+    return SOLVERS[name](**options)
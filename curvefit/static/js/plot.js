@@ -0,0 +1,88 @@
+// Draw fit results returned by the server as {x, y, curve_x, curve_y,
+// logscale} on a canvas element, with the confidence band if there is one.
+function draw_plot(canvas, data) {
+  var ctx = canvas.getContext('2d');
+  var w = canvas.width, h = canvas.height;
+  var left = 70, right = 20, top = 20, bottom = 50;
+  var tx = data.logscale ? function(v) { return Math.log(v) / Math.LN10; }
+                         : function(v) { return v; };
+  var xmin = tx(Math.min.apply(null, data.curve_x));
+  var xmax = tx(Math.max.apply(null, data.curve_x));
+  var ymin = Math.min.apply(null, data.y);
+  var ymax = Math.max.apply(null, data.y);
+  var ylo = ymin - ymax * 0.2, yhi = ymax + ymax * 0.2;
+  if (xmax === xmin) { xmax = xmin + 1; }
+  if (yhi === ylo) { yhi = ylo + 1; }
+  var px = function(v) {
+    return left + (tx(v) - xmin) / (xmax - xmin) * (w - left - right);
+  };
+  var py = function(v) {
+    return h - bottom - (v - ylo) / (yhi - ylo) * (h - top - bottom);
+  };
+  var i;
+
+  ctx.clearRect(0, 0, w, h);
+  ctx.strokeStyle = '#000';
+  ctx.fillStyle = '#000';
+  ctx.lineWidth = 1;
+  ctx.strokeRect(left, top, w - left - right, h - top - bottom);
+
+  // Axis ticks: decades on a log axis, five steps otherwise.
+  ctx.font = '14px sans-serif';
+  ctx.textAlign = 'center';
+  for (i = 0; i <= 5; i++) {
+    var xv = xmin + (xmax - xmin) * i / 5;
+    if (data.logscale) {
+      xv = Math.round(xv);
+      if (xv < xmin || xv > xmax) { continue; }
+    }
+    var label = data.logscale ? '1e' + xv : xv.toPrecision(3);
+    var xp = px(data.logscale ? Math.pow(10, xv) : xv);
+    ctx.fillText(label, xp, h - bottom + 18);
+    ctx.beginPath();
+    ctx.moveTo(xp, h - bottom);
+    ctx.lineTo(xp, h - bottom - 5);
+    ctx.stroke();
+  }
+  ctx.textAlign = 'right';
+  for (i = 0; i <= 5; i++) {
+    var yv = ylo + (yhi - ylo) * i / 5;
+    ctx.fillText(yv.toPrecision(3), left - 6, py(yv) + 5);
+    ctx.beginPath();
+    ctx.moveTo(left, py(yv));
+    ctx.lineTo(left + 5, py(yv));
+    ctx.stroke();
+  }
+
+  ctx.save();
+  ctx.beginPath();
+  ctx.rect(left, top, w - left - right, h - top - bottom);
+  ctx.clip();
+  if (data.band) {
+    ctx.fillStyle = '#d9d9d9';
+    ctx.beginPath();
+    for (i = 0; i < data.curve_x.length; i++) {
+      var bx = px(data.curve_x[i]), by = py(data.curve_y[i] + data.band[i]);
+      if (i === 0) { ctx.moveTo(bx, by); } else { ctx.lineTo(bx, by); }
+    }
+    for (i = data.curve_x.length - 1; i >= 0; i--) {
+      ctx.lineTo(px(data.curve_x[i]), py(data.curve_y[i] - data.band[i]));
+    }
+    ctx.closePath();
+    ctx.fill();
+  }
+  ctx.lineWidth = 2;
+  ctx.beginPath();
+  for (i = 0; i < data.curve_x.length; i++) {
+    var cx = px(data.curve_x[i]), cy = py(data.curve_y[i]);
+    if (i === 0) { ctx.moveTo(cx, cy); } else { ctx.lineTo(cx, cy); }
+  }
+  ctx.stroke();
+  ctx.lineWidth = 1;
+  for (i = 0; i < data.x.length; i++) {
+    ctx.beginPath();
+    ctx.arc(px(data.x[i]), py(data.y[i]), 6, 0, 2 * Math.PI);
+    ctx.stroke();
+  }
+  ctx.restore();
+}
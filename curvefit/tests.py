@@ -1,12 +1,39 @@
 # Tests for curvefit app
 
+import datetime
+import json
+import logging
+import multiprocessing
 import os
+import shutil
+import tempfile
+import threading
+import time
 import xlrd, xlwt
+from distutils.spawn import find_executable
 
-from django.test import TestCase
+from StringIO import StringIO
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.test import TestCase, TransactionTestCase
+from django.test.client import Client
+from django.utils import unittest
 
 from settings import MEDIA_ROOT, PROJECT_PATH
 from curvefit.views import *
+from curvefit import executor, jobs
+from curvefit.executor import FitExecutor, run_fit
+from curvefit import benchmark, native, plotstore
+from curvefit.metrics import logger, metrics
+from curvefit.guess import guess_parameters
+from curvefit.solvers import LOSSES, SOLVERS, get_solver
+from curvefit.uncertainty import covariance, t_quantile
+from curvefit import resultcache
+from curvefit.resultcache import cached_execute, get_result_cache, result_key
+from curvefit.plotting import (curve_samples, get_template, plot_data,
+                               render_png)
 
 
 def write_file_data(filename, sep=None):
@@ -68,6 +95,42 @@ def file_setup():
     badtxt.close()
 
 
+def clear_media():
+    """
+    Remove everything the tests left in MEDIA_ROOT, stored plots included.
+    """
+    for name in os.listdir(MEDIA_ROOT):
+        path = os.path.join(MEDIA_ROOT, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+
+def write_xlsx_data(filename, nrows=15):
+    """
+    Write a workbook with a header row, an unused column between x and y
+    and a second sheet that should never be read.
+    """
+    wb = openpyxl.Workbook()
+    sheet = wb.active
+    sheet.append(['time', 'note', 'signal'])
+    for i in range(1, nrows + 1):
+        sheet.append([i, 'n/a', i * i])
+    wb.create_sheet('other').append(['junk', 1, 2])
+    wb.save(filename)
+
+def whole_jacobian(fit, var):
+    """
+    Return the residual and Jacobian of fit at var over all of its points,
+    from the model's separate equation and derivatives.
+    """
+    f = fit.y - fit.compiled.eqn(fit.x, var)
+    J = -np.column_stack([df(fit.x, var) * np.ones(len(fit.x))
+                          for df in fit.compiled.funcarray])
+    return f, J
+
+
 class FileHandlerTest(TestCase):
     """
     Test that the file_handler function works and returns expected values.
@@ -79,19 +142,81 @@ class FileHandlerTest(TestCase):
         filename = os.path.join(MEDIA_ROOT, "test.xls")
         # Write fake data to xls file.
         write_file_data(filename)
-        fit = CurveFit(filename, 'ic50', [1.0, 1.0, 1.0])
+        fit = CurveFit(filename, 'var0 * x ** 2 + var1 * x + var2',
+                       [1.0, 1.0, 1.0])
         fit.file_handler('.xls')
         self.assertEqual(list(map(int, fit.x)), range(15))
         self.assertEqual(list(map(int, fit.y)), [i * i for i in range(15)])
         self.assertEqual(fit.msg, '')
 
+    @unittest.skipIf(openpyxl is None, "openpyxl is not installed")
+    def test_read_xlsx_files(self):
+        """
+        xlsx files are streamed from the first sheet, skipping the header.
+        """
+        filename = os.path.join(MEDIA_ROOT, "test.xlsx")
+        write_xlsx_data(filename, nrows=3000)
+        data, msg = read_table(filename, '.xlsx', columns=['1', 'signal'])
+        os.remove(filename)
+        self.assertEqual(msg, '')
+        self.assertEqual(data.shape, (3000, 2))
+        self.assertEqual(data[-1].tolist(), [3000, 3000 * 3000])
+
+    def test_columns_by_number_and_heading(self):
+        filename = os.path.join(MEDIA_ROOT, "test.csv")
+        f = open(filename, "w")
+        f.write("a,b,c\n1,2,3\n4,5,6\n")
+        f.close()
+        data, msg = read_table(filename, '.csv', columns=['c', '1'])
+        self.assertEqual(data.tolist(), [[3, 1], [6, 4]])
+        data, msg = read_table(filename, '.csv', columns=['d', '1'])
+        os.remove(filename)
+        self.assertEqual(msg, "There is no column d in the input file.")
+
+    def test_read_npy_files(self):
+        """
+        npy files are memory-mapped; structured arrays have named columns.
+        """
+        filename = os.path.join(MEDIA_ROOT, "test.npy")
+        x = np.arange(15.0)
+        np.save(filename, np.column_stack([x, x * x]))
+        data, msg = read_table(filename, '.npy')
+        self.assertEqual(data.tolist(), np.column_stack([x, x * x]).tolist())
+        table = np.zeros(15, dtype=[('t', float), ('signal', float)])
+        table['t'], table['signal'] = x, x * x
+        np.save(filename, table)
+        data, msg = read_table(filename, '.npy', columns=['signal', 't'])
+        os.remove(filename)
+        self.assertEqual(data[:, 0].tolist(), (x * x).tolist())
+
+    def test_read_npz_files(self):
+        filename = os.path.join(MEDIA_ROOT, "test.npz")
+        x = np.arange(15.0)
+        np.savez(filename, x=x, y=x * x, z=-x)
+        data, msg = read_table(filename, '.npz', columns=['x', 'z'])
+        os.remove(filename)
+        self.assertEqual(data[:, 1].tolist(), (-x).tolist())
+
+    @unittest.skipIf(pq is None, "pyarrow is not installed")
+    def test_read_parquet_files(self):
+        import pyarrow
+        filename = os.path.join(MEDIA_ROOT, "test.parquet")
+        x = np.arange(15.0)
+        pq.write_table(pyarrow.Table.from_arrays(
+            [pyarrow.array(x), pyarrow.array(x * x)], names=['x', 'y']),
+            filename)
+        data, msg = read_table(filename, '.parquet')
+        os.remove(filename)
+        self.assertEqual(data.tolist(), np.column_stack([x, x * x]).tolist())
+
     def test_read_csv_files(self):
         """
         Test that csv files are read and data is correct.
         """
         filename = os.path.join(MEDIA_ROOT, "test.csv")
         write_file_data(filename, sep=",")
-        fit = CurveFit(filename, 'ic50', [1.0, 1.0, 1.0])
+        fit = CurveFit(filename, 'var0 * x ** 2 + var1 * x + var2',
+                       [1.0, 1.0, 1.0])
         fit.file_handler('.csv')
         self.assertEqual(list(map(int, fit.x)), range(15))
         self.assertEqual(list(map(int, fit.y)), [i * i for i in range(15)])
@@ -103,7 +228,8 @@ class FileHandlerTest(TestCase):
         """
         filename = os.path.join(MEDIA_ROOT, "test.txt")
         write_file_data(filename, sep="\t")
-        fit = CurveFit(filename, 'ic50', [1.0, 1.0, 1.0])
+        fit = CurveFit(filename, 'var0 * x ** 2 + var1 * x + var2',
+                       [1.0, 1.0, 1.0])
         fit.file_handler('.txt')
         self.assertEqual(list(map(int, fit.x)), range(15))
         self.assertEqual(list(map(int, fit.y)), [i * i for i in range(15)])
@@ -115,7 +241,8 @@ class FileHandlerTest(TestCase):
         """
         filename = os.path.join(MEDIA_ROOT, "test.txt")
         write_file_data(filename, sep=",")
-        fit = CurveFit(filename, 'ic50', [1.0, 1.0, 1.0])
+        fit = CurveFit(filename, 'var0 * x ** 2 + var1 * x + var2',
+                       [1.0, 1.0, 1.0])
         fit.file_handler('.txt')
         self.assertEqual(list(map(int, fit.x)), [])
         self.assertEqual(list(map(int, fit.y)), [])
@@ -198,6 +325,22 @@ class CurveFitTest(TestCase):
         iters, vals = self.run_levenberg_marquardt(model, param, y)
         self.assertTrue(np.allclose(vals, param))
 
+    def test_double_gaussian_model(self):
+        """
+        Models with more than four parameters are fitted too.
+        """
+        param = [0.1, 1.0, 8.0, 3.0, 0.5, 25.0, 4.0]
+        model = ('var0 + var1 * exp(-(x - var2) ** 2 / var3 ** 2) + '
+                 'var4 * exp(-(x - var5) ** 2 / var6 ** 2)')
+        x = np.arange(1, 40, 0.5)
+        y = (param[0] + param[1] * np.exp(-(x - param[2]) ** 2 / param[3] ** 2)
+             + param[4] * np.exp(-(x - param[5]) ** 2 / param[6] ** 2))
+        fit = CurveFit('dummy', model, np.array([0.0, 1, 7, 2, 1, 24, 2]))
+        fit.x = x
+        fit.y = y
+        iters, vals = fit.levenberg_marquardt()
+        self.assertTrue(np.allclose(vals, param))
+
     def test_perfect_guess(self):
         """
         A perfect guess should not iterate
@@ -216,6 +359,752 @@ class CurveFitTest(TestCase):
         self.assertEqual(iters, 0)
 
 
+class UploadStreamTest(TestCase):
+    """
+    Test that uploads are parsed straight from their chunks.
+    """
+    class ChunkedUpload(object):
+        def __init__(self, chunks):
+            self._chunks = chunks
+
+        def chunks(self):
+            return iter(self._chunks)
+
+    def test_lines_split_across_chunks(self):
+        """
+        Lines and line endings split between chunks are put back together.
+        """
+        upload = self.ChunkedUpload(["1,1\r", "\n2,4\r\n3,", "9"])
+        self.assertEqual(list(iter_lines(upload)),
+                         ["1,1\r\n", "2,4\r\n", "3,9"])
+        data, msg = read_table(upload, '.csv')
+        self.assertEqual(data.tolist(), [[1, 1], [2, 4], [3, 9]])
+        self.assertEqual(msg, '')
+
+    def test_upload_is_not_written_to_media_root(self):
+        """
+        Fitting an upload should leave nothing behind but the plot.
+        """
+        file_setup()
+        f = open(os.path.join(PROJECT_PATH, 'tests', 'test.csv'), "rU")
+        self.client.post('/curvefit/', {
+            'model': '1 - (var0 / (1 + (var1 / x) ** var2))',
+            'm1': 1.0, 'm2': 1.0, 'm3': 1.0, 'm4': 1.0,
+            'infile': f,
+        })
+        f.close()
+        self.assertFalse('test.csv' in os.listdir(MEDIA_ROOT))
+        clear_media()
+
+
+class ModelCacheTest(TestCase):
+    """
+    Test that compiled models are reused between fits.
+    """
+    def setUp(self):
+        model_cache.clear()
+        model_aliases.clear()
+
+    def test_repeat_model_hits_cache(self):
+        """
+        Compiling the same model twice should only compile it once.
+        """
+        model = '1 - (var0 / (1 + (var1 / x) ** var2))'
+        first = compile_model(model, 3)
+        second = compile_model(model, 3)
+        self.assertTrue(first is second)
+        self.assertEqual(model_cache.stats()['misses'], 1)
+        self.assertEqual(model_cache.stats()['hits'], 1)
+
+    def test_equivalent_spelling_hits_cache(self):
+        """
+        Models that sympify to the same expression share a cache entry.
+        """
+        first = compile_model('var0*x/(var1 + x)', 2)
+        second = compile_model('(var0 * x) / (x + var1)', 2)
+        self.assertTrue(first is second)
+
+    def test_evicted_model_counts_one_miss(self):
+        """
+        Compiling a model whose alias is known but whose compiled model has
+        been evicted counts a single miss.
+        """
+        model = 'var0 * exp(-var1 * x)'
+        compile_model(model, 2)
+        model_cache.clear()
+        compile_model(model, 2)
+        self.assertEqual(model_cache.stats()['misses'], 1)
+        self.assertEqual(model_cache.stats()['hits'], 0)
+        compile_model(model, 2)
+        self.assertEqual(model_cache.stats()['misses'], 1)
+        self.assertEqual(model_cache.stats()['hits'], 1)
+
+    def test_cache_is_bounded(self):
+        """
+        The least recently used model is evicted once the cache is full.
+        """
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+
+class FusedKernelTest(TestCase):
+    """
+    Test that the fused residual and Jacobian kernel matches the separately
+    lambdified model and derivatives.
+    """
+    def check_kernel(self, kernel, compiled, x, y, var):
+        f = np.empty(len(x))
+        jt = compiled.jacobian_buffer(len(x))
+        kernel(x, y, f, jt, var)
+        self.assertTrue(np.allclose(f, y - compiled.eqn(x, var)))
+        for i, df in enumerate(compiled.funcarray):
+            self.assertTrue(np.allclose(jt[i], -df(x, var) * x ** 0.0))
+
+    def test_fused_kernel_matches_lambdify(self):
+        model = 'var0 + ((var1 - var0) / (1 + exp((var2 - x) / var3)))'
+        var = [0.0012, 0.9563, 0.1221, 1.7532]
+        x = np.linspace(-5, 5, 50)
+        y = np.cos(x)
+        compiled = compile_model(model, 4)
+        self.check_kernel(compiled.kernel, compiled, x, y, var)
+
+    def test_unfused_kernel_matches_lambdify(self):
+        model = 'var0 + var1 * exp(-var2 * x)'
+        var = [0.9563, 0.1221, 1.7532]
+        x = np.linspace(0, 5, 50)
+        y = np.sin(x)
+        compiled = compile_model(model, 3)
+        kernel = unfused_kernel(compiled.eqn, compiled.funcarray)
+        self.check_kernel(kernel, compiled, x, y, var)
+
+
+    def test_constant_columns_are_cached(self):
+        """
+        Constant derivatives are filled once by jacobian_buffer and left
+        alone by the kernel.
+        """
+        compiled = compile_model('var0 + var1 * x + var2 * exp(x)', 3)
+        self.assertEqual(compiled.constant_columns, {0: -1.0})
+        x = np.linspace(0, 1, 20)
+        jt = compiled.jacobian_buffer(len(x))
+        jt[1:] = np.nan
+        compiled.kernel(x, np.zeros(20), np.empty(20), jt, [1.0, 2.0, 3.0])
+        self.assertTrue(np.all(jt[0] == -1.0))
+        self.assertTrue(np.allclose(jt[1], -x))
+
+
+@unittest.skipUnless(find_executable(native.CC), "needs a C compiler")
+class NativeKernelTest(TestCase):
+    """
+    Test the models compiled to C.
+    """
+    model = 'var0 + ((var1 - var0) / (1 + exp((var2 - x) / var3))) + var4 * x'
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.symfunc = get_symbolic_function(self.model, 5)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def compile(self, symfunc=None, nvars=5):
+        if symfunc is None:
+            symfunc = self.symfunc
+        numpy_model = CompiledModel(symfunc, nvars, 'numpy')
+        return numpy_model, native_kernel(symfunc, nvars, numpy_model.kernel,
+                                          numpy_model.residual,
+                                          self.cache_dir)
+
+    def test_matches_numpy_kernel(self):
+        """
+        The C kernel agrees with numpy, reading x and y through strides.
+        """
+        numpy_model, c = self.compile()
+        data = np.column_stack([np.linspace(-5, 5, 101),
+                                np.linspace(0, 1, 101)])
+        x, y = data[:, 0], data[:, 1]
+        var = np.array([0.1, 0.9, 0.3, 0.2, 0.05])
+        f, jt = np.empty(101), numpy_model.jacobian_buffer(101)
+        f2, jt2 = np.empty(101), numpy_model.jacobian_buffer(200)[:, :101]
+        numpy_model.kernel(x, y, f, jt, var)
+        for i, value in c.constant_columns.items():
+            jt2[i] = value
+        c.kernel(x, y, f2, jt2, var)
+        self.assertTrue(np.allclose(f, f2))
+        self.assertTrue(np.allclose(jt, jt2))
+        self.assertTrue(np.allclose(c.residual(x, y, np.empty(101), var), f))
+
+    def test_constant_columns(self):
+        symfunc = get_symbolic_function('var0 + var1 * x', 2)
+        c = self.compile(symfunc, 2)[1]
+        self.assertEqual(c.constant_columns, {0: -1.0})
+
+    def test_stacked_parameters_use_numpy(self):
+        numpy_model, c = self.compile()
+        x = np.linspace(-5, 5, 50)
+        var = np.array([[0.1, 0.2], [0.9, 1.0], [0.3, 0.4], [0.2, 0.3],
+                        [0.0, 0.1]])[:, :, None]
+        f, jt = np.empty((2, 50)), numpy_model.jacobian_buffer(2, 50)
+        f2, jt2 = np.empty((2, 50)), numpy_model.jacobian_buffer(2, 50)
+        numpy_model.kernel(x, x, f, jt, var)
+        c.kernel(x, x, f2, jt2, var)
+        self.assertTrue(np.allclose(f, f2))
+        self.assertTrue(np.allclose(jt, jt2))
+
+    def test_library_is_cached_on_disk(self):
+        """
+        A library built before, by this or another process, is loaded
+        without generating the C source again.
+        """
+        self.compile()
+        self.assertEqual(len([name for name in os.listdir(self.cache_dir)
+                              if name.endswith('.so')]), 1)
+        native._libraries.clear()
+        def generate():
+            raise AssertionError("compiled twice")
+        key = (s.srepr(self.symfunc), 5)
+        lib, constants = native.load_library(key, generate, self.cache_dir)
+        self.assertEqual(constants, {})
+
+    def test_untrusted_library_is_not_loaded(self):
+        """
+        Libraries in a directory, or files, that other users can write to
+        are never loaded, since they could have been planted.
+        """
+        self.compile()
+        path = [os.path.join(self.cache_dir, name)
+                for name in os.listdir(self.cache_dir)
+                if name.endswith('.so')][0]
+        key = (s.srepr(self.symfunc), 5)
+        generate = lambda: self.fail("compiled again")
+        for target in (path, self.cache_dir):
+            mode = os.stat(target).st_mode
+            os.chmod(target, mode | 0022)
+            native._libraries.clear()
+            self.assertEqual(native.load_library(key, generate,
+                                                 self.cache_dir), None)
+            os.chmod(target, mode)
+        native._libraries.clear()
+        self.assertNotEqual(native.load_library(key, generate,
+                                                self.cache_dir), None)
+
+    def test_unsupported_functions_fall_back(self):
+        symfunc = get_symbolic_function('var0 * besselj(0, var1 * x)', 2)
+        self.assertEqual(self.compile(symfunc, 2)[1], None)
+
+    def test_fits_agree(self):
+        fit = CurveFit('dummy', self.model, np.zeros(5))
+        fit.x = np.linspace(-5, 5, 200)
+        fit.y = 0.1 + 0.8 / (1 + np.exp((0.3 - fit.x) / 0.2)) + 0.05 * fit.x
+        expected = fit.fit()[1].copy()
+        c = self.compile()[1]
+        fit.var = np.zeros(5)
+        fit.compiled = CompiledModel(self.symfunc, 5, 'numpy')
+        fit.kernel = fit.compiled.kernel = c.kernel
+        fit.compiled.residual = c.residual
+        fit.chunk_size = 64
+        self.assertTrue(np.allclose(fit.fit()[1], expected))
+
+
+class ModelParametersTest(TestCase):
+    def test_nvars_counts_to_highest_index(self):
+        self.assertEqual(find_nvars('var0 + var1 * exp(-var1 * x)'), 2)
+        self.assertEqual(find_nvars('var0 + var2 * x'), 3)
+        self.assertEqual(find_nvars('var10 * x + var9'), 11)
+        self.assertEqual(check_vars('var1 * x + var0'), '')
+        self.assertIn('var1 is missing', check_vars('var0 + var2 * x'))
+
+    def test_unknown_names_are_rejected(self):
+        """
+        Names other than x and the parameters would bind to locals of the
+        generated kernels, such as y, so they are a model error.
+        """
+        for model in ['var0 * y + var1', 'var0 * jt + var1 * n',
+                      'cse0 + var0 * x + var1']:
+            self.assertRaises(ValueError, get_symbolic_function, model, 2)
+            result = run_fit({'model': model, 'var': [1.0, 1.0],
+                              'x': np.arange(5.0), 'y': np.arange(5.0)})
+            self.assertEqual(result['msg'],
+                             "There was an error in the model equation.")
+
+
+class BuiltinModelTest(TestCase):
+    """
+    Test the hand-written kernels used for the built-in models.
+    """
+    def test_builtins_agree_with_sympy(self):
+        """
+        Every built-in model's derivatives should match sympy's.
+        """
+        var = [0.5, 1.2, 0.8, 1.5]
+        for x in [np.linspace(0.1, 5, 40), np.logspace(-1, 3, 200)]:
+            for builtin in BUILTIN_MODELS.values():
+                self.assertTrue(check_builtin(builtin, x,
+                                              var[:builtin.nvars]),
+                                builtin.name)
+
+    def test_boltzmann_far_from_midpoint(self):
+        """
+        The Boltzmann derivatives stay finite where exp((var2 - x) / var3)
+        overflows, so a fit from a narrow width still converges.
+        """
+        builtin = BUILTIN_MODELS['boltzmann']
+        x = np.linspace(0, 1000, 200)
+        self.assertTrue(check_builtin(builtin, x, [0.5, 2.5, 500.0, 1.0]))
+        y = builtin.eqn(x, [0.5, 2.5, 500.0, 50.0])
+        result = fit_data(builtin.expression, [1.0, 1.0, 1.0, 1.0], x, y,
+                          builtin='boltzmann')
+        self.assertTrue(result['k'] > 0)
+        self.assertTrue(np.allclose(result['var'], [0.5, 2.5, 500.0, 50.0]))
+
+    def test_builtin_constant_columns(self):
+        """
+        The constant rows of the built-in models are filled once by
+        jacobian_buffer and never written by the kernel, and agree with
+        those found for the same expression by sympy.
+        """
+        x = np.linspace(0.1, 5, 20)
+        for builtin in BUILTIN_MODELS.values():
+            compiled = compile_model(builtin.expression, builtin.nvars)
+            self.assertEqual(builtin.constant_columns,
+                             compiled.constant_columns, builtin.name)
+            jt = builtin.jacobian_buffer(len(x))
+            for i in builtin.constant_columns:
+                jt[i] = np.nan
+            builtin.kernel(x, np.zeros(20), np.empty(20), jt,
+                           [0.5, 1.2, 0.8, 1.5][:builtin.nvars])
+            self.assertEqual(np.isnan(jt).all(axis=1).sum(),
+                             len(builtin.constant_columns))
+
+    def test_builtin_expression_uses_fast_path(self):
+        """
+        A model typed exactly as a built-in one should not be compiled.
+        """
+        fit = CurveFit('dummy', '1 - (var0 / (1 + (var1 / x) ** var2))',
+                       [1.0, 1.0, 1.0], builtin='ic50')
+        self.assertTrue(fit.compiled is BUILTIN_MODELS['ic50'])
+
+    def test_edited_builtin_is_compiled(self):
+        """
+        Editing the expression of a built-in model falls back to sympy.
+        """
+        fit = CurveFit('dummy', '2 - (var0 / (1 + (var1 / x) ** var2))',
+                       [1.0, 1.0, 1.0], builtin='ic50')
+        self.assertTrue(isinstance(fit.compiled, CompiledModel))
+
+
+class SolverTest(TestCase):
+    """
+    Test the solver backends on a steep sigmoid.
+    """
+    model = 'var0 + ((var1 - var0) / (1 + exp((var2 - x) / var3))) + 0 * x'
+    param = [0.1, 0.9, 0.3, 0.2]
+
+    def make_fit(self, guess=(0.0, 1.0, 0.0, 1.0)):
+        fit = CurveFit('dummy', self.model, np.array(guess))
+        fit.x = np.linspace(-5, 5, 200)
+        fit.y = self.param[0] + (self.param[1] - self.param[0]) / (
+            1 + np.exp((self.param[2] - fit.x) / self.param[3]))
+        return fit
+
+    def test_every_solver_fits(self):
+        for name in SOLVERS:
+            fit = self.make_fit()
+            k, var = fit.fit(get_solver(name))
+            self.assertTrue(np.allclose(var, self.param), name)
+            self.assertTrue(fit.nfev >= fit.njev > 0)
+            self.assertTrue(fit.time > 0)
+
+    def test_dogleg_needs_fewer_evaluations(self):
+        lm, dogleg = self.make_fit(), self.make_fit()
+        lm.fit(get_solver('lm'))
+        dogleg.fit(get_solver('dogleg'))
+        self.assertTrue(dogleg.nfev < lm.nfev)
+
+    def test_iteration_cap(self):
+        fit = self.make_fit()
+        k, var = fit.fit(get_solver('lm', max_iter=3))
+        self.assertEqual(k, 3)
+
+    def test_bounds_are_respected(self):
+        for name in SOLVERS:
+            fit = self.make_fit((0.0, 1.0, 0.0, 1.0))
+            k, var = fit.fit(get_solver(name, upper=[1.0, 1.0, 0.2]))
+            self.assertTrue(var[2] <= 0.2, name)
+
+    def test_optimum_on_a_bound(self):
+        """
+        When the best fit lies on a bound every solver converges to it,
+        holding the bounded parameter there and fitting the others.
+        """
+        x = np.linspace(0, 10, 50)
+        y = 2 * np.exp(-0.5 * x)
+        grid = np.linspace(0, 1, 100001)
+        sse = [np.sum((y - np.exp(-v * x)) ** 2) for v in grid]
+        best = grid[np.argmin(sse)]
+        for name in SOLVERS:
+            fit = CurveFit('dummy', 'var0 * exp(-var1 * x)',
+                           np.array([0.5, 0.5]))
+            fit.x, fit.y = x, y
+            solver = get_solver(name, lower=[0.0, 0.0], upper=[1.0, 1.0])
+            k, var = fit.fit(solver)
+            self.assertTrue(k < solver.max_iter, name)
+            self.assertEqual(var[0], 1.0, name)
+            self.assertTrue(abs(var[1] - best) < 1e-4, name)
+
+    def test_unknown_solver(self):
+        self.assertRaises(ValueError, get_solver, 'simplex')
+
+    def test_chunked_normal_equations(self):
+        """
+        Accumulating over chunks gives the same J^T J, J^T f and sum of
+        squares as the whole Jacobian.
+        """
+        var = np.array([0.0, 1.0, 0.0, 1.0])
+        fit = self.make_fit()
+        f, J = whole_jacobian(fit, var)
+        fit.chunk_size = 7
+        a, g = np.empty((4, 4)), np.empty(4)
+        F = fit.normal_equations(var, a, g)
+        self.assertTrue(np.allclose(a, np.dot(J.T, J)))
+        self.assertTrue(np.allclose(g, np.dot(J.T, f)))
+        self.assertTrue(np.allclose(F, np.dot(f, f)))
+        self.assertTrue(np.allclose(fit.sum_of_squares(var), np.dot(f, f)))
+
+    def test_chunked_fits_agree(self):
+        for name in SOLVERS:
+            fit = self.make_fit()
+            whole = fit.fit(get_solver(name))[1]
+            fit = self.make_fit()
+            fit.chunk_size = 7
+            chunked = fit.fit(get_solver(name))[1]
+            self.assertTrue(np.allclose(whole, chunked), name)
+            self.assertEqual(len(fit.fc), 7)
+
+
+class WeightedFitTest(TestCase):
+    """
+    Test weighted fits and robust losses on a straight line with outliers.
+    """
+    def make_fit(self):
+        fit = CurveFit('dummy', 'var0 + var1 * x', np.array([0.0, 0.0]))
+        fit.x = np.linspace(0, 10, 101)
+        fit.y = 1.0 + 2.0 * fit.x + 0.01 * np.sin(7 * fit.x)
+        fit.y[::10] += 50.0
+        return fit
+
+    def test_least_squares_is_pulled_by_outliers(self):
+        var = self.make_fit().fit()[1]
+        self.assertFalse(np.allclose(var, [1.0, 2.0], atol=0.1))
+
+    def test_sigma_weights_the_fit(self):
+        fit = self.make_fit()
+        fit.sigma = np.ones(len(fit.x))
+        fit.sigma[::10] = 1.0e6
+        var = fit.fit()[1]
+        self.assertTrue(np.allclose(var, [1.0, 2.0], atol=0.01))
+
+    def test_robust_losses_ignore_outliers(self):
+        for loss in LOSSES:
+            if loss == 'linear':
+                continue
+            for name in SOLVERS:
+                fit = self.make_fit()
+                fit.loss = loss
+                var = fit.fit(get_solver(name))[1]
+                self.assertTrue(np.allclose(var, [1.0, 2.0], atol=0.05),
+                                (loss, name, var))
+                self.assertTrue(fit.loss_scale > 0)
+
+    def test_chunked_weighted_normal_equations(self):
+        """
+        Accumulating over chunks gives J^T W J and J^T W f.
+        """
+        var = np.array([0.5, 1.5])
+        fit = self.make_fit()
+        fit.sigma = np.linspace(0.5, 2.0, len(fit.x))
+        fit.loss = 'cauchy'
+        fit.loss_scale = 2.0
+        fit.rho = LOSSES['cauchy']
+        f, J = whole_jacobian(fit, var)
+        e = f / fit.sigma
+        w = LOSSES['cauchy']((e / 2.0) ** 2)[1] / fit.sigma ** 2
+        fit.chunk_size = 7
+        a, g = np.empty((2, 2)), np.empty(2)
+        F = fit.normal_equations(var, a, g)
+        self.assertTrue(np.allclose(a, np.dot(J.T * w, J)))
+        self.assertTrue(np.allclose(g, np.dot(J.T, w * f)))
+        self.assertTrue(np.allclose(F, 4.0 * np.log1p(e ** 2 / 4.0).sum()))
+        self.assertTrue(np.allclose(fit.sum_of_squares(var), F))
+
+
+class UncertaintyTest(TestCase):
+    """
+    Test the parameter uncertainties and fit statistics.
+    """
+    def make_fit(self):
+        fit = CurveFit('dummy', 'var0 + var1 * x', np.array([1.0, 1.0]))
+        fit.x = np.linspace(0, 10, 41)
+        fit.y = 1.0 + 2.0 * fit.x + 0.3 * np.sin(3 * fit.x)
+        return fit
+
+    def test_straight_line_errors(self):
+        """
+        The errors of a straight line fit match ordinary least squares.
+        """
+        fit = self.make_fit()
+        fit.fit()
+        nfev = fit.nfev
+        stats = fit.statistics()
+        self.assertEqual(fit.nfev, nfev)
+        X = np.column_stack([np.ones(len(fit.x)), fit.x])
+        coef, ssr = np.linalg.lstsq(X, fit.y, rcond=-1)[:2]
+        cov = np.linalg.inv(np.dot(X.T, X)) * ssr[0] / 39
+        self.assertTrue(np.allclose(stats['covariance'], cov))
+        self.assertTrue(np.allclose(stats['stderr'], np.sqrt(np.diag(cov))))
+        self.assertEqual(stats['dof'], 39)
+        self.assertTrue(np.allclose(stats['chi2_red'], ssr[0] / 39))
+        r2 = 1 - ssr[0] / ((fit.y - fit.y.mean()) ** 2).sum()
+        self.assertTrue(np.allclose(stats['r2'], r2))
+
+    def test_ill_conditioned_covariance(self):
+        """
+        A numerically singular J^T W J gives infinite variances rather than
+        the garbage its inverse holds, while a merely badly scaled one is
+        inverted.
+        """
+        fit = CurveFit('dummy', 'var0 * exp(-var1 * x)', np.array([1.0, 1.0]))
+        fit.x, fit.y = np.ones(3), np.array([0.5, 0.6, 0.7])
+        fit.fit()
+        stats = fit.statistics()
+        self.assertEqual(stats['stderr'], [None, None])
+        self.assertEqual(stats['covariance'], [[None, None], [None, None]])
+        jtj = np.array([[1e-10, 1e-1], [1e-1, 1e10]]) * 3
+        self.assertTrue(np.allclose(covariance(jtj, 4.0, 2),
+                                    2 * np.linalg.inv(jtj)))
+
+    def test_weighted_chi2(self):
+        fit = self.make_fit()
+        fit.sigma = np.linspace(0.1, 0.5, len(fit.x))
+        var = fit.fit()[1]
+        stats = fit.statistics()
+        e = (fit.y - var[0] - var[1] * fit.x) / fit.sigma
+        self.assertTrue(np.allclose(stats['chi2_red'], np.dot(e, e) / 39))
+
+    def test_confidence_band(self):
+        fit = self.make_fit()
+        fit.fit()
+        stats = fit.statistics()
+        X = np.column_stack([np.ones(len(fit.x)), fit.x])
+        cov = np.array(stats['covariance'])
+        expected = t_quantile(39) * np.sqrt(
+            (np.dot(X, cov) * X).sum(axis=1))
+        self.assertTrue(np.allclose(fit.curve_band(fit.x), expected))
+        data = fit.plot_data()
+        self.assertEqual(len(data['band']), len(data['curve_x']))
+
+    def test_t_quantile(self):
+        for dof, t in [(1, 12.7062), (2, 4.3027), (5, 2.5706), (30, 2.0423)]:
+            self.assertAlmostEqual(t_quantile(dof), t, 3)
+
+    def test_no_degrees_of_freedom(self):
+        fit = self.make_fit()
+        fit.x, fit.y = fit.x[:2], fit.y[:2]
+        fit.fit()
+        stats = fit.statistics()
+        self.assertEqual(stats['stderr'], [None, None])
+        self.assertEqual(fit.curve_band(fit.x), None)
+
+
+class GuessTest(TestCase):
+    """
+    Test the automatic initial guesses.
+    """
+    def test_builtin_heuristics(self):
+        """
+        The heuristics land close to the true parameters of clean curves.
+        """
+        cases = [
+            ('boltzmann', [0.2, 3.0, 12.0, 2.5], np.linspace(0, 25, 200)),
+            ('expdecay', [0.5, 4.0, 0.3], np.linspace(0, 20, 200)),
+            ('gaussian', [0.1, 2.0, 7.0, 1.5], np.linspace(0, 15, 200)),
+            ('hill', [2.5, 40.0, 1.3], np.logspace(-1, 3, 60)),
+            ('ic50', [0.9, 25.0, 1.8], np.logspace(-1, 3, 60)),
+            ('mm', [12.0, 8.0], np.linspace(0.1, 60, 60)),
+        ]
+        for name, param, x in cases:
+            builtin = BUILTIN_MODELS[name]
+            y = builtin.eqn(x, param)
+            var = guess_parameters(builtin, [1.0] * len(param), x, y)
+            self.assertTrue(np.allclose(var, param, rtol=0.3), name)
+
+    def test_grid_improves_on_guess(self):
+        """
+        For other models the best point of the grid is used if it beats the
+        given guess.
+        """
+        compiled = compile_model('var0 * x + var1 * cos(x)', 2)
+        x = np.linspace(0, 10, 100)
+        y = 2.0 * x - 30.0 * np.cos(x)
+        var = guess_parameters(compiled, [1.0, 1.0], x, y)
+        self.assertTrue(np.allclose(var, [1.0, -10.0]))
+
+    def test_given_guess_kept_if_best(self):
+        compiled = compile_model('var0 * x + var1 * cos(x)', 2)
+        x = np.linspace(0, 10, 100)
+        y = 2.0 * x + 3.0 * np.cos(x)
+        var = guess_parameters(compiled, [2.0, 3.0], x, y)
+        self.assertTrue(np.allclose(var, [2.0, 3.0]))
+
+    def test_auto_guess_fits_gaussian(self):
+        """
+        A Gaussian the default guess misses is fitted from the estimate.
+        """
+        builtin = BUILTIN_MODELS['gaussian']
+        param = [0.1, 2.0, 7.0, 1.5]
+        x = np.linspace(0, 15, 200)
+        result = fit_data(builtin.expression, [1.0] * 4, x,
+                          builtin.eqn(x, param), builtin='gaussian',
+                          auto_guess=True)
+        self.assertTrue(np.allclose(result['var'], param))
+        self.assertNotEqual(result['guess'], [1.0] * 4)
+
+
+class MultiStartTest(TestCase):
+    """
+    Test the multi-start search for the global best fit.
+    """
+    def test_modsin_from_a_poor_guess(self):
+        builtin = BUILTIN_MODELS['modsin']
+        param = [1.5, 0.7, 3.0]
+        x = np.linspace(0, 20, 400)
+        y = builtin.eqn(x, param)
+        single = fit_data(builtin.expression, [1.0] * 3, x, y,
+                          builtin='modsin')
+        self.assertFalse(np.allclose(single['var'], param))
+        result = fit_data(builtin.expression, [1.0] * 3, x, y,
+                          builtin='modsin', multistart=True)
+        self.assertTrue(np.allclose(result['var'], param))
+        self.assertTrue(result['solutions'])
+        for s in result['solutions']:
+            self.assertFalse(np.allclose(s['var'], param, rtol=1.0e-4))
+
+    def test_gaussian_mixture(self):
+        model = ('var0 * exp(-(x - var1)**2 / var2**2) + '
+                 'var3 * exp(-(x - var4)**2 / var5**2)')
+        param = [1.0, 3.0, 0.8, 0.6, 7.0, 1.2]
+        x = np.linspace(0, 20, 400)
+        y = (param[0] * np.exp(-(x - param[1]) ** 2 / param[2] ** 2) +
+             param[3] * np.exp(-(x - param[4]) ** 2 / param[5] ** 2))
+        solutions = multi_start(model, [1.0, 5.0, 1.0, 1.0, 5.0, 1.0], x, y)
+        best = np.abs(solutions[0][0])
+        swapped = param[3:] + param[:3]
+        self.assertTrue(np.allclose(best, param, rtol=1.0e-3) or
+                        np.allclose(best, swapped, rtol=1.0e-3))
+        sse = [s for _, s in solutions]
+        self.assertEqual(sse, sorted(sse))
+
+
+class BatchCurveFitTest(TestCase):
+    """
+    Test fitting many curves at once.
+    """
+    params = [[0.9563, 0.1221, 1.7532],
+              [0.5, 0.3, 1.2],
+              [0.8, 2.0, 0.9]]
+    model = '1 - (var0 / (1 + (var1 / x) ** var2))'
+
+    def ideal_curves(self):
+        xmax = np.log10(150)
+        xmin = np.log10(0.001)
+        x = 10 ** np.arange(xmin, xmax, (xmax - xmin) / 25)
+        y = [1 - (p[0] / (1 + (p[1] / x) ** p[2])) for p in self.params]
+        return x, np.array(y)
+
+    def tearDown(self):
+        clear_media()
+
+    def test_batch_returns_each_curves_params(self):
+        """
+        Every curve should be fitted to its own parameters.
+        """
+        x, y = self.ideal_curves()
+        for model in [self.model, '1 - var0 / (1 + (var1 / x) ** var2)']:
+            fit = BatchCurveFit('dummy', model, [1.0, 1.0, 1.0])
+            fit.x = x
+            fit.y = y
+            iters, vals = fit.levenberg_marquardt()
+            self.assertEqual(len(iters), 3)
+            self.assertTrue(np.allclose(vals, self.params))
+
+    def test_batch_view_reads_multicolumn_file(self):
+        """
+        The batch page fits every column after the first.
+        """
+        x, y = self.ideal_curves()
+        filename = os.path.join(MEDIA_ROOT, "batch.csv")
+        np.savetxt(filename, np.column_stack([x] + list(y)), delimiter=",")
+        f = open(filename, "rU")
+        response = self.client.post(
+            '/curvefit/batch/',
+            {
+                'model': self.model,
+                'm1': 1.0,
+                'm2': 1.0,
+                'm3': 1.0,
+                'm4': 1.0,
+                'infile': f
+            }, follow=True
+        )
+        f.close()
+        self.assertIn("<title>CurveFit | Batch Fit Results</title>",
+                      response.content)
+        for p in self.params:
+            for value in p:
+                self.assertIn("<td>%.4f</td>" % value, response.content)
+
+
+class PlotRenderTest(TestCase):
+    """
+    Test the pyplot-free plot renderer.
+    """
+    def setUp(self):
+        self.x = np.arange(1, 40, 1.0)
+        self.y = (9.563 * self.x) / (0.6257 + self.x)
+        self.eqn = lambda x: (9.563 * x) / (0.6257 + x)
+
+    def test_render_png_returns_image(self):
+        png = render_png(self.x, self.y, self.eqn, xlab='x', ylab='y')
+        self.assertEqual(png[:8], '\x89PNG\r\n\x1a\n')
+
+    def test_curve_resolution_follows_plot_width(self):
+        fig, canvas, ax = get_template()
+        n = curve_samples(fig, ax)
+        self.assertTrue(100 < n < 10000)
+
+    def test_concurrent_renders(self):
+        """
+        Threads rendering at the same time each get their own plot.
+        """
+        results = {}
+        def render(i):
+            results[i] = render_png(self.x, self.y * i, self.eqn)
+        threads = [threading.Thread(target=render, args=(i,))
+                   for i in range(1, 5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(set(results.values())), 4)
+        self.assertEqual(results[2], render_png(self.x, self.y * 2, self.eqn))
+
+
 class CurvefitFormTest(TestCase):
     """
     Test the form webpage.
@@ -243,6 +1132,12 @@ class CurvefitFormTest(TestCase):
             opt = "<option value=\"%s\">%s</option>" % (i[0], i[1])
             self.assertIn(opt, response.content)
 
+    def test_loss_scale_must_be_positive(self):
+        for value, valid in [('0', False), ('-1', False), ('0.5', True)]:
+            form = CurvefitForm({'loss_scale': value})
+            form.is_valid()
+            self.assertEqual('loss_scale' not in form.errors, valid, value)
+
 
 class CurvefitSuccessTest(TestCase):
     """
@@ -254,10 +1149,10 @@ class CurvefitSuccessTest(TestCase):
         """
         # Fake data...
         file_setup()
+        get_result_cache().clear()
 
     def tearDown(self):
-        for f in os.listdir(MEDIA_ROOT):
-            os.remove(os.path.join(MEDIA_ROOT, f))
+        clear_media()
 
     def setup_response(self,
                        filename,
@@ -326,6 +1221,142 @@ class CurvefitSuccessTest(TestCase):
         self.assertIn("<td>0.1221</td>", response.content)
         self.assertIn("<td>1.7532</td>", response.content)
 
+    def test_inline_plot_is_not_saved(self):
+        """
+        With inline plots the image is embedded in the page.
+        """
+        settings.CURVEFIT_INLINE_PLOTS = True
+        try:
+            response = self.setup_response("test.txt")
+        finally:
+            settings.CURVEFIT_INLINE_PLOTS = False
+        self.assertIn('<img src="data:image/png;base64,', response.content)
+        self.assertEqual(os.listdir(MEDIA_ROOT), [])
+
+    def test_more_than_four_parameters(self):
+        """
+        Guesses for var4 and up come from the more_vars field.
+        """
+        f = open(os.path.join(PROJECT_PATH, 'tests', 'test.txt'), "rU")
+        response = self.client.post('/curvefit/', {
+            'model': '1 - (var0 / (1 + (var1 / x) ** var2)) + var3 * x + var4',
+            'm1': 1.0, 'm2': 1.0, 'm3': 1.0, 'm4': 0.0,
+            'more_vars': '0.0',
+            'infile': f,
+        })
+        f.close()
+        self.assertIn("<td>m<sub>5</sub></td>", response.content)
+
+    def test_dogleg_solver_with_bounds(self):
+        """
+        The solver and bounds are taken from the form and the evaluation
+        counts are shown.
+        """
+        f = open(os.path.join(PROJECT_PATH, 'tests', 'test.txt'), "rU")
+        response = self.client.post('/curvefit/', {
+            'model': '1 - (var0 / (1 + (var1 / x) ** var2))',
+            'm1': 1.0, 'm2': 1.0, 'm3': 1.0, 'm4': 1.0,
+            'solver': 'dogleg',
+            'lower_bounds': '0, 0, 0',
+            'infile': f,
+        })
+        f.close()
+        self.assertIn("<td>0.9563</td>", response.content)
+        self.assertIn("function evaluations", response.content)
+
+    def test_auto_guess_fills_missing_guesses(self):
+        """
+        With auto_guess, guesses for var4 and up are not required.
+        """
+        f = open(os.path.join(PROJECT_PATH, 'tests', 'test.txt'), "rU")
+        response = self.client.post('/curvefit/', {
+            'model': '1 - (var0 / (1 + (var1 / x) ** var2)) + var3 * x + var4',
+            'm1': 1.0, 'm2': 1.0, 'm3': 1.0, 'm4': 0.0,
+            'auto_guess': 'on',
+            'infile': f,
+        })
+        f.close()
+        self.assertIn("<td>m<sub>5</sub></td>", response.content)
+
+    def test_multistart_returns_solutions(self):
+        response = self.client.post('/curvefit/json/', {
+            'model': '1 - (var0 / (1 + (var1 / x) ** var2))',
+            'm1': 1.0, 'm2': 1.0, 'm3': 1.0, 'm4': 1.0,
+            'multistart': 'on',
+            'infile': open(os.path.join(PROJECT_PATH, 'tests', 'test.txt'),
+                           "rU"),
+        })
+        data = json.loads(response.content)
+        self.assertTrue(np.allclose(data['var'], [0.9563, 0.1221, 1.7532],
+                                    atol=1.0e-4))
+        self.assertTrue(isinstance(data['solutions'], list))
+
+    @unittest.skipIf(openpyxl is None, "openpyxl is not installed")
+    def test_xlsx_upload_with_chosen_columns(self):
+        filename = os.path.join(MEDIA_ROOT, "upload.xlsx")
+        write_xlsx_data(filename)
+        f = open(filename, "rb")
+        response = self.client.post('/curvefit/', {
+            'model': 'var0 * x ** var1',
+            'm1': 1.0, 'm2': 1.0, 'm3': 1.0, 'm4': 1.0,
+            'y_column': 'signal',
+            'infile': f,
+        })
+        f.close()
+        self.assertIn("<td>1.0000</td>", response.content)
+        self.assertIn("<td>2.0000</td>", response.content)
+
+    def test_npy_upload(self):
+        filename = os.path.join(MEDIA_ROOT, "upload.npy")
+        x = np.arange(1.0, 16.0)
+        np.save(filename, np.column_stack([x, 3 * x ** 2]))
+        f = open(filename, "rb")
+        response = self.client.post('/curvefit/', {
+            'model': 'var0 * x ** var1',
+            'm1': 1.0, 'm2': 1.0, 'm3': 1.0, 'm4': 1.0,
+            'infile': f,
+        })
+        f.close()
+        self.assertIn("<td>3.0000</td>", response.content)
+        self.assertIn("<td>2.0000</td>", response.content)
+
+    def test_sigma_column_and_loss(self):
+        filename = os.path.join(MEDIA_ROOT, "upload.csv")
+        x = np.arange(1.0, 31.0)
+        y = 3.0 * x + 1.0
+        y[::10] += 100.0
+        sigma = np.ones(len(x))
+        with open(filename, "w") as f:
+            f.write("x,y,error\n")
+            for row in zip(x, y, sigma):
+                f.write("%g,%g,%g\n" % row)
+        f = open(filename, "rb")
+        response = self.client.post('/curvefit/json/', {
+            'model': 'var0 + var1 * x',
+            'm1': 1.0, 'm2': 1.0, 'm3': 1.0, 'm4': 1.0,
+            'sigma_column': 'error', 'loss': 'huber',
+            'infile': f,
+        })
+        f.close()
+        data = json.loads(response.content)
+        self.assertTrue(np.allclose(data['var'], [1.0, 3.0], atol=0.05))
+        self.assertTrue(data['loss_scale'] > 0)
+
+    def test_sigma_must_be_positive(self):
+        filename = os.path.join(MEDIA_ROOT, "upload.csv")
+        with open(filename, "w") as f:
+            f.writelines("%d,%d,%d\n" % (i, i * i, i) for i in xrange(15))
+        f = open(filename, "rb")
+        response = self.client.post('/curvefit/', {
+            'model': 'var0 * x ** var1',
+            'm1': 1.0, 'm2': 1.0, 'm3': 1.0, 'm4': 1.0,
+            'sigma_column': '3',
+            'infile': f,
+        })
+        f.close()
+        self.assertIn("The standard deviations must all be positive.",
+                      response.content)
+
     def test_axis_labels_are_not_required(self):
         """
         Labels for the graph shouldn't be required'.
@@ -335,6 +1366,698 @@ class CurvefitSuccessTest(TestCase):
         self.assertIn("<td>0.1221</td>", response.content)
         self.assertIn("<td>1.7532</td>", response.content)
 
+    def test_standard_errors_are_shown(self):
+        response = self.setup_response("test.txt")
+        self.assertIn("&plusmn;", response.content)
+        self.assertIn("R<sup>2</sup>", response.content)
+        self.assertIn("on 22 degrees of freedom", response.content)
+
+
+class FitExecutorTest(TestCase):
+    """
+    Test running fits in worker processes.
+    """
+    def kwargs(self, model):
+        x = np.arange(1, 40, 1.0)
+        return {
+            'model': model,
+            'var': [1.0, 1.0],
+            'x': x,
+            'y': (9.563 * x) / (0.6257 + x),
+        }
+
+    def test_worker_fits_model(self):
+        """
+        A fit run on a worker returns the same parameters.
+        """
+        executor = FitExecutor(2)
+        try:
+            model = '(var0 * x) / (var1 + x)'
+            self.assertTrue(executor.route(model) is
+                            executor.route('(var0*x)/(var1+x)'))
+            result = executor.run(self.kwargs(model), 60)
+        finally:
+            executor.shutdown()
+        self.assertTrue(np.allclose(result['var'], [9.563, 0.6257]))
+
+    def test_worker_is_replaced_after_timeout(self):
+        """
+        A fit that times out does not hold up later fits routed to the same
+        worker.
+        """
+        executor = FitExecutor(1)
+        try:
+            pool = executor.pools[0]
+            stuck = pool.apply_async(time.sleep, (600,))
+            self.assertRaises(multiprocessing.TimeoutError, executor.wait,
+                              pool, stuck, 0.5)
+            self.assertFalse(executor.pools[0] is pool)
+            result = executor.run(self.kwargs('(var0 * x) / (var1 + x)'), 60)
+        finally:
+            executor.shutdown()
+        self.assertTrue(np.allclose(result['var'], [9.563, 0.6257]))
+
+    def test_bad_model_is_reported(self):
+        """
+        Model errors come back as a message rather than an exception.
+        """
+        result = run_fit(self.kwargs('print "hacked"; var0; var1'))
+        self.assertEqual(result['msg'],
+                         "There was an error in the model equation.")
+
+
+class ResultCacheTest(TestCase):
+    """
+    Test that identical fits are served from the result cache.
+    """
+    def setUp(self):
+        get_result_cache().clear()
+        self.calls = []
+        self.execute = resultcache.execute
+        resultcache.execute = lambda kwargs: (self.calls.append(kwargs) or
+                                              self.execute(kwargs))
+        x = np.arange(1, 40, 1.0)
+        self.kwargs = {
+            'model': '(var0 * x) / (var1 + x)',
+            'var': [1.0, 1.0],
+            'x': x,
+            'y': (9.563 * x) / (0.6257 + x),
+            'store_plot': True,
+        }
+
+    def tearDown(self):
+        resultcache.execute = self.execute
+        clear_media()
+
+    def test_repeat_fit_is_cached(self):
+        first = cached_execute(self.kwargs)
+        second = cached_execute(dict(self.kwargs))
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(first, second)
+
+    def test_key_ignores_model_spacing(self):
+        """
+        The key ignores how the model is spaced, without parsing it, which
+        is left to the workers.
+        """
+        model = dict(self.kwargs, model='var0 * exp(-x / var1) ^ 2')
+        respaced = dict(self.kwargs, model='var0*exp(-x/var1)**2')
+        self.assertEqual(result_key(model), result_key(respaced))
+        self.assertEqual(model_aliases.get(('var0*exp(-x/var1)**2', 2)),
+                         None)
+
+    def test_key_depends_on_guess_and_data(self):
+        key = result_key(self.kwargs)
+        self.assertNotEqual(key, result_key(dict(self.kwargs,
+                                                 var=[2.0, 1.0])))
+        self.assertNotEqual(key, result_key(dict(self.kwargs,
+                                                 y=self.kwargs['y'] + 1)))
+
+    def test_missing_plot_is_restored(self):
+        """
+        A cached result whose plot was deleted gets it written back.
+        """
+        first = cached_execute(self.kwargs)
+        os.remove(os.path.join(MEDIA_ROOT, first['plotfile']))
+        result = cached_execute(self.kwargs)
+        self.assertEqual(result['plotfile'], first['plotfile'])
+        self.assertTrue(os.path.exists(os.path.join(MEDIA_ROOT,
+                                                    first['plotfile'])))
+
+
+class PlotStoreTest(TestCase):
+    """
+    Test storing plots by their contents and sweeping them away.
+    """
+    def tearDown(self):
+        clear_media()
+
+    def save(self, png, age=0):
+        plotfile = plotstore.save_plot(png)
+        used = time.time() - age
+        os.utime(os.path.join(MEDIA_ROOT, plotfile), (used, used))
+        return plotfile
+
+    def stored(self):
+        return sorted(path for used, size, path in
+                      plotstore.stored_plots(MEDIA_ROOT, time.time()))
+
+    def test_identical_plots_are_stored_once(self):
+        first = self.save('png one')
+        self.assertEqual(first, self.save('png one'))
+        self.assertNotEqual(first, self.save('png two'))
+        name = first.split('/')[-1]
+        self.assertEqual(first, '/'.join([plotstore.PLOT_DIR, name[:2],
+                                          name]))
+        self.assertEqual(len(self.stored()), 2)
+
+    def test_saving_again_marks_plot_used(self):
+        plotfile = self.save('png', age=100)
+        plotstore.save_plot('png')
+        used = os.path.getmtime(os.path.join(MEDIA_ROOT, plotfile))
+        self.assertTrue(time.time() - used < 10)
+
+    def test_sweep_by_ttl(self):
+        self.save('old', age=1000)
+        new = self.save('new', age=10)
+        with open(os.path.join(MEDIA_ROOT, 'plot_legacy.png'), 'wb') as f:
+            f.write('legacy')
+        legacy = time.time() - 1000
+        os.utime(os.path.join(MEDIA_ROOT, 'plot_legacy.png'),
+                 (legacy, legacy))
+        self.assertEqual(plotstore.sweep(budget=None, ttl=100), (2, 9))
+        self.assertEqual(self.stored(), [os.path.join(MEDIA_ROOT, new)])
+
+    def test_sweep_least_recently_used_to_budget(self):
+        plots = [self.save('plot %d' % i, age=100 - i) for i in range(5)]
+        self.assertEqual(plotstore.sweep(budget=12, ttl=None), (3, 18))
+        self.assertEqual(self.stored(), [os.path.join(MEDIA_ROOT, p)
+                                         for p in sorted(plots[3:])])
+
+    def test_concurrent_sweeps_stop_at_budget(self):
+        """
+        Plots another sweep removed in the meantime count as freed, so two
+        sweeps at once do not remove more than the budget needs.
+        """
+        plots = [self.save('plot %d' % i, age=100 - i) for i in range(10)]
+        listed = plotstore.stored_plots
+        def list_then_sweep(root, now):
+            found = listed(root, now)
+            plotstore.stored_plots = listed
+            plotstore.sweep(budget=36, ttl=None)
+            return found
+        plotstore.stored_plots = list_then_sweep
+        try:
+            self.assertEqual(plotstore.sweep(budget=36, ttl=None), (0, 0))
+        finally:
+            plotstore.stored_plots = listed
+        self.assertEqual(self.stored(), [os.path.join(MEDIA_ROOT, p)
+                                         for p in sorted(plots[4:])])
+
+    def test_save_does_not_start_sweeper(self):
+        """
+        Saving a plot, as the fit workers do, never starts a sweeper.
+        """
+        sweeper = plotstore._sweeper
+        plotstore._sweeper = None
+        try:
+            self.save('png')
+            self.assertEqual(plotstore._sweeper, None)
+        finally:
+            plotstore._sweeper = sweeper
+
+    def test_command(self):
+        self.save('old', age=1000)
+        out = StringIO()
+        call_command('sweep_plots', ttl=100, stdout=out)
+        self.assertEqual(out.getvalue(), "Removed 1 plots, freeing 3 bytes.\n")
+        self.assertEqual(self.stored(), [])
+
+    def test_results_page_shows_stored_plot(self):
+        file_setup()
+        get_result_cache().clear()
+        f = open(os.path.join(PROJECT_PATH, 'tests', 'test.csv'), "rU")
+        response = self.client.post('/curvefit/', {
+            'model': '1 - (var0 / (1 + (var1 / x) ** var2))',
+            'm1': 1.0, 'm2': 1.0, 'm3': 1.0, 'm4': 1.0,
+            'infile': f,
+        })
+        f.close()
+        plot = self.stored()[0]
+        self.assertIn('<img src="/resources/%s" />' %
+                      os.path.relpath(plot, MEDIA_ROOT), response.content)
+
+
+def wait_for_job(job, timeout=60):
+    """
+    Return job once it is no longer pending, or after timeout seconds.
+    """
+    end = time.time() + timeout
+    while time.time() < end:
+        job = FitJob.objects.get(pk=job.pk)
+        if job.status != 'pending':
+            return job
+        time.sleep(0.05)
+    return job
+
+
+class FitJobTest(TransactionTestCase):
+    """
+    Test queued fits and the job pages.
+    """
+    def setUp(self):
+        file_setup()
+        get_result_cache().clear()
+        self.settings = settings.CURVEFIT_ASYNC
+        settings.CURVEFIT_ASYNC = True
+        self.executor = FitExecutor(1)
+        executor._executor = self.executor
+
+    def tearDown(self):
+        settings.CURVEFIT_ASYNC = self.settings
+        executor._executor = None
+        self.executor.shutdown()
+        clear_media()
+
+    def post(self):
+        f = open(os.path.join(PROJECT_PATH, 'tests', 'test.txt'), "rU")
+        response = self.client.post('/curvefit/', {
+            'model': '1 - (var0 / (1 + (var1 / x) ** var2))',
+            'm1': 1.0, 'm2': 1.0, 'm3': 1.0, 'm4': 1.0,
+            'infile': f,
+        })
+        f.close()
+        return response
+
+    def test_post_redirects_to_job(self):
+        """
+        Submitting a fit should redirect to its job page.
+        """
+        response = self.post()
+        job = FitJob.objects.get()
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response['Location'].endswith(
+            '/curvefit/job/%d/' % job.pk))
+
+    def test_async_needs_workers(self):
+        """
+        Without workers a queued fit would run inside the request, so it is
+        refused rather than silently blocking.
+        """
+        executor._executor = None
+        workers = settings.CURVEFIT_WORKERS
+        settings.CURVEFIT_WORKERS = 0
+        try:
+            self.assertRaises(ImproperlyConfigured, self.post)
+        finally:
+            settings.CURVEFIT_WORKERS = workers
+        self.assertEqual(FitJob.objects.count(), 0)
+
+    def test_finished_job_shows_results(self):
+        """
+        The job page shows the fit results, with their standard errors and
+        goodness of fit, once the job is done.
+        """
+        self.post()
+        job = wait_for_job(FitJob.objects.get())
+        response = self.client.get('/curvefit/job/%d/' % job.pk)
+        self.assertIn("<title>CurveFit | Fit Results</title>",
+                      response.content)
+        self.assertIn("<td>0.9563</td>", response.content)
+        self.assertIn("&plusmn;", response.content)
+        self.assertNotIn("<td>&ndash;</td>", response.content)
+        self.assertIn("R<sup>2</sup>", response.content)
+        self.assertIn("function evaluations", response.content)
+
+    def test_job_json(self):
+        """
+        The job status is available as JSON.
+        """
+        self.post()
+        job = wait_for_job(FitJob.objects.get())
+        response = self.client.get('/curvefit/job/%d/json/' % job.pk)
+        data = json.loads(response.content)
+        self.assertEqual(data['status'], 'done')
+        self.assertTrue(np.allclose(data['var'], [0.9563, 0.1221, 1.7532],
+                                    atol=1e-4))
+        self.assertEqual(len(data['stderr']), 3)
+        self.assertEqual(len(data['covariance']), 3)
+        for name in ('r2', 'chi2_red', 'dof', 'nfev', 'solutions'):
+            self.assertIn(name, data)
+
+    def test_pending_job_waits(self):
+        """
+        A job that has not run yet shows the waiting page.
+        """
+        job = FitJob.objects.create(model='var0 * x + var1',
+                                    filename='test.txt')
+        response = self.client.get('/curvefit/job/%d/' % job.pk)
+        self.assertIn("<title>CurveFit | Fit Job</title>", response.content)
+
+
+class WorkerJobTest(TransactionTestCase):
+    """
+    Test queued jobs run by worker processes, whose results are recorded
+    by the pool's result handler thread.
+    """
+    def setUp(self):
+        self.executor = FitExecutor(1)
+        executor._executor = self.executor
+        self.store = jobs.store
+        x = np.arange(1, 40, 1.0)
+        self.kwargs = {
+            'model': '(var0 * x) / (var1 + x)',
+            'var': [1.0, 1.0],
+            'x': x,
+            'y': (9.563 * x) / (0.6257 + x),
+        }
+
+    def tearDown(self):
+        jobs.store = self.store
+        executor._executor = None
+        self.executor.shutdown()
+
+    def test_worker_result_is_recorded(self):
+        job = wait_for_job(submit_job(self.kwargs, 'data.txt'))
+        self.assertEqual(job.status, 'done')
+        self.assertTrue(np.allclose(job.get_params(), [9.563, 0.6257]))
+
+    def test_errors_do_not_stop_later_jobs(self):
+        """
+        An exception while recording one job leaves the result handler
+        running for the next.
+        """
+        def store(key, result):
+            raise IOError("disk full")
+        jobs.store = store
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        handlers, logger.handlers = logger.handlers, [handler]
+        try:
+            first = wait_for_job(submit_job(self.kwargs, 'data.txt'))
+            second = wait_for_job(submit_job(dict(self.kwargs,
+                                                  var=[2.0, 1.0]),
+                                             'data.txt'))
+        finally:
+            logger.handlers = handlers
+        self.assertEqual([first.status, second.status], ['done', 'done'])
+        self.assertEqual(len(records), 2)
+
+    def test_lost_job_expires(self):
+        job = FitJob.objects.create(model='var0 * x + var1',
+                                    filename='test.txt')
+        created = job.created - datetime.timedelta(
+            seconds=settings.CURVEFIT_FIT_TIMEOUT + 1)
+        FitJob.objects.filter(pk=job.pk).update(created=created)
+        response = self.client.get('/curvefit/job/%d/json/' % job.pk)
+        data = json.loads(response.content)
+        self.assertEqual(data['status'], 'failed')
+        self.assertEqual(data['msg'],
+                         "The fit took too long and was abandoned.")
+
+
+class VectorPlotTest(TestCase):
+    """
+    Test plots drawn in the browser and the JSON results.
+    """
+    def setUp(self):
+        file_setup()
+        get_result_cache().clear()
+
+    def tearDown(self):
+        clear_media()
+
+    def post(self, url, **extra):
+        f = open(os.path.join(PROJECT_PATH, 'tests', 'test.csv'), "rU")
+        data = {
+            'model': '1 - (var0 / (1 + (var1 / x) ** var2))',
+            'm1': 1.0, 'm2': 1.0, 'm3': 1.0, 'm4': 1.0,
+            'logscale': True,
+            'infile': f,
+        }
+        data.update(extra)
+        response = self.client.post(url, data)
+        f.close()
+        return response
+
+    def test_vector_plot_page(self):
+        """
+        The results page draws the plot itself and no image is saved.
+        """
+        response = self.post('/curvefit/', vector_plot=True)
+        self.assertIn('<canvas id="plot"', response.content)
+        self.assertIn("<td>0.9563</td>", response.content)
+        self.assertEqual(os.listdir(MEDIA_ROOT), [])
+
+    def test_json_results(self):
+        """
+        The JSON endpoint returns the parameters and plot points.
+        """
+        response = self.post('/curvefit/json/')
+        self.assertEqual(response['Content-Type'], 'application/json')
+        data = json.loads(response.content)
+        self.assertTrue(np.allclose(data['var'], [0.9563, 0.1221, 1.7532],
+                                    atol=1e-4))
+        self.assertEqual(len(data['plot']['x']), 25)
+        self.assertTrue(data['plot']['logscale'])
+        self.assertEqual(len(data['stderr']), 3)
+        self.assertEqual(data['dof'], 22)
+        self.assertTrue(0.99 < data['r2'] <= 1)
+        self.assertEqual(os.listdir(MEDIA_ROOT), [])
+
+    def test_json_errors(self):
+        response = self.post('/curvefit/json/', model='log(x) + var0')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('Supported models', json.loads(response.content)['msg'])
+        response = self.post('/curvefit/json/', model='var0 + var2 * x')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('var1 is missing', json.loads(response.content)['msg'])
+
+    def test_plot_data_is_thinned(self):
+        x = np.linspace(1, 10, 100000)
+        data = plot_data(x, x * 2, lambda x: x * 2, max_points=500)
+        self.assertEqual(len(data['x']), 500)
+        self.assertEqual(data['x'][-1], 10)
+
+
+class ApiTest(TestCase):
+    """
+    Test fitting through the JSON API.
+    """
+    def setUp(self):
+        get_result_cache().clear()
+        self.client = Client(enforce_csrf_checks=True)
+        self.x = np.linspace(0, 10, 30)
+        self.y = 3.0 * np.exp(-0.5 * self.x)
+
+    def tearDown(self):
+        clear_media()
+
+    def spec(self, **extra):
+        spec = {'model': 'var0 * exp(-var1 * x)', 'var': [1, 1],
+                'x': list(self.x), 'y': list(self.y)}
+        spec.update(extra)
+        return spec
+
+    def post(self, data, path='/curvefit/api/fit/',
+             content_type='application/json'):
+        if content_type == 'application/json':
+            data = json.dumps(data)
+        return self.client.post(path, data, content_type=content_type)
+
+    def test_fit(self):
+        """
+        A fit is returned without a plot, and without a CSRF token.
+        """
+        response = self.post(self.spec())
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content)
+        self.assertTrue(np.allclose(data['var'], [3.0, 0.5]))
+        self.assertEqual(data['dof'], 28)
+        self.assertFalse('plot' in data or 'plotdata' in data)
+        self.assertEqual(os.listdir(MEDIA_ROOT), [])
+
+    def test_plots(self):
+        data = json.loads(self.post(self.spec(plot='vector')).content)
+        self.assertEqual(len(data['plot']['x']), 30)
+        data = json.loads(self.post(self.spec(plot='png')).content)
+        self.assertTrue(data['plotdata'].startswith('data:image/png;base64,'))
+
+    def test_builtin_and_options(self):
+        spec = self.spec(model='', builtin='expdecay', var=[], auto_guess=True,
+                         solver='dogleg', sigma=[0.1] * 30, upper=[10, 10, 10])
+        data = json.loads(self.post(spec).content)
+        self.assertTrue(np.allclose(data['var'], [0.0, 3.0, 0.5], atol=1e-6))
+
+    def test_errors(self):
+        for spec, msg in [(self.spec(y=[1, 2]), "same length"),
+                          (self.spec(x='abc'), "list of numbers"),
+                          (self.spec(var=[1]), "initial guess"),
+                          (self.spec(sigma=[0] * 30), "positive"),
+                          (self.spec(solver='newton'), "Unknown solver"),
+                          (self.spec(loss='huber', loss_scale=0),
+                           "must be positive"),
+                          (self.spec(model='log(x) + var0'), "Supported"),
+                          (self.spec(model='var0 + var1 * '), "error"),
+                          (self.spec(model=u'var0 * exp(-var1 * \u03bb)'),
+                           "error in the model equation")]:
+            response = self.post(spec)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn(msg, json.loads(response.content)['msg'])
+        response = self.post('{', content_type='text/plain')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get('/curvefit/api/fit/').status_code,
+                         405)
+
+    def test_strict_json(self):
+        """
+        Infinities and NaNs, such as a model evaluated at log(0), are sent
+        as null, since they are not valid JSON.
+        """
+        def reject(name):
+            raise ValueError("%s is not valid JSON" % name)
+        spec = self.spec(model='var0 * log(x) + var1', plot='vector')
+        data = json.loads(self.post(spec).content, parse_constant=reject)
+        self.assertEqual(data['plot']['curve_y'][0], None)
+        self.assertTrue(np.isfinite(data['plot']['curve_y'][1:]).all())
+
+    def test_batch(self):
+        """
+        Each fit of a batch gets its own result or message, in order.
+        """
+        fits = [self.spec(), self.spec(x=[]),
+                self.spec(y=list(2 * self.y))]
+        data = json.loads(self.post({'fits': fits}).content)
+        results = data['results']
+        self.assertEqual(len(results), 3)
+        self.assertTrue(np.allclose(results[0]['var'], [3.0, 0.5]))
+        self.assertEqual(results[1], {'msg': "Cannot read data. Empty input."})
+        self.assertTrue(np.allclose(results[2]['var'], [6.0, 0.5]))
+        settings.CURVEFIT_API_MAX_BATCH = 2
+        try:
+            response = self.post({'fits': fits})
+        finally:
+            settings.CURVEFIT_API_MAX_BATCH = 100
+        self.assertEqual(response.status_code, 400)
+
+    def test_binary_body(self):
+        sigma = np.ones(30)
+        body = np.column_stack([self.x, self.y, sigma]).astype('<f8')
+        response = self.post(body.tostring(), content_type=
+                             'application/octet-stream',
+                             path='/curvefit/api/fit/?model=var0*exp(-var1*x)'
+                                  '&var=1,1&weighted=1')
+        data = json.loads(response.content)
+        self.assertTrue(np.allclose(data['var'], [3.0, 0.5]))
+        response = self.post(body.tostring()[:-8], content_type=
+                             'application/octet-stream',
+                             path='/curvefit/api/fit/?var=1,1&weighted=1')
+        self.assertEqual(response.status_code, 400)
+
+
+class MetricsTest(TestCase):
+    """
+    Test the fit counters, stage timings and iteration cap warnings.
+    """
+    def setUp(self):
+        file_setup()
+        get_result_cache().clear()
+        metrics.reset()
+
+    def tearDown(self):
+        clear_media()
+
+    def post(self):
+        f = open(os.path.join(PROJECT_PATH, 'tests', 'test.csv'), "rU")
+        response = self.client.post('/curvefit/json/', {
+            'model': '1 - (var0 / (1 + (var1 / x) ** var2))',
+            'm1': 1.0, 'm2': 1.0, 'm3': 1.0, 'm4': 1.0,
+            'infile': f,
+        })
+        f.close()
+        return response
+
+    def test_metrics_endpoint(self):
+        self.post()
+        self.post()
+        response = self.client.get('/curvefit/metrics/')
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        for line in ['curvefit_requests_total 2',
+                     'curvefit_fits_total 1',
+                     'curvefit_result_cache_hits_total 1',
+                     'curvefit_iteration_cap_total 0',
+                     '# TYPE curvefit_stage_seconds summary',
+                     'curvefit_stage_seconds_count{stage="parse"} 2',
+                     'curvefit_stage_seconds_count{stage="fit"} 1',
+                     'curvefit_stage_seconds_count{stage="compile"} 1']:
+            self.assertIn(line, response.content)
+        k = json.loads(self.post().content)['k']
+        self.assertIn('curvefit_iterations_total %d' % k,
+                      self.client.get('/curvefit/metrics/').content)
+
+    def test_metrics_can_be_turned_off(self):
+        settings.CURVEFIT_METRICS = False
+        try:
+            response = self.client.get('/curvefit/metrics/')
+        finally:
+            settings.CURVEFIT_METRICS = True
+        self.assertEqual(response.status_code, 404)
+
+    def test_timing_header(self):
+        self.assertFalse(self.post().has_header('Server-Timing'))
+        get_result_cache().clear()
+        settings.CURVEFIT_TIMING_HEADER = True
+        try:
+            response = self.post()
+        finally:
+            settings.CURVEFIT_TIMING_HEADER = False
+        stages = [part.split(';')[0]
+                  for part in response['Server-Timing'].split(', ')]
+        self.assertEqual(stages, ['parse', 'compile', 'guess', 'fit', 'plot',
+                                  'total'])
+
+    def test_iteration_cap_is_logged(self):
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        handlers, logger.handlers = logger.handlers, [handler]
+        try:
+            x = np.linspace(1, 10, 20)
+            result = fit_data('var0 * exp(-var1 * x)', [1.0, 1.0], x,
+                              3 * np.exp(-0.5 * x),
+                              solver_options={'max_iter': 2})
+        finally:
+            logger.handlers = handlers
+        self.assertTrue(result['iteration_cap'])
+        self.assertEqual(len(records), 1)
+        self.assertIn("iteration cap of 2", records[0].getMessage())
+
+
+class BenchmarkTest(TestCase):
+    """
+    Test the benchmark harness on tiny data sets.
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_every_stage_is_timed(self):
+        results = benchmark.run([50], ['mm', 'ic50'], ['.csv', '.xls'], 1)
+        self.assertEqual(sorted(results['timings']), [
+            'compile:ic50', 'compile:mm', 'fit:ic50:50', 'fit:mm:50',
+            'parse:.csv:50', 'parse:.xls:50', 'render:ic50:50',
+            'render:mm:50'])
+        self.assertTrue(all(k > 0 for k in results['iterations'].values()))
+
+    def test_compare_with_baseline(self):
+        baseline = {'timings': {'fit:mm:50': 0.1, 'fit:mm:500': 0.1,
+                                'render:mm:50': 0.0001}}
+        results = {'timings': {'fit:mm:50': 0.2, 'fit:mm:500': 0.11,
+                               'render:mm:50': 0.0005, 'parse:.txt:50': 1.0}}
+        self.assertEqual(benchmark.compare(results, baseline),
+                         [('fit:mm:50', 0.1, 0.2)])
+
+    def test_command(self):
+        output = os.path.join(self.directory, 'results.json')
+        out = StringIO()
+        call_command('benchmark', sizes='50', models='mm', formats='.txt',
+                     repeat=1, output=output, stdout=out)
+        self.assertIn('fit:mm:50', out.getvalue())
+        results = benchmark.load(output)
+        self.assertEqual(len(results['timings']), 4)
+        for key in results['timings']:
+            results['timings'][key] /= 100.0
+        baseline = os.path.join(self.directory, 'baseline.json')
+        benchmark.save(results, baseline)
+        err = StringIO()
+        self.assertRaises(SystemExit, call_command, 'benchmark',
+                          sizes='50', models='mm', formats='.txt', repeat=1,
+                          baseline=baseline, stdout=StringIO(), stderr=err)
+        self.assertIn("slower than the baseline", err.getvalue())
+
 
 class CurveFitFailTest(TestCase):
     """
@@ -346,10 +2069,10 @@ class CurveFitFailTest(TestCase):
         """
         # Fake data...
         file_setup()
+        get_result_cache().clear()
 
     def tearDown(self):
-        for f in os.listdir(MEDIA_ROOT):
-            os.remove(os.path.join(MEDIA_ROOT, f))
+        clear_media()
 
     def setup_response(self,
                        filename,
@@ -464,11 +2187,23 @@ class CurveFitFailTest(TestCase):
             response.content)
         response = self.setup_response(
             'test.xls',
-            model='var2*log(var1*x) + var0*exp(var3*x / var4)')
+            model=' + '.join('var%d * x ** %d' % (i, i) for i in range(17)))
         self.assertIn(
             '<p class="errorlist">Supported models must have at least 2',
             response.content)
 
+    def test_curvefit_fails_without_enough_guesses(self):
+        """
+        Models with more than four parameters need the extra guesses.
+        """
+        response = self.setup_response(
+            'test.xls',
+            model='var2*log(var1*x) + var0*exp(var3*x / var4)')
+        self.assertIn(
+            '<p class="errorlist">Please give an initial guess for each of '
+            'the 5 parameters.</p>',
+            response.content)
+
     def test_bad_model(self):
         """
         A bad model should return a message.
@@ -477,3 +2212,13 @@ class CurveFitFailTest(TestCase):
         self.assertIn(
             '<p class="errorlist">There was an error in the model equation.</p>',
             response.content)
+
+    def test_non_ascii_model(self):
+        """
+        A model that is not ASCII is an error in the model, not a crash.
+        """
+        response = self.setup_response('test.xls',
+                                       model=u'var0 * exp(-var1 * \u03bb)')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("There was an error in the model equation.",
+                      response.content)
@@ -0,0 +1,96 @@
+import numpy as np
+
+# Two-sided confidence level of the bands drawn around the fitted curve.
+CONFIDENCE = 0.95
+NORMAL_QUANTILE = 1.959963984540054
+
+# Largest condition number of J^T W J, scaled to a unit diagonal, whose
+# inverse is trusted.
+MAX_CONDITION = 1.0 / np.finfo(float).eps
+
+
+def t_quantile(dof):
+    """
+    Return the two-sided 95% quantile of Student's t distribution with dof
+    degrees of freedom: exactly for one and two, and otherwise from the
+    Cornish-Fisher expansion about the normal quantile, which is within
+    0.2% of it.
+    """
+    p = 0.5 + 0.5 * CONFIDENCE
+    if dof == 1:
+        return np.tan(np.pi * (p - 0.5))
+    if dof == 2:
+        return (2 * p - 1) / np.sqrt(2 * p * (1 - p))
+    z = NORMAL_QUANTILE
+    return (z + (z ** 3 + z) / (4.0 * dof)
+            + (5 * z ** 5 + 16 * z ** 3 + 3 * z) / (96.0 * dof ** 2)
+            + (3 * z ** 7 + 19 * z ** 5 + 17 * z ** 3 - 15 * z)
+              / (384.0 * dof ** 3)
+            + (79 * z ** 9 + 776 * z ** 7 + 1482 * z ** 5 - 1920 * z ** 3
+               - 945 * z) / (92160.0 * dof ** 4))
+
+def covariance(jtj, ssr, dof):
+    """
+    Return the covariance matrix of the parameters from J^T W J at the fit
+    and the weighted residual sum of squares, scaled by the residual
+    variance ssr / dof as the weights are taken to be relative. J^T W J is
+    scaled to a unit diagonal before it is inverted, so that parameters of
+    very different sizes do not count against it. A singular or
+    ill-conditioned J^T W J, or no degrees of freedom, gives infinite
+    variances.
+    """
+    N = len(jtj)
+    cov = np.empty((N, N))
+    cov.fill(np.inf)
+    d = np.sqrt(np.diag(jtj))
+    if dof <= 0 or not np.isfinite(jtj).all() or not (d > 0).all():
+        return cov
+    scale = np.outer(d, d)
+    try:
+        if np.linalg.cond(jtj / scale) > MAX_CONDITION:
+            return cov
+        return np.linalg.inv(jtj / scale) / scale * (ssr / dof)
+    except np.linalg.LinAlgError:
+        return cov
+
+def r_squared(y, chi2, weights=None):
+    """
+    Return the coefficient of determination of a fit to y with weighted
+    residual sum of squares chi2.
+    """
+    if weights is None:
+        weights = np.ones(len(y))
+    mean = np.dot(weights, y) / weights.sum()
+    d = y - mean
+    total = np.dot(weights * d, d)
+    return 1.0 - chi2 / total if total > 0 else np.nan
+
+def band(jt, cov, dof):
+    """
+    Return the half width of the confidence band of the fitted curve at
+    points whose transposed Jacobian is jt, of shape (N, n).
+    """
+    var = np.einsum('in,ij,jn->n', jt, cov, jt)
+    return t_quantile(max(dof, 1)) * np.sqrt(np.maximum(var, 0))
+
+def finite(values):
+    """
+    Return values as nested lists for JSON, with non-finite entries as None.
+    """
+    values = np.asarray(values, dtype=float)
+    if values.ndim == 0:
+        return float(values) if np.isfinite(values) else None
+    return [finite(v) for v in values]
+
+def json_safe(data):
+    """
+    Return data with every non-finite float in it, however deeply nested in
+    dicts, lists and tuples, replaced by None, so it can be sent as JSON.
+    """
+    if isinstance(data, dict):
+        return dict((k, json_safe(v)) for k, v in data.items())
+    if isinstance(data, (list, tuple)):
+        return [json_safe(v) for v in data]
+    if isinstance(data, float) and not np.isfinite(data):
+        return None
+    return data
@@ -1,95 +1,500 @@
+import json
 import os
+import time
 import matplotlib
 
 matplotlib.use("Agg")
 
-from django.http import HttpResponseRedirect
-from django.shortcuts import render_to_response
+from django.conf import settings
+from django.http import (HttpResponse, HttpResponseNotAllowed,
+                         HttpResponseNotFound, HttpResponseRedirect)
+from django.shortcuts import get_object_or_404, render_to_response
 from django.template import RequestContext
 from django.core.context_processors import csrf
+from django.forms import ValidationError
+from django.views.decorators.csrf import csrf_exempt
 from sympy.core.sympify import SympifyError
 
-from curvefit.forms import CurvefitForm
+from curvefit.executor import fit_summary
+from curvefit.forms import CurvefitForm, parse_numbers
 from curvefit.functions import *
-from curvefit.model_functions import find_nvars
+from curvefit.guess import guess_parameters
+from curvefit.resultcache import cached_execute, cached_execute_many, lookup
+from curvefit.jobs import expire_job, submit_job
+from curvefit.metrics import metrics, server_timing, timed
+from curvefit.model_functions import (BUILTIN_MODELS, MAX_NVARS, check_vars,
+                                      find_nvars)
+from curvefit.models import FitJob
+from curvefit.solvers import LOSSES, SOLVERS
+from curvefit.uncertainty import json_safe
+
+SUPPORTED_EXTENSIONS = ['.txt', '.csv', '.xls', '.xlsx', '.npy', '.npz',
+                        '.parquet']
+
+
+def form_error(request, form, msg, action='/curvefit/'):
+    return render_to_response('curvefit/curvefitform.html',
+                              {'form': form, 'msg': msg, 'action': action},
+                              context_instance=RequestContext(request))
+
+def initial_guess(data, model):
+    """
+    Return the initial guess from the cleaned form data for model, or None
+    and a message explaining why there is none.
+    """
+    guess = [data['m1'], data['m2'], data['m3'], data['m4']]
+    guess += data['more_vars']
+    return pad_guess(guess, model, data['auto_guess'])
+
+def pad_guess(guess, model, auto_guess):
+    """
+    Return a value of guess for each parameter of model, padded with ones
+    if it is short and the guess is to be estimated anyway, or None and a
+    message.
+    """
+    nvars = find_nvars(model)
+    if nvars < 2 or nvars > MAX_NVARS:
+        return None, "Supported models must have at least 2 \
+                      and at most %d independent variables!" % MAX_NVARS
+    msg = check_vars(model)
+    if msg:
+        return None, msg
+    guess = list(guess)
+    if len(guess) < nvars:
+        if not auto_guess:
+            return None, ("Please give an initial guess for each of the "
+                          "%d parameters." % nvars)
+        guess += [1.0] * (nvars - len(guess))
+    return np.array(guess[:nvars]), ''
+
+def parameter_rows(var, stderr=None):
+    """
+    Pair each fitted parameter with its standard error, or None if there
+    is none.
+    """
+    return zip(var, stderr or [None] * len(var))
+
+def prepare_fit(data):
+    """
+    Check the cleaned form data and read the uploaded file. Returns the
+    arguments for fit_data, or None and a message explaining the problem.
+    """
+    model = str(data['model'])
+    infile = data['infile']
+    ext = os.path.splitext(infile.name)[1]
+    if ext not in SUPPORTED_EXTENSIONS:
+        return None, "%s is an unsupported file type." % ext
+    var, msg = initial_guess(data, model)
+    if msg:
+        return None, msg
+    columns = None
+    if data['x_column'] or data['y_column'] or data['sigma_column']:
+        columns = [data['x_column'] or '1', data['y_column'] or '2']
+        if data['sigma_column']:
+            columns.append(data['sigma_column'])
+    x, y, sigma, msg = load_data(infile, ext, columns)
+    metrics.inc('bytes_parsed', infile.size)
+    if msg:
+        return None, msg
+    solver_options = {}
+    if data['lower_bounds']:
+        solver_options['lower'] = data['lower_bounds']
+    if data['upper_bounds']:
+        solver_options['upper'] = data['upper_bounds']
+    kwargs = {
+        'model': model,
+        'var': [float(v) for v in var],
+        'x': x,
+        'y': y,
+        'sigma': sigma,
+        'logscale': data['logscale'],
+        'builtin': data['builtin_models'],
+        'xlabel': data['x_label'],
+        'ylabel': data['y_label'],
+        'auto_guess': data['auto_guess'],
+        'multistart': data['multistart'],
+        'solver': data['solver'] or None,
+        'solver_options': solver_options,
+        'loss': data['loss'] or 'linear',
+        'loss_scale': data['loss_scale'],
+    }
+    return kwargs, ''
+
+def add_timings(response, timings, result, start):
+    """
+    Count the time spent parsing the upload and handling the whole request,
+    and add a Server-Timing header with every stage to response if that is
+    turned on. Like 'time', the fit stages of a cached result are those of
+    the run that produced it.
+    """
+    timings['total'] = time.time() - start
+    metrics.observe(timings)
+    if settings.CURVEFIT_TIMING_HEADER:
+        stages = dict(result.get('timings', {}))
+        stages.update(timings)
+        response['Server-Timing'] = server_timing(stages)
+    return response
+
+def result_context(filename, model, result):
+    """
+    Return the context of the results page for a successful fit of model to
+    the data in filename.
+    """
+    c = {
+        'filename': filename,
+        'plotfile': result['plotfile'],
+        'plotdata': result.get('plotdata'),
+        'model': model,
+        'k': result['k'],
+        'nfev': result.get('nfev'),
+        'njev': result.get('njev'),
+        'time': result.get('time'),
+        'loss_scale': result.get('loss_scale'),
+        'var': result['var'],
+        'params': parameter_rows(result['var'], result.get('stderr')),
+        'r2': result.get('r2'),
+        'chi2_red': result.get('chi2_red'),
+        'dof': result.get('dof'),
+        'solutions': result.get('solutions'),
+    }
+    if result.get('plot') is not None:
+        c['plotjson'] = json.dumps(result['plot'])
+    return c
 
 def curvefit(request):
+    if request.method == 'POST':
+        start = time.time()
+        metrics.inc('requests')
+        form = CurvefitForm(request.POST, request.FILES)
+        if form.is_valid():
+            timings = {}
+            with timed(timings, 'parse'):
+                kwargs, msg = prepare_fit(form.cleaned_data)
+            if msg:
+                return form_error(request, CurvefitForm(request.POST), msg)
+            filename = os.path.basename(form.cleaned_data['infile'].name)
+            vector_plot = form.cleaned_data['vector_plot']
+            if vector_plot:
+                kwargs['vector_plot'] = True
+            else:
+                kwargs['store_plot'] = True
+            if settings.CURVEFIT_ASYNC:
+                result = lookup(kwargs)[0]
+                if result is None:
+                    job = submit_job(kwargs, filename)
+                    return HttpResponseRedirect('/curvefit/job/%d/' % job.pk)
+            else:
+                kwargs['inline_plot'] = settings.CURVEFIT_INLINE_PLOTS
+                result = cached_execute(kwargs)
+            if 'msg' in result:
+                return form_error(request, CurvefitForm(request.POST),
+                                  result['msg'])
+            
+            c = result_context(filename, kwargs['model'], result)
+            response = render_to_response('curvefit/curvefitsuccess.html', c)
+            return add_timings(response, timings, result, start)
+    else:
+        form = CurvefitForm()
+    return render_to_response('curvefit/curvefitform.html', {'form': form}, 
+                              context_instance=RequestContext(request))
+
+def curvefit_json(request):
+    """
+    Fit a form submission and return the parameters and the points needed
+    to draw the plot as JSON.
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    start = time.time()
+    metrics.inc('requests')
+    form = CurvefitForm(request.POST, request.FILES)
+    if not form.is_valid():
+        return json_response({'errors': form.errors}, status=400)
+    timings = {}
+    with timed(timings, 'parse'):
+        kwargs, msg = prepare_fit(form.cleaned_data)
+    if msg:
+        return json_response({'msg': msg}, status=400)
+    kwargs['vector_plot'] = True
+    result = cached_execute(kwargs)
+    if 'msg' in result:
+        return json_response({'msg': result['msg']}, status=400)
+    response = json_response(fit_summary(kwargs['model'], result))
+    return add_timings(response, timings, result, start)
+
+def json_response(data, status=200):
+    """
+    Return data as JSON. Infinities and NaNs are not valid JSON, so they
+    are sent as null.
+    """
+    return HttpResponse(json.dumps(json_safe(data), allow_nan=False),
+                        status=status,
+                        content_type='application/json')
+
+def api_numbers(value, name):
+    """
+    Return a list of numbers from the API as a float array, or None and a
+    message.
+    """
+    try:
+        values = np.array(value, dtype=float)
+    except (TypeError, ValueError):
+        values = None
+    if values is None or values.ndim != 1:
+        return None, "%s must be a list of numbers." % name
+    if not np.isfinite(values).all():
+        return None, "%s must all be finite." % name
+    return values, ''
+
+def api_fit_arguments(spec):
+    """
+    Check one fit asked for through the API and return the arguments for
+    fit_data, or None and a message explaining the problem. See README for
+    the fields of spec.
+    """
+    if not isinstance(spec, dict):
+        return None, "Each fit must be a JSON object."
+    builtin = spec.get('builtin') or ''
+    if builtin and builtin not in BUILTIN_MODELS:
+        return None, "Unknown built-in model %s." % builtin
+    model = spec.get('model') or (builtin and
+                                  BUILTIN_MODELS[builtin].expression)
+    if not isinstance(model, basestring) or not model:
+        return None, "Give a model or the name of a built-in model."
+    try:
+        model = str(model)
+    except UnicodeEncodeError:
+        return None, "There was an error in the model equation."
+    auto_guess = bool(spec.get('auto_guess'))
+    guess, msg = api_numbers(spec.get('var') or [], 'var')
+    if msg:
+        return None, msg
+    var, msg = pad_guess(guess, model, auto_guess)
+    if msg:
+        return None, msg
+    columns = [('x', spec.get('x')), ('y', spec.get('y'))]
+    if spec.get('sigma') is not None:
+        columns.append(('sigma', spec['sigma']))
+    data = {}
+    for name, value in columns:
+        data[name], msg = api_numbers(value, name)
+        if msg:
+            return None, msg
+    if not len(data['x']):
+        return None, "Cannot read data. Empty input."
+    if any(len(v) != len(data['x']) for v in data.values()):
+        return None, "x, y and sigma must all be the same length."
+    sigma = data.get('sigma')
+    if sigma is not None:
+        msg = check_sigma(sigma)
+        if msg:
+            return None, msg
+    solver = spec.get('solver') or None
+    if solver is not None and solver not in SOLVERS:
+        return None, "Unknown solver %s." % solver
+    loss = spec.get('loss') or 'linear'
+    if loss not in LOSSES:
+        return None, "Unknown loss %s." % loss
+    loss_scale = spec.get('loss_scale')
+    if loss_scale is not None:
+        try:
+            loss_scale = float(loss_scale)
+        except (TypeError, ValueError):
+            return None, "loss_scale must be a number."
+        if not 0 < loss_scale < float('inf'):
+            return None, "loss_scale must be positive."
+    solver_options = {}
+    for name in ('lower', 'upper'):
+        if spec.get(name) is not None:
+            bounds, msg = api_numbers(spec[name], name)
+            if msg:
+                return None, msg
+            solver_options[name] = [float(b) for b in bounds]
+    plot = spec.get('plot') or None
+    if plot not in (None, 'vector', 'png'):
+        return None, "plot must be 'vector' or 'png'."
+    kwargs = {
+        'model': model,
+        'var': [float(v) for v in var],
+        'x': data['x'],
+        'y': data['y'],
+        'sigma': sigma,
+        'logscale': bool(spec.get('logscale')),
+        'builtin': builtin,
+        'xlabel': spec.get('xlabel') or '',
+        'ylabel': spec.get('ylabel') or '',
+        'auto_guess': auto_guess,
+        'multistart': bool(spec.get('multistart')),
+        'solver': solver,
+        'solver_options': solver_options,
+        'loss': loss,
+        'loss_scale': loss_scale,
+        'vector_plot': plot == 'vector',
+        'inline_plot': plot == 'png',
+    }
+    return kwargs, ''
+
+def binary_fit(request):
+    """
+    Return the fit asked for by a request whose body holds the data as
+    little-endian doubles, x, y and, with weighted=1 in the query string,
+    sigma for each point in turn. Everything else comes from the query
+    string, with lists separated by commas. Returns None and a message if
+    the body cannot be read.
+    """
+    query = request.GET
+    ncols = 3 if query.get('weighted') in ('1', 'true') else 2
+    body = request.raw_post_data
+    if len(body) % (8 * ncols):
+        return None, ("The body must hold %d little-endian doubles for "
+                      "each point." % ncols)
+    data = np.frombuffer(body, dtype='<f8').reshape(-1, ncols)
+    spec = {'x': data[:, 0], 'y': data[:, 1]}
+    if ncols == 3:
+        spec['sigma'] = data[:, 2]
+    for name in ('model', 'builtin', 'solver', 'loss', 'loss_scale', 'plot',
+                 'xlabel', 'ylabel'):
+        if query.get(name):
+            spec[name] = query[name]
+    for name in ('logscale', 'auto_guess', 'multistart'):
+        spec[name] = query.get(name) in ('1', 'true')
+    for name in ('var', 'lower', 'upper'):
+        if query.get(name):
+            try:
+                spec[name] = parse_numbers(query[name])
+            except ValidationError:
+                return None, "%s must be a list of numbers." % name
+    return spec, ''
+
+@csrf_exempt
+def api_fit(request):
+    """
+    Fit data sent as JSON, or as binary with the options in the query
+    string, and return the results as JSON, without plotting unless asked
+    to. A JSON body with a list of 'fits' runs them all in one request, in
+    parallel when there are workers, and returns a list of 'results', each
+    either a fit or a 'msg' saying why it failed.
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    start = time.time()
+    metrics.inc('requests')
+    metrics.inc('bytes_parsed', len(request.raw_post_data))
+    timings = {}
+    with timed(timings, 'parse'):
+        content_type = request.META.get('CONTENT_TYPE', '').split(';')[0]
+        if content_type == 'application/octet-stream':
+            spec, msg = binary_fit(request)
+        else:
+            try:
+                spec, msg = json.loads(request.raw_post_data), ''
+            except ValueError:
+                spec, msg = None, "The request body is not valid JSON."
+        if msg:
+            return json_response({'msg': msg}, status=400)
+        batch = isinstance(spec, dict) and 'fits' in spec
+        if batch:
+            specs = spec['fits']
+            if not isinstance(specs, list):
+                return json_response({'msg': "fits must be a list."},
+                                     status=400)
+            if len(specs) > settings.CURVEFIT_API_MAX_BATCH:
+                return json_response(
+                    {'msg': "At most %d fits may be sent at once." %
+                            settings.CURVEFIT_API_MAX_BATCH}, status=400)
+        else:
+            specs = [spec]
+        checked = [api_fit_arguments(s) for s in specs]
+    if not batch:
+        kwargs, msg = checked[0]
+        if msg:
+            return json_response({'msg': msg}, status=400)
+        result = cached_execute(kwargs)
+        if 'msg' in result:
+            return json_response({'msg': result['msg']}, status=400)
+        response = json_response(fit_summary(kwargs['model'], result))
+        return add_timings(response, timings, result, start)
+    valid = [kwargs for kwargs, msg in checked if not msg]
+    fitted = iter(cached_execute_many(valid))
+    results = []
+    for kwargs, msg in checked:
+        result = {'msg': msg} if msg else next(fitted)
+        if 'msg' in result:
+            results.append({'msg': result['msg']})
+        else:
+            results.append(fit_summary(kwargs['model'], result))
+    response = json_response({'results': results})
+    return add_timings(response, timings, {}, start)
+
+def curvefit_batch(request):
+    """
+    Fit the model to every y column of the uploaded file.
+    """
+    action = '/curvefit/batch/'
     if request.method == 'POST':
         form = CurvefitForm(request.POST, request.FILES)
         if form.is_valid():
             model = str(form.cleaned_data['model'])
-            m1 = form.cleaned_data['m1']
-            m2 = form.cleaned_data['m2']
-            m3 = form.cleaned_data['m3']
-            m4 = form.cleaned_data['m4']
-            xlabel = form.cleaned_data['x_label']
-            ylabel = form.cleaned_data['y_label']
+            builtin = form.cleaned_data['builtin_models']
             logscale = form.cleaned_data['logscale']
             infile = form.cleaned_data['infile']
             ext = os.path.splitext(infile.name)[1]
-            if ext not in ['.txt', '.csv', '.xls']:
+            if ext not in SUPPORTED_EXTENSIONS:
                 msg = "%s is an unsupported file type." % ext
-                form = CurvefitForm(request.POST)
-                return render_to_response('curvefit/curvefitform.html', 
-                                          {'form': form,
-                                           'msg': msg},
-                                context_instance=RequestContext(request))
-            content = infile.read()
-            filepath = os.path.join(MEDIA_ROOT, infile.name)
-            if ext == '.xls':
-                sf = open(filepath, "wb")
-            else:
-                sf = open(filepath, "w")
-            sf.write(content)
-            sf.close()
-            
-            nvars = find_nvars(model)
-            if nvars == 4:
-                var = np.array([m1, m2, m3, m4])
-            elif nvars == 3:
-                var = np.array([m1, m2, m3])
-            elif nvars == 2:
-                var = np.array([m1, m2])
-            else:
-                msg = "Supported models must have at least 2 \
-                       and at most 4 independent variables!"
-                form = CurvefitForm()
-                return render_to_response('curvefit/curvefitform.html',
-                                          {'form': form, 'msg': msg},
-                                context_instance=RequestContext(request))
-            plotname = "plot_" + random_key() + ".png"
-            plotfile = os.path.join(MEDIA_ROOT, plotname)
-            
+                return form_error(request, CurvefitForm(request.POST), msg,
+                                  action)
+            var, msg = initial_guess(form.cleaned_data, model)
+            if msg:
+                return form_error(request, CurvefitForm(request.POST), msg,
+                                  action)
             try:
-                fit = CurveFit(filepath, model, var, logscale)
+                fit = BatchCurveFit(infile.name, model, var, logscale,
+                                    builtin)
             except:
                 msg = "There was an error in the model equation."
-                form = CurvefitForm(request.POST)
-                return render_to_response('curvefit/curvefitform.html',
-                                          {'form': form, 'msg': msg},
-                                context_instance=RequestContext(request))
-            fit.file_handler(ext)
+                return form_error(request, CurvefitForm(request.POST), msg,
+                                  action)
+            fit.file_handler(ext, infile)
             if fit.msg:
-                form = CurvefitForm(request.POST)
-                return render_to_response('curvefit/curvefitform.html',
-                                          {'form': form,
-                                           'msg': fit.msg},
-                                    context_instance=RequestContext(request))
-            fit_var = fit.levenberg_marquardt()
-            fit.plot(plotfile, xlabel, ylabel)
-            
-            filename = os.path.basename(filepath)
-            
+                return form_error(request, CurvefitForm(request.POST),
+                                  fit.msg, action)
+            if form.cleaned_data['auto_guess']:
+                fit.guess = np.array([guess_parameters(fit.compiled, var,
+                                                       fit.x, y)
+                                      for y in fit.y])
+            iters, params = fit.levenberg_marquardt()
             c = {
-                'filename': filename,
-                'plotfile': plotname,
+                'filename': os.path.basename(infile.name),
                 'model': model,
-                'k': fit_var[0],
-                'var': fit_var[1],
-            }    
-            return render_to_response('curvefit/curvefitsuccess.html', c)
+                'nvar': range(fit.nvar),
+                'results': zip(range(1, len(iters) + 1), iters, params),
+            }
+            return render_to_response('curvefit/curvefitbatch.html', c)
     else:
         form = CurvefitForm()
-    return render_to_response('curvefit/curvefitform.html', {'form': form}, 
+    return render_to_response('curvefit/curvefitform.html',
+                              {'form': form, 'action': action},
                               context_instance=RequestContext(request))
 
+def job_status(request, job_id):
+    """
+    Show the results of a queued fit, or a page that waits for them.
+    """
+    job = expire_job(get_object_or_404(FitJob, pk=job_id))
+    if job.status == 'done':
+        c = result_context(job.filename, job.model, job.get_result())
+        return render_to_response('curvefit/curvefitsuccess.html', c)
+    return render_to_response('curvefit/curvefitjob.html', {'job': job})
+
+def metrics_view(request):
+    """
+    Serve this process's fit counters and stage timings for Prometheus.
+    """
+    if not settings.CURVEFIT_METRICS:
+        return HttpResponseNotFound()
+    return HttpResponse(metrics.render(),
+                        content_type='text/plain; version=0.0.4')
+
+def job_json(request, job_id):
+    job = expire_job(get_object_or_404(FitJob, pk=job_id))
+    return json_response(job.as_dict())
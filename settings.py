@@ -1,6 +1,7 @@
 # Django settings for django_curvefit project.
 
 import os
+import tempfile
 
 PROJECT_PATH = os.path.abspath(os.path.dirname(__file__))
 
@@ -17,6 +18,10 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3', 
         'NAME': os.path.join(PROJECT_PATH, os.path.join('db', 'mydb.sqlite3')),
+        # A file rather than memory, so that the tests of queued jobs can
+        # see the database from the worker pool's result handler thread.
+        'TEST_NAME': os.path.join(tempfile.gettempdir(),
+                                  'curvefit-test.sqlite3'),
     }
 }
 
@@ -86,6 +91,22 @@ STATICFILES_FINDERS = (
 # Make this unique, and don't share it with anybody.
 SECRET_KEY = '3k^j(h0ovt#lj4c&q(&f#ol5)u5g)kont6e&fu!bt1e=b09a^1'
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Results of recent fits, so resubmitting the same data, model and
+    # initial guess does not fit it again.
+    'curvefit': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'curvefit-results',
+        'TIMEOUT': 3600,
+        'OPTIONS': {
+            'MAX_ENTRIES': 200,
+        },
+    },
+}
+
 # List of callables that know how to import templates from various sources.
 TEMPLATE_LOADERS = (
     'django.template.loaders.filesystem.Loader',
@@ -133,6 +154,10 @@ LOGGING = {
         'mail_admins': {
             'level': 'ERROR',
             'class': 'django.utils.log.AdminEmailHandler'
+        },
+        'console': {
+            'level': 'WARNING',
+            'class': 'logging.StreamHandler'
         }
     },
     'loggers': {
@@ -141,5 +166,71 @@ LOGGING = {
             'level': 'ERROR',
             'propagate': True,
         },
+        # Warns of fits that stop at the iteration cap.
+        'curvefit': {
+            'handlers': ['console'],
+            'level': 'WARNING',
+        },
     }
 }
+
+# Number of compiled models (sympy expression, lambdified model and partial
+# derivatives) each process keeps in memory.
+CURVEFIT_MODEL_CACHE_SIZE = 128
+
+# Number of worker processes that compile models and run fits. Fits of the
+# same model always go to the same worker. With 0, fits run in the web
+# process. Fits still running after CURVEFIT_FIT_TIMEOUT seconds are
+# abandoned, and their worker is replaced.
+CURVEFIT_WORKERS = 0
+CURVEFIT_FIT_TIMEOUT = 300
+
+# Queue fits and redirect to a job page that polls for the result, instead
+# of waiting for the fit inside the request. Needs CURVEFIT_WORKERS.
+CURVEFIT_ASYNC = False
+
+# Embed result plots in the results page instead of saving them to
+# MEDIA_ROOT.
+CURVEFIT_INLINE_PLOTS = False
+
+# Cache from CACHES holding fit results, or None to always fit.
+CURVEFIT_RESULT_CACHE = 'curvefit'
+
+# Default stopping rules for the solvers: at most CURVEFIT_MAX_ITER
+# iterations, stopping early once the largest gradient component is below
+# CURVEFIT_GTOL or a step moves the parameters by less than CURVEFIT_XTOL.
+CURVEFIT_MAX_ITER = 200
+CURVEFIT_GTOL = 1.0e-15
+CURVEFIT_XTOL = 1.0e-20
+
+# Fits evaluate the model and its Jacobian over at most this many points at
+# a time, so memory stays bounded however large the data set is.
+CURVEFIT_CHUNK_SIZE = 65536
+
+# With 'c', models are compiled to C loop kernels by the local compiler
+# ($CC, or cc) instead of running as generated numpy code. The libraries are
+# kept in CURVEFIT_KERNEL_CACHE_DIR, by default curvefit-kernels-<uid> in the
+# temporary directory, and shared by every process using it. The directory
+# and libraries must belong to the server's user and be writable by nobody
+# else, or they are not loaded.
+CURVEFIT_COMPILE_TIER = 'numpy'
+CURVEFIT_KERNEL_CACHE_DIR = None
+
+# Serve fit counters and stage timings for Prometheus at /curvefit/metrics/,
+# and add a Server-Timing header breaking down the time spent on each fit
+# response.
+CURVEFIT_METRICS = True
+CURVEFIT_TIMING_HEADER = False
+
+# Result plots are stored in CURVEFIT_PLOT_DIR under MEDIA_ROOT, named after
+# a hash of their contents. Every CURVEFIT_PLOT_SWEEP_INTERVAL seconds (0 for
+# never; see also manage.py sweep_plots) plots unused for CURVEFIT_PLOT_TTL
+# seconds are removed, then the least recently used until the rest take up
+# at most CURVEFIT_PLOT_BUDGET bytes. None turns either limit off.
+CURVEFIT_PLOT_DIR = 'plots'
+CURVEFIT_PLOT_BUDGET = 512 * 1024 * 1024
+CURVEFIT_PLOT_TTL = 7 * 24 * 3600
+CURVEFIT_PLOT_SWEEP_INTERVAL = 3600
+
+# Most fits /curvefit/api/fit/ accepts in one batch request.
+CURVEFIT_API_MAX_BATCH = 100
@@ -2,12 +2,20 @@ from django.contrib.staticfiles.urls import staticfiles_urlpatterns
 from django.conf.urls.defaults import patterns, include, url
 from django.conf import settings
 
+from curvefit.plotstore import start_sweeper
+
 # Uncomment the next two lines to enable the admin:
 # from django.contrib import admin
 # admin.autodiscover()
 
 urlpatterns = patterns('',
     (r'^curvefit/$', 'curvefit.views.curvefit'),
+    (r'^curvefit/batch/$', 'curvefit.views.curvefit_batch'),
+    (r'^curvefit/json/$', 'curvefit.views.curvefit_json'),
+    (r'^curvefit/api/fit/$', 'curvefit.views.api_fit'),
+    (r'^curvefit/metrics/$', 'curvefit.views.metrics_view'),
+    (r'^curvefit/job/(?P<job_id>\d+)/$', 'curvefit.views.job_status'),
+    (r'^curvefit/job/(?P<job_id>\d+)/json/$', 'curvefit.views.job_json'),
 )
 
 if settings.DEBUG:
@@ -21,3 +29,5 @@ if settings.DEBUG:
     )
 
 urlpatterns += staticfiles_urlpatterns()
+
+start_sweeper()